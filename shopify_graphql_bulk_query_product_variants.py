@@ -26,297 +26,247 @@ GRAPHQL_VER = "2024-10"
 GRAPHQL_ENDPOINT = "https://" + STORE_NAME + ".myshopify.com/admin/api/" + GRAPHQL_VER + "/graphql.json"
 
 
+# ---------------------------------------------------------------------------
 
-def shopify_graphql_bulk_query(query:str=None, verbose:bool=False):
-    """
-    Execute the bulk query specified by query and return the bulk operation id
-    Requires global variables:  API_TOKEN and GRAPHQL_ENDPOINT 
+# The client (connection pool, rate limit throttle, retries and metrics), the bulk query, poll,
+# download and JSON lines parsing functions are shared with the update script and imported from it.
+# Pass them client=shopify_graphql_client() to use this script's store settings above.
+
+from shopify_graphql_bulk_query_update_product_variants import ShopifyGraphQLClient, shopify_graphql_bulk_poll, shopify_graphql_bulk_iter
+
+_default_client = None
 
-    bulk_op_id = shopify_graphql_bulk_query(query=query)
+def shopify_graphql_client(client:ShopifyGraphQLClient=None):
     """
-    # https://shopify.dev/docs/api/admin-graphql/2024-10/objects/BulkOperation
+    Returns client, or if client is None, a pooled client built from this script's global variables
+    API_TOKEN, STORE_NAME, GRAPHQL_VER and GRAPHQL_ENDPOINT.  The fallback client is re-used until those globals change.
 
-    import json
+    client = shopify_graphql_client(client)
+    """
+    global _default_client
 
-    # pip install requests
-    import requests
+    if not client is None: return client
 
     if not isinstance(API_TOKEN, str): raise Exception("API_TOKEN is not defined")
     if not isinstance(GRAPHQL_ENDPOINT, str): raise Exception("GRAPHQL_ENDPOINT is not defined")
 
-    # Define the headers for the GraphQL HTTP POST
-    headers = {
-        'Content-Type': 'application/graphql',      # Must be: 'application/graphql'    NOT: 'application/json'
-        'X-Shopify-Access-Token': f'{API_TOKEN}',
-    }
+    if _default_client is None or not _default_client.api_token == API_TOKEN or not _default_client.graphql_endpoint == GRAPHQL_ENDPOINT:
+        if not _default_client is None: _default_client.close()
+        _default_client = ShopifyGraphQLClient(store_name=STORE_NAME, api_token=API_TOKEN, graphql_ver=GRAPHQL_VER, graphql_endpoint=GRAPHQL_ENDPOINT)
 
+    return _default_client
 
-    response = requests.post(GRAPHQL_ENDPOINT, data=query, headers=headers)
-    data = response.json()
 
-    #print("type(data):", type(data))    # <class 'dict'>
-    #print("type(json.dumps(data, indent=2)):", type(json.dumps(data, indent=2)))    # <class 'str'>
+# ---------------------------------------------------------------------------
 
-    #print(json.dumps(data, indent=2))
+def shopify_graphql_webhook_subscribe(callback_url:str=None, topic:str="BULK_OPERATIONS_FINISH", verbose:bool=False, client:ShopifyGraphQLClient=None):
     """
+    Subscribe callback_url to the webhook topic (default BULK_OPERATIONS_FINISH, the bulk_operations/finish
+    topic) and return the webhook subscription id.  callback_url must reach a ShopifyBulkWebhookReceiver
+    (Shopify requires a public https url, ex. a reverse proxy or tunnel to the receiver's port).
 
-    {
-    "errors": "Not Found"
-    }
-    
-    {
-    "data": {
-        "bulkOperationRunQuery": {
-        "bulkOperation": {
-            "id": "gid://shopify/BulkOperation/4142422163590",
-            "status": "CREATED"
-        },
-        "userErrors": []
-        }
-    },
-    "extensions": {
-        "cost": {
-        "requestedQueryCost": 10,
-        "actualQueryCost": 10,
-        "throttleStatus": {
-            "maximumAvailable": 2000.0,
-            "currentlyAvailable": 1990,
-            "restoreRate": 100.0
-        }
-        }
-    }
-    }
+    subscription_id = shopify_graphql_webhook_subscribe(callback_url="https://example.com/webhooks/bulk_operations_finish")
     """
+    # https://shopify.dev/docs/api/usage/bulk-operations/queries#option-a-subscribe-to-the-bulk_operations-finish-webhook-topic
+
+    import json
+
+    client = shopify_graphql_client(client)
+
+    query = '''mutation {webhookSubscriptionCreate(topic: ''' + topic + ''', webhookSubscription: {format: JSON, callbackUrl: "''' + callback_url + '''"}) {webhookSubscription {id topic} userErrors {field message}}}'''
+    data = client.post(query)
 
-    # Check for errors
     if "errors" in data:
         print(f"ERROR: {data['errors']}")
         raise Exception(f"ERROR: {data['errors']}")
 
-    # Extract the bulk operation id
-    bulk_op_id = None
-    if "bulkOperationRunQuery" in data['data']:
-        errors = data['data']['bulkOperationRunQuery']['userErrors']
-        bulk_operation =  data['data']['bulkOperationRunQuery']['bulkOperation']
-        if not bulk_operation is None: 
-            bulk_op_id = bulk_operation['id']
-            bulk_op_id = str(bulk_op_id).rsplit(sep="/", maxsplit=1)[1]
-            if verbose: print("bulk_op_id:", bulk_op_id)
-    elif "productVariantsBulkUpdate" in data['data']:
-        pass
-        bulk_operation =  data['data']['productVariantsBulkUpdate']
-        errors = data['data']['productVariantsBulkUpdate']['userErrors']
-    else:
-        print("*** Unexpected bulk operation ***")
-        print(json.dumps(data, indent=2))
-        raise Exception("Unexpected bulk operation")
-    if bulk_operation is None: 
-        print("ERRORS:")
-        for error in errors:
-            #print(error)
-            print(str(error['message']))
-            print()        
-        raise Exception("The bulk query is invalid.  ")
-
-    return bulk_op_id
-
-
-def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=False):
+    errors = data['data']['webhookSubscriptionCreate']['userErrors']
+    if len(errors) > 0:
+        print(json.dumps(errors, indent=2))
+        raise Exception(f"webhookSubscriptionCreate failed for {callback_url}")
+
+    subscription_id = data['data']['webhookSubscriptionCreate']['webhookSubscription']['id']
+    if verbose: print(f"Webhook subscription {subscription_id} for {topic} -> {callback_url}")
+
+    return subscription_id
+
+
+def shopify_graphql_webhook_delete(subscription_id:str=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
     """
-    Poll Shopify by the bulk_op_id waiting wait_s between each poll until the bulk results are ready.
-    Returns the actual cost, object count, and the URL.  URL will be None if an error occurs.
+    Delete the webhook subscription subscription_id (the id returned by shopify_graphql_webhook_subscribe()).
 
-    bulk_op_id = '1234567890123'
-    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
-    if url is None: raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
+    shopify_graphql_webhook_delete(subscription_id=subscription_id)
     """
-    # https://shopify.dev/docs/api/usage/bulk-operations/queries#option-b-poll-a-running-bulk-operation
 
-    from time import sleep
-    import json
+    client = shopify_graphql_client(client)
 
-    # pip install requests
-    import requests
+    query = 'mutation {webhookSubscriptionDelete(id: "' + subscription_id + '") {deletedWebhookSubscriptionId userErrors {field message}}}'
+    data = client.post(query)
 
-    if not isinstance(API_TOKEN, str): raise Exception("API_TOKEN is not defined")
-    if not isinstance(GRAPHQL_ENDPOINT, str): raise Exception("GRAPHQL_ENDPOINT is not defined")
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
 
-    # Define the headers for the GraphQL HTTP POST
-    headers = {
-        'Content-Type': 'application/graphql',      # Must be: 'application/graphql'    NOT: 'application/json'
-        'X-Shopify-Access-Token': f'{API_TOKEN}',
-    }
+    if verbose: print(f"Webhook subscription {subscription_id} deleted")
 
-    # Create the query JSON string
-    query = 'query { node(id: "gid://shopify/BulkOperation/' + str(bulk_op_id) + '") {... on BulkOperation {status\nerrorCode\nobjectCount\nurl}}}'
 
-    if verbose: print("Polling GraphQL for bulk query results by bulk operation id " + str(bulk_op_id) + "..")
-    url = None
-    # Query (poll) Shopify until the bulk data is available
-    while url is None:
-        response = requests.post(GRAPHQL_ENDPOINT, data=query, headers=headers)
-        data = response.json()
-        #print(json.dumps(data, indent=2))
+class ShopifyBulkWebhookReceiver:
+    """
+    A small local HTTP server that receives the bulk_operations/finish webhook and wakes up the
+    caller waiting for that bulk operation.  If api_secret (the app's client secret) is passed,
+    the X-Shopify-Hmac-Sha256 header of every webhook is verified.
+
+    with ShopifyBulkWebhookReceiver(port=8080, api_secret="xxx") as receiver:
+        subscription_id = shopify_graphql_webhook_subscribe(callback_url="https://example.com" + receiver.path)
+        bulk_op_id = shopify_graphql_bulk_query(query=bulk_query)
+        cost, obj_count, url = shopify_graphql_bulk_wait_webhook(bulk_op_id=bulk_op_id, receiver=receiver)
+    """
 
-        """
-        BulkOperation
-        {
-        "data": {
-            "node": {
-            "status": "COMPLETED",
-            "errorCode": null,
-            "objectCount": "47",
-            "url": "https://storage.googleapis.com/shopify-tiers-assets-prod-us-east1/bulk-operation-outputs/..jsonl"
-            }
-        },
-        "extensions": {
-            "cost": {
-            "requestedQueryCost": 1,
-            "actualQueryCost": 1,
-            "throttleStatus": {
-                "maximumAvailable": 2000.0,
-                "currentlyAvailable": 1999,
-                "restoreRate": 100.0
-            }
-            }
-        }
-        }
-
-        productVariantsBulkUpdate
-        {
-        "data": {
-            "node": null
-        },
-        "extensions": {
-            "cost": {
-            "requestedQueryCost": 1,
-            "actualQueryCost": 1,
-            "throttleStatus": {
-                "maximumAvailable": 2000.0,
-                "currentlyAvailable": 1999,
-                "restoreRate": 100.0
-            }
-            }
-        }
-        }
+    def __init__(self, host:str="0.0.0.0", port:int=8080, path:str="/webhooks/bulk_operations_finish", api_secret:str=None, verbose:bool=False):
 
-        """
-        
-        error_code = None
-        status = None
-        obj_count = None
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        import threading
+        import json
+        import hmac
+        import hashlib
+        import base64
 
-        if not data['data']['node'] is None and 'status' in data['data']['node']:
-            # Extract the bulk query status
-            # https://shopify.dev/docs/api/admin-graphql/2024-10/enums/bulkoperationstatus
-            # CANCELED, CANCELING, COMPLETED, CREATED, EXPIIRED, FAILED, RUNNING
-            status = data['data']['node']['status']
+        self.path = path
+        self.api_secret = api_secret
+        self.verbose = verbose
+        # bulk operation id -> the webhook payload (dict)
+        self.events = {}
+        self.condition = threading.Condition()
+        receiver = self
 
-            # The errorCode will be Null if no error
-            error_code = data['data']['node']['errorCode']
+        class ShopifyBulkWebhookHandler(BaseHTTPRequestHandler):
 
-            # objectCount is the number of items that will be returned by the bulk query.
-            obj_count = data['data']['node']['objectCount']
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
 
-        cost = data['extensions']['cost']
+                if not self.path.split("?")[0] == receiver.path:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
 
-        if verbose:
-            print(f"status: {status}")
-            if not error_code is None: print(f"error_code: {error_code}")
-            print(f"obj_count: {obj_count}")
+                if not receiver.api_secret is None:
+                    digest = hmac.new(receiver.api_secret.encode("utf-8"), body, hashlib.sha256).digest()
+                    if not hmac.compare_digest(base64.b64encode(digest).decode("utf-8"), self.headers.get('X-Shopify-Hmac-Sha256', '')):
+                        self.send_response(401)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
 
-        # If an error occurs, print out the details.
-        if not error_code is None:
-            print(json.dumps(data, indent=2))
-            print(f"status: {status}")
-            print(f"error_code: {error_code}")
-            print(f"obj_count: {obj_count}")
-            return cost['actualQueryCost'], obj_count, None
+                # Respond right away (Shopify expects a 2xx within 5 s), then hand over the payload.
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
 
-        url = None
-        if not data['data']['node'] is None and 'url' in data['data']['node']:
-            url = data['data']['node']['url']
-            # url will be None until the bulk query is complete
+                """
+                {
+                "admin_graphql_api_id": "gid://shopify/BulkOperation/4142422163590",
+                "completed_at": "2024-11-21T12:00:20-05:00",
+                "created_at": "2024-11-21T12:00:00-05:00",
+                "error_code": null,
+                "status": "completed",
+                "type": "query"
+                }
+                """
+                payload = json.loads(body)
+                receiver.notify(payload)
 
-        if url is None:
-            # Wait to give the server a chance to process the query
-            if not status is None: print(f"status: {status} \t waiting {wait_s} s ..")
-            sleep(wait_s)
+            def log_message(self, *args):
+                pass
 
-        if url is None and status is None: 
-            # productVariantsBulkUpdate
-            #print(json.dumps(data, indent=2))
-            return cost['actualQueryCost'], obj_count, url
+        self.httpd = ThreadingHTTPServer((host, port), ShopifyBulkWebhookHandler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[0], self.httpd.server_address[1]
+        self.thread = None
 
-    if verbose: 
-        print("actualQueryCost:", cost['actualQueryCost'])
-        print("url:", url)
 
-    return cost['actualQueryCost'], obj_count, url
+    def start(self):
+        import threading
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        if self.verbose: print(f"Listening for bulk_operations/finish webhooks on {self.host}:{self.port}{self.path}")
+        return self
 
 
-def shopify_graphql_bulk_dl_to_file(url:str=None, path_file:str=None, verbose:bool=False):
-    """
-    Download the bulk query results from url to the local file path_file.
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
 
-    path_file = shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, verbose=False)
-    """
 
-    def download_from_url_to_file(url):
+    def notify(self, payload:dict=None):
         """
-        Download the file specified by url.
+        Record the bulk_operations/finish payload and wake up the callers waiting on it.
         """
-        import requests
-        get_response = requests.get(url,stream=True)
-        with open(path_file, 'wb') as f:
-            for chunk in get_response.iter_content(chunk_size=1024):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+        bulk_op_id = str(payload['admin_graphql_api_id']).rsplit(sep="/", maxsplit=1)[1]
+        if self.verbose: print(f"bulk_operations/finish webhook for bulk_op_id {bulk_op_id}: {payload['status']}")
+        with self.condition:
+            self.events[bulk_op_id] = payload
+            self.condition.notify_all()
 
 
-    # Download the JSON file specified by a URL to a local file path_file.
+    def wait(self, bulk_op_id:str=None, timeout_s:float=None):
+        """
+        Block until the bulk_operations/finish webhook for bulk_op_id arrives (or has already arrived)
+        and return its payload.  Returns None after timeout_s.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: str(bulk_op_id) in self.events, timeout=timeout_s)
+            return self.events.get(str(bulk_op_id))
 
-    # Delete the file if it already exists
-    if path_file.is_file(): 
-        print(f"Deleting file that already exists {path_file}")
-        path_file.unlink()  
 
-    # Download the JSON file specified by url and write it to path_file
-    # url:  https://storage.googleapis.com/shopify-tiers-assets-prod-us-east1/bulk-operation-outputs/l32j8ouqfxzi7rkq6hmnxzzzj1lj-final?GoogleAccessId=assets-us-prod%40shopify-tiers.iam.gserviceaccount.com&Expires=1732187275&Signature=TStPV3pLAzM3sFYezQLmH91%2F%2FwJwp55MxfJE9uNUY79xWzD9xIm8WKa1FkWnCG6UwlHHFp26EkmAAoBTjQCuRjSHKq9DI2VC5qUlCDkoTCdfHnf7Y5sq%2BRnz93DDgLxeH0NEiV3%2BYHHsklzt1TKuM%2Bh%2Bnp1eD3EPOriox0Q4UF4%2BmlijQUstRv7kvkVwJbEFMIL7S%2B3MuwdkNVCwd2Mivj%2BJE%2Bsz4gFHlPCJUkdbmI8Q8R5%2Fx9Y7KvJfwQ89uAY%2FwhOjAuOmZiiWE9EstBtPjvmj1UwBkJO1nKRmisAFXY%2BjTdL0PsbfzvdBG64Ovah6KOJlbzlKq5YwI0F%2BQcuOKQ%3D%3D&response-content-disposition=attachment%3B+filename%3D%22bulk-4142422163590.jsonl%22%3B+filename%2A%3DUTF-8%27%27bulk-4142422163590.jsonl&response-content-type=application%2Fjson
-    download_from_url_to_file(url)
+def shopify_graphql_bulk_wait_webhook(bulk_op_id:str=None, receiver:ShopifyBulkWebhookReceiver=None, timeout_s:float=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Wait for the bulk_operations/finish webhook for bulk_op_id (instead of polling) and return the
+    actual cost, object count, and the URL like shopify_graphql_bulk_poll().  The webhook doesn't carry
+    the url, so one node(id:) query gets it once the bulk operation has finished.
+    If no webhook arrives within timeout_s, it falls back to polling.
+
+    cost, obj_count, url = shopify_graphql_bulk_wait_webhook(bulk_op_id=bulk_op_id, receiver=receiver, timeout_s=3600)
+    """
 
-    if not path_file.is_file(): raise Exception("Download from '" + url + "' to file '" + str(path_file) + "' FAILED")
+    client = shopify_graphql_client(client)
 
-    if verbose: print("Downloaded JSON file location:", path_file)
+    if verbose: print(f"Waiting for the bulk_operations/finish webhook for bulk_op_id {bulk_op_id} ..")
+    payload = receiver.wait(bulk_op_id=bulk_op_id, timeout_s=timeout_s)
+    if payload is None:
+        print(f"No bulk_operations/finish webhook for bulk_op_id {bulk_op_id} after {timeout_s} s.  Polling ..")
+    elif verbose:
+        print(f"status: {payload['status']} \t error_code: {payload['error_code']}")
 
-    return path_file
+    # Finished (or no webhook):  the first poll returns the url unless the bulk operation is still running.
+    return shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=verbose, client=client)
 
 
 # Download the bulk query results (json lines) from the URL to memory (not file)
-def shopify_graphql_bulk_dl_to_ram(url:str=None, verbose:bool=False):
+def shopify_graphql_bulk_dl_to_ram(url:str=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
     """
     Download the bulk query results from url to memory (ram).
 
     This is a template to be used to create a custom function.
+    The lines are streamed by shopify_graphql_bulk_iter() (one line at a time, not the whole file).
 
     """
-    
-    import requests
-
-    #pip install jsonlines
-    import jsonlines
 
-    response = requests.get(url,stream=True)
-    response.raise_for_status()
-    if not response.status_code == 200:
-        raise Exception(f"ERROR: {response.status_code}")
-
-    # Process response content with jsonlines
-    with jsonlines.Reader(response.iter_lines()) as reader:
-        for chunk in reader.iter():
-            if chunk: # filter out keep-alive new chunks
-                #print(type(chunk))  # <class 'dict'>
-                print(chunk)
+    client = shopify_graphql_client(client)
+    
+    # Process the response content one line at a time
+    for chunk in shopify_graphql_bulk_iter(url=url, verbose=verbose, client=client):
+        #print(type(chunk))  # <class 'dict'>
+        print(chunk)
 
     """
     {'id': 'gid://shopify/Product/1629753868406'}
@@ -335,17 +285,71 @@ if __name__ == '__main__':
     # then download them to a variable (memory).
 
     """
+    from shopify_graphql_bulk_query_update_product_variants import shopify_graphql_bulk_query
+
+    # One pooled client (keep-alive session) for this script's store, shared by every call.
+    # Or ShopifyGraphQLClient(store_name=STORE_NAME, api_token=API_TOKEN, graphql_ver=GRAPHQL_VER)
+    client = shopify_graphql_client()
+
     query = "{products {edges {node {id variants {edges {node {id title sku}}}}}}}"  
     bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
-    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False)
+    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False, client=client)
 
     # Poll Shopify via GraphQL until the bulk query is complete.  Return the URL for download. 
-    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
     print(f"Bulk query actual cost was {cost} for {obj_count} items.")
     if not url is None: print(f"Bulk query results download url: {url}")
 
     # Download the bulk query results to a local variable (memory). 
-    shopify_graphql_bulk_dl_to_ram(url=url)
+    shopify_graphql_bulk_dl_to_ram(url=url, client=client)
+
+    # Where the time went (submit, polls, download, parse) and the cost of each phase.
+    print(client.metrics.report())
+    """
+
+
+    # ---------------------------------------------------------------------------
+    # After a restart, reattach to the bulk query that is still running (or reuse the result url
+    # of the one that just completed) instead of starting the export again.  A bulk query of
+    # another query that is still running raises an exception, unless cancel=True (and it is
+    # older than stale_s), then it is canceled (bulkOperationCancel).
+
+    """
+    from shopify_graphql_bulk_query_update_product_variants import shopify_graphql_bulk_query_reattach, shopify_graphql_bulk_current, shopify_graphql_bulk_cancel
+
+    client = shopify_graphql_client()
+
+    query = "{products {edges {node {id variants {edges {node {id title sku}}}}}}}"  
+    bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
+    bulk_op_id, created_at = shopify_graphql_bulk_query_reattach(query=bulk_query, max_age_s=3600, verbose=True, client=client)
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
+
+    # Or cancel the shop's current bulk query
+    #bulk_operation = shopify_graphql_bulk_current(op_type="QUERY", verbose=True, client=client)
+    #if not bulk_operation is None: shopify_graphql_bulk_cancel(bulk_op_id=bulk_operation['bulk_op_id'], client=client)
+    """
+
+
+    # ---------------------------------------------------------------------------
+    # Execute a bulk query and wait for the bulk_operations/finish webhook instead of polling.
+    # The callback url must be a public https url that reaches the receiver's port.
+
+    """
+    from shopify_graphql_bulk_query_update_product_variants import shopify_graphql_bulk_query
+
+    client = shopify_graphql_client()
+
+    with ShopifyBulkWebhookReceiver(port=8080, api_secret="your-app-client-secret", verbose=True) as receiver:
+        subscription_id = shopify_graphql_webhook_subscribe(callback_url="https://your-host.example.com" + receiver.path, client=client)
+
+        query = "{products {edges {node {id variants {edges {node {id title sku}}}}}}}"  
+        bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
+        bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False, client=client)
+
+        cost, obj_count, url = shopify_graphql_bulk_wait_webhook(bulk_op_id=bulk_op_id, receiver=receiver, timeout_s=3600, client=client)
+        print(f"Bulk query actual cost was {cost} for {obj_count} items.")
+
+        shopify_graphql_webhook_delete(subscription_id=subscription_id, client=client)
     """
 
 
@@ -359,19 +363,23 @@ if __name__ == '__main__':
     #pip install jsonlines
     import jsonlines
 
+    from shopify_graphql_bulk_query_update_product_variants import shopify_graphql_bulk_query, shopify_graphql_bulk_dl_to_file
+
+    client = shopify_graphql_client()
+
     # Build a bulk query to get all products and their nested variants:
     query = "{products {edges {node {id variants {edges {node {id title sku price}}}}}}}"  
     bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
-    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False)
+    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False, client=client)
     print(f"bulk_op_id: {bulk_op_id}")
 
     # Poll Shopify via GraphQL until the bulk query is complete.  Return the URL for download. 
-    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
     if not url is None: 
         print(url)
 
     path_file = Path(Path.cwd()).joinpath("bulk_dl.jsonl")
-    path_file = shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, verbose=False)
+    path_file = shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, verbose=False, client=client)
     if not path_file.is_file(): raise Exception(f"File not found {path_file}")
 
     # Use jsonlines to import the data because it executes without errors, unlike using csv reader. 
@@ -380,4 +388,19 @@ if __name__ == '__main__':
             print(line)
             break
     """
+
+
+    # ---------------------------------------------------------------------------
+    # Parse a large downloaded bulk query results file with all of the CPU cores.
+    # The file is split at the products (their variants stay with them) and parsed in a process pool.
+
+    """
+    from shopify_graphql_bulk_query_update_product_variants import shopify_graphql_bulk_parse_file
+
+    path_file = Path(Path.cwd()).joinpath("bulk_dl.jsonl")
+    products = shopify_graphql_bulk_parse_file(path_file=path_file, child_keys={"ProductVariant": "variants"}, verbose=True)
+
+    # Or per chunk columnar batches (pyarrow)
+    #batches = shopify_graphql_bulk_parse_file(path_file=path_file, columns=("id", "sku", "price", "__parentId"), verbose=True)
+    """
     # ---------------------------------------------------------------------------
\ No newline at end of file
@@ -28,32 +28,587 @@ GRAPHQL_ENDPOINT = "https://" + STORE_NAME + ".myshopify.com/admin/api/" + GRAPH
 
 # ---------------------------------------------------------------------------
 
-def shopify_graphql_bulk_query(query:str=None, verbose:bool=False):
+class ShopifyThrottleBucket:
+    """
+    A local estimate of the Shopify GraphQL leaky bucket (rate limit) for one store.
+    It is updated from the extensions.cost.throttleStatus returned with every response
+    (currentlyAvailable, restoreRate, maximumAvailable) and refills at restoreRate between
+    responses.  acquire() blocks until the requested cost fits in the bucket and reserves
+    it until release() is called, so concurrent requests stay just under the limit.
+    If reserve is set, acquire() leaves that much cost in the bucket for the other
+    apps and integrations sharing the store's rate limit.
+
+    throttle = ShopifyThrottleBucket()
+    reserved = throttle.acquire(cost=50)
+    data = client.post(query)       # client.post() calls throttle.update(data['extensions']['cost'])
+    throttle.release(reserved)
     """
-    Execute the bulk query specified by query and return the bulk operation id
-    Requires global variables:  API_TOKEN and GRAPHQL_ENDPOINT 
 
-    bulk_op_id = shopify_graphql_bulk_query(query=query)
+    # https://shopify.dev/docs/api/usage/rate-limits#graphql-admin-api-rate-limits
+
+    def __init__(self, maximum_available:float=1000.0, restore_rate:float=50.0):
+        import threading
+        import time
+
+        # The defaults are for a standard plan.  They are replaced by the first throttleStatus received.
+        self.maximum_available = float(maximum_available)
+        self.currently_available = float(maximum_available)
+        self.restore_rate = float(restore_rate)
+        self.t_update = time.monotonic()
+        # False until the first throttleStatus is received
+        self.updated = False
+        # Cost reserved by requests that have been sent but not yet answered
+        self.in_flight = 0.0
+        # The last requestedQueryCost received (an estimate for the next similar request)
+        self.requested_cost = None
+        # Cost that acquire() never takes from the bucket (left for other integrations)
+        self.reserve = 0.0
+        self.condition = threading.Condition()
+
+
+    def update(self, cost:dict=None):
+        """
+        Update the bucket from the extensions.cost of a GraphQL response.
+        """
+        import time
+        if cost is None or not 'throttleStatus' in cost: return
+        throttle_status = cost['throttleStatus']
+        with self.condition:
+            t = time.monotonic()
+            currently_available = float(throttle_status['currentlyAvailable'])
+            if self.updated:
+                # Concurrent responses can arrive out of order.  An older (higher) currentlyAvailable would
+                # undo the cost of the requests answered since, so keep the lower of it and the refilled estimate.
+                refilled = min(self.maximum_available, self.currently_available + self.restore_rate * (t - self.t_update))
+                currently_available = min(currently_available, refilled)
+            self.maximum_available = float(throttle_status['maximumAvailable'])
+            self.currently_available = currently_available
+            self.restore_rate = float(throttle_status['restoreRate'])
+            self.t_update = t
+            self.updated = True
+            if 'requestedQueryCost' in cost and not cost['requestedQueryCost'] is None: self.requested_cost = float(cost['requestedQueryCost'])
+            self.condition.notify_all()
+
+
+    def available(self):
+        """
+        Returns the estimated cost available now (refilled since the last update, less the cost in flight).
+        """
+        import time
+        with self.condition:
+            refilled = self.currently_available + self.restore_rate * (time.monotonic() - self.t_update)
+            return min(self.maximum_available, refilled) - self.in_flight
+
+
+    def status(self):
+        """
+        Returns the estimated throttleStatus now (like extensions.cost.throttleStatus).
+        """
+        return {"maximumAvailable": self.maximum_available, "currentlyAvailable": self.available(), "restoreRate": self.restore_rate}
+
+
+    def acquire(self, cost:float=None, timeout_s:float=None):
+        """
+        Block until cost is available in the bucket, reserve it, and return the cost reserved.
+        If cost is None, the last requestedQueryCost received is used.
+        """
+        import time
+        t_deadline = None if timeout_s is None else time.monotonic() + timeout_s
+        with self.condition:
+            if cost is None: cost = self.requested_cost if not self.requested_cost is None else 1.0
+            # A request can never cost more than the bucket holds
+            cost = min(float(cost), self.maximum_available - self.reserve)
+            while True:
+                available = self.available() - self.reserve
+                if available >= cost: break
+                wait_s = (cost - available) / self.restore_rate
+                if not t_deadline is None:
+                    if time.monotonic() + wait_s > t_deadline: raise Exception(f"Throttle: cost {cost} not available within {timeout_s} s")
+                # Wake up early if a response (update) or a release arrives
+                self.condition.wait(wait_s)
+            self.in_flight += cost
+            return cost
+
+
+    def release(self, cost:float=None):
+        """
+        Release the cost reserved by acquire() once the response has been received.
+        """
+        with self.condition:
+            self.in_flight = max(0.0, self.in_flight - cost)
+            self.condition.notify_all()
+
+
+class ShopifyMetrics:
+    """
+    Timing and cost instrumentation for the phases of a bulk query / update run:  the bulk query submit,
+    each poll (and the wait between polls), the download (time to first byte, bytes), the parse of the
+    JSON lines (objects, parse time only) and each mutation.  Every phase is recorded as a structured
+    event {"phase", "t", "latency_s", "bytes", "objects", "cost", ..} that is appended to events
+    (the last max_events), written to the JSONL file path_file and passed to callback(event), and is
+    aggregated into per phase counters and latency histograms (prometheus(), report()).
+    If otel, each span() is also an OpenTelemetry span (nested spans in the same thread form a span tree).
+    Every ShopifyGraphQLClient has one (client.metrics).  client.close() closes the file (the next event
+    opens it again, so a ShopifyMetrics can be shared by several clients).
+
+    metrics = ShopifyMetrics(path_file=Path.cwd().joinpath("metrics.jsonl"))
+    client = ShopifyGraphQLClient(store_name="your-store-name", api_token="shpat_xxx", metrics=metrics)
+    with metrics.span("reprice") as event:
+        event['objects'] = 3
+    print(metrics.report())
+    print(metrics.prometheus())
     """
-    # https://shopify.dev/docs/api/admin-graphql/2024-10/objects/BulkOperation
 
-    import json
+    # The upper bounds (s) of the latency histogram buckets
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
 
-    # pip install requests
-    import requests
+    def __init__(self, path_file:Path=None, callback=None, max_events:int=100000, otel:bool=False):
+        import threading
+        from collections import deque
+
+        self.events = deque(maxlen=max_events)
+        # phase -> {"count", "latency_s", "bytes", "objects", "cost", "errors", "buckets"}
+        self.phases = {}
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.path_file = path_file
+        self.file = None if path_file is None else open(path_file, 'a', buffering=1)
+        self.tracer = None
+        if otel:
+            # pip install opentelemetry-api opentelemetry-sdk
+            from opentelemetry import trace
+            self.tracer = trace.get_tracer("shopify_graphql")
+
+
+    def record(self, phase:str=None, latency_s:float=0.0, **values):
+        """
+        Record one event of phase that took latency_s.  values are the bytes, objects, cost and any other attributes.
+        Returns the event.
+        """
+        import time
+        event = {"phase": phase, "t": time.time(), "latency_s": latency_s, "bytes": 0, "objects": 0, "cost": 0.0}
+        event.update(values)
+        self._record(event)
+        return event
+
+
+    def _record(self, event:dict=None):
+        import json
+        from bisect import bisect_left
+
+        with self.lock:
+            phase = self.phases.get(event['phase'])
+            if phase is None:
+                phase = {"count": 0, "latency_s": 0.0, "bytes": 0, "objects": 0, "cost": 0.0, "errors": 0, "buckets": [0] * (len(self.LATENCY_BUCKETS) + 1)}
+                self.phases[event['phase']] = phase
+            phase['count'] += 1
+            phase['latency_s'] += event['latency_s']
+            phase['bytes'] += event['bytes'] or 0
+            phase['objects'] += event['objects'] or 0
+            phase['cost'] += event['cost'] or 0.0
+            if 'error' in event: phase['errors'] += 1
+            phase['buckets'][bisect_left(self.LATENCY_BUCKETS, event['latency_s'])] += 1
+            self.events.append(event)
+            if self.file is None and not self.path_file is None: self.file = open(self.path_file, 'a', buffering=1)
+            if not self.file is None:
+                self.file.write(json.dumps(event, default=str) + "\n")
+        if not self.callback is None: self.callback(event)
+
+
+    def span(self, phase:str=None, **attributes):
+        """
+        Returns a context manager that times phase and records it as an event on exit.  The event (dict)
+        it returns can be updated inside the with block (ex. event['bytes'] += len(chunk)).
+
+        with client.metrics.span("bulk_query_submit") as event:
+            data = client.post(query)
+            event['cost'] = data['extensions']['cost']['actualQueryCost']
+        """
+        from contextlib import contextmanager
+
+        @contextmanager
+        def timed_span():
+            import time
+            event = {"phase": phase, "t": time.time(), "latency_s": 0.0, "bytes": 0, "objects": 0, "cost": 0.0}
+            event.update(attributes)
+            otel_span = None if self.tracer is None else self.tracer.start_as_current_span(phase)
+            otel_context = None if otel_span is None else otel_span.__enter__()
+            t_start_sec = time.perf_counter()
+            try:
+                yield event
+            except BaseException as e:
+                event['error'] = str(e)
+                raise
+            finally:
+                event['latency_s'] = time.perf_counter() - t_start_sec
+                self._record(event)
+                if not otel_span is None:
+                    for key, value in event.items():
+                        if isinstance(value, (str, bool, int, float)): otel_context.set_attribute(key, value)
+                    otel_span.__exit__(None, None, None)
+
+        return timed_span()
+
+
+    def report(self):
+        """
+        Returns a table of the totals and rates for each phase (as text).
+        """
+        lines = [f"{'phase':<22} {'count':>8} {'total s':>10} {'mean s':>9} {'MB':>10} {'MB/s':>8} {'objects':>10} {'objects/s':>10} {'cost':>10}"]
+        with self.lock:
+            for name, phase in self.phases.items():
+                latency_s = phase['latency_s']
+                mb = phase['bytes'] / 1e6
+                lines.append(f"{name:<22} {phase['count']:>8} {latency_s:>10.3f} {latency_s / phase['count']:>9.4f} {mb:>10.2f} {mb / latency_s if latency_s > 0 else 0.0:>8.1f} {phase['objects']:>10} {phase['objects'] / latency_s if latency_s > 0 else 0.0:>10.0f} {phase['cost']:>10.0f}")
+        return "\n".join(lines)
+
+
+    def prometheus(self, prefix:str="shopify_graphql"):
+        """
+        Returns the counters and the latency histogram of each phase in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for metric, key, help_text in (("requests_total", "count", "Events recorded"), ("errors_total", "errors", "Events that raised an exception"), ("bytes_total", "bytes", "Bytes transferred"), ("objects_total", "objects", "Objects (lines, variants) processed"), ("cost_total", "cost", "GraphQL actualQueryCost")):
+                lines.append(f"# HELP {prefix}_{metric} {help_text}")
+                lines.append(f"# TYPE {prefix}_{metric} counter")
+                for name, phase in self.phases.items():
+                    lines.append(f'{prefix}_{metric}{{phase="{name}"}} {phase[key]}')
+            lines.append(f"# HELP {prefix}_latency_seconds Latency of each event")
+            lines.append(f"# TYPE {prefix}_latency_seconds histogram")
+            for name, phase in self.phases.items():
+                count = 0
+                for le, n in zip(self.LATENCY_BUCKETS + ("+Inf",), phase['buckets']):
+                    count += n
+                    lines.append(f'{prefix}_latency_seconds_bucket{{phase="{name}",le="{le}"}} {count}')
+                lines.append(f'{prefix}_latency_seconds_sum{{phase="{name}"}} {phase["latency_s"]}')
+                lines.append(f'{prefix}_latency_seconds_count{{phase="{name}"}} {phase["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+    def close(self):
+        """
+        Flush and close the JSONL file (it is opened again by the next event).
+        """
+        with self.lock:
+            if not self.file is None:
+                self.file.close()
+                self.file = None
+
+
+class ShopifyRetryPolicy:
+    """
+    The retry policy of a ShopifyGraphQLClient (client.retry), shared by all of its requests and threads.
+    A THROTTLED request waits in client.throttle until the bucket has refilled its requested cost (like
+    every other request) and is retried (up to throttle_retries times).  A transient error (a connection
+    error or timeout, HTTP 429 / 5xx, an INTERNAL_SERVER_ERROR) is retried up to retries times with an
+    exponential backoff with full jitter (honoring Retry-After).  A request that isn't idempotent (ex. a
+    bulkOperationRunQuery) is only retried if it surely didn't reach the store (a connect timeout, HTTP 429).
+    After failure_threshold transient errors in a row the circuit breaker opens:  every request waits
+    reset_s before the next attempt (or fails right away if fail_fast), so a store that is down isn't
+    hammered by every worker.  The first success closes it.
+
+    client = ShopifyGraphQLClient(store_name="your-store-name", api_token="shpat_xxx", retry=ShopifyRetryPolicy(retries=10))
+    """
+
+    # The HTTP status codes that are retried
+    RETRY_STATUS = (429, 500, 502, 503, 504, 520, 521, 522, 523, 524, 530)
+
+    def __init__(self, retries:int=8, throttle_retries:int=50, backoff_min_s:float=0.5, backoff_max_s:float=60.0, failure_threshold:int=5, reset_s:float=30.0, fail_fast:bool=False):
+        import threading
+
+        self.retries = retries
+        self.throttle_retries = throttle_retries
+        self.backoff_min_s = backoff_min_s
+        self.backoff_max_s = backoff_max_s
+        self.failure_threshold = failure_threshold
+        self.reset_s = reset_s
+        self.fail_fast = fail_fast
+        self.lock = threading.Lock()
+        # The circuit breaker
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+
+    def backoff_s(self, attempt:int=None, retry_after:str=None):
+        """
+        Returns the wait (s) before retry attempt (1 ..) of a transient error.
+        """
+        import random
+        if not retry_after is None:
+            try:
+                return min(self.backoff_max_s, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(self.backoff_min_s, min(self.backoff_max_s, self.backoff_min_s * 2.0 ** attempt))
+
+
+    def before_request(self):
+        """
+        Wait while the circuit breaker is open (or raise an exception if fail_fast).
+        """
+        import time
+        with self.lock:
+            wait_s = self.open_until - time.monotonic()
+        if wait_s > 0.0:
+            if self.fail_fast: raise Exception(f"Circuit breaker open for {wait_s:.1f} s after {self.consecutive_failures} errors in a row")
+            time.sleep(wait_s)
+
+
+    def success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+
+    def failure(self):
+        """
+        Count a transient error.  Returns True if the circuit breaker opened.
+        """
+        import time
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failure_threshold and time.monotonic() >= self.open_until:
+                self.open_until = time.monotonic() + self.reset_s
+                self.trips += 1
+                return True
+        return False
+
+
+class ShopifyGraphQLClient:
+    """
+    A reusable Shopify Admin GraphQL client for one store.
+    All of the requests made with the client share one requests.Session (HTTP keep-alive
+    and a connection pool), so the TCP + TLS handshake and the headers are set up once
+    instead of for every POST.  client.throttle tracks the store's rate limit bucket and
+    client.metrics (ShopifyMetrics) records the timing and cost of each phase.
+    post() retries THROTTLED, 5xx and network errors by client.retry (ShopifyRetryPolicy).
+
+    client = ShopifyGraphQLClient(store_name="your-store-name", api_token="shpat_xxx", graphql_ver="2024-10")
+    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, client=client)
+    client.close()
+    """
+
+    def __init__(self, store_name:str=None, api_token:str=None, graphql_ver:str=None, graphql_endpoint:str=None, timeout_s:tuple=(10.0, 60.0), pool_maxsize:int=10, metrics:ShopifyMetrics=None, retry:ShopifyRetryPolicy=None):
+
+        # pip install requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if not isinstance(api_token, str): raise Exception("api_token is not defined")
+        if graphql_ver is None: graphql_ver = GRAPHQL_VER
+        if graphql_endpoint is None:
+            if not isinstance(store_name, str): raise Exception("store_name or graphql_endpoint must be defined")
+            graphql_endpoint = "https://" + store_name + ".myshopify.com/admin/api/" + graphql_ver + "/graphql.json"
+
+        self.store_name = store_name
+        self.api_token = api_token
+        self.graphql_ver = graphql_ver
+        self.graphql_endpoint = graphql_endpoint
+        # (connect, read) timeouts in seconds
+        self.timeout_s = timeout_s
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # This goes in the header of every GraphQL POST
+        self.session.headers.update({'X-Shopify-Access-Token': f'{api_token}'})
+
+        # The rate limit (leaky bucket) of the store, updated from every response
+        self.throttle = ShopifyThrottleBucket()
+        # The timing and cost of each phase (bulk query, poll, download, parse, mutation)
+        self.metrics = ShopifyMetrics() if metrics is None else metrics
+        # Retries of THROTTLED, 5xx and network errors, and the circuit breaker
+        self.retry = ShopifyRetryPolicy() if retry is None else retry
+
+
+    def post(self, query:str=None, variables:dict=None, cost:float=None, idempotent:bool=True):
+        """
+        POST the GraphQL query (or mutation) to the store endpoint and return the response JSON as a dict.
+        If variables is passed, the query and its variables are sent as JSON.
+        If cost (the estimated requestedQueryCost) is passed, it is reserved in client.throttle for each
+        attempt (acquire() blocks until the bucket has it) and released when the response arrives.
+        A THROTTLED request re-acquires its requestedQueryCost through client.throttle before it is retried,
+        so it waits its turn with the other requests instead of starving.  HTTP 429 / 5xx and network errors
+        are retried (client.retry).  An exception is raised when the retries are exhausted, or right away for
+        another HTTP error without a JSON body (ex. 401, 404).  Other errors are returned (ex. {"errors": ..}).
+        If not idempotent (ex. a bulkOperationRunQuery, which must not be started twice), an error after which
+        the request may have been executed (a read timeout, a dropped connection, a 5xx) isn't retried:  an
+        exception is raised so that the caller can check what the store did (ex. currentBulkOperation).
+
+        data = client.post(query)
+        data = client.post("mutation call($id: ID!) {..}", variables={"id": "gid://shopify/Product/1629753868406"}, cost=11)
+        """
+        import time
+
+        # pip install requests
+        import requests
+
+        attempt = 0
+        throttled = 0
+        while True:
+            self.retry.before_request()
+            error = None
+            # False only if the store surely didn't execute the request
+            maybe_executed = True
+            response_cost = None
+            t_acquire_sec = time.perf_counter()
+            reserved = None if cost is None else self.throttle.acquire(cost)
+            if throttled > 0: self.metrics.record("throttled", time.perf_counter() - t_acquire_sec, requested_cost=cost)
+            try:
+                if variables is None:
+                    headers = {'Content-Type': 'application/graphql'}      # Must be: 'application/graphql'    NOT: 'application/json'
+                    response = self.session.post(self.graphql_endpoint, data=query, headers=headers, timeout=self.timeout_s)
+                else:
+                    response = self.session.post(self.graphql_endpoint, json={"query": query, "variables": variables}, timeout=self.timeout_s)
+                if response.status_code in self.retry.RETRY_STATUS:
+                    error = f"HTTP {response.status_code}"
+                    # A 429 is refused before it runs.  A 5xx (ex. a gateway timeout) may come after it ran.
+                    maybe_executed = not response.status_code == 429
+                else:
+                    data = response.json()
+                    # Update the bucket before the reservation is released
+                    response_cost = data.get('extensions', {}).get('cost') if isinstance(data, dict) else None
+                    if not response_cost is None: self.throttle.update(response_cost)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = type(e).__name__
+                # Only a request that never connected surely didn't reach the store.
+                maybe_executed = not isinstance(e, requests.exceptions.ConnectTimeout)
+                response = None
+            except ValueError:
+                # Not JSON (ex. an HTML error page from a proxy).  Only 429 and 5xx are transient.
+                if not (response.status_code == 429 or response.status_code >= 500):
+                    raise Exception(f"ERROR: HTTP {response.status_code} from {self.graphql_endpoint}:  {response.text[:200]}")
+                error = f"HTTP {response.status_code} invalid JSON"
+                maybe_executed = not response.status_code == 429
+            finally:
+                if not reserved is None: self.throttle.release(reserved)
+
+            if error is None:
+                codes = [e.get('extensions', {}).get('code') for e in data['errors'] if isinstance(e, dict)] if isinstance(data, dict) and isinstance(data.get('errors'), list) else []
+                if "THROTTLED" in codes:
+                    # Not a failure:  wait in the bucket (refilled from this response's throttleStatus) for the requested cost.
+                    throttled += 1
+                    if throttled > self.retry.throttle_retries: raise Exception(f"THROTTLED {throttled} times:  {data['errors']}")
+                    requested = None if response_cost is None else response_cost.get('requestedQueryCost')
+                    cost = max(float(cost or 0.0), float(requested or 1.0))
+                    continue
+                if "INTERNAL_SERVER_ERROR" in codes:
+                    error = "INTERNAL_SERVER_ERROR"
+                else:
+                    self.retry.success()
+                    return data
+
+            # A transient error
+            attempt += 1
+            if self.retry.failure(): print(f"Circuit breaker open for {self.retry.reset_s} s after {self.retry.consecutive_failures} errors in a row ({error})")
+            if not idempotent and maybe_executed: raise Exception(f"GraphQL request to {self.graphql_endpoint} FAILED and was not retried (it may have been executed):  {error}")
+            if attempt > self.retry.retries: raise Exception(f"GraphQL request to {self.graphql_endpoint} FAILED after {self.retry.retries} retries:  {error}")
+            wait_s = self.retry.backoff_s(attempt, None if response is None else response.headers.get('Retry-After'))
+            self.metrics.record("retry", wait_s, error=error, attempt=attempt)
+            print(f"{error}.  Retry {attempt} of {self.retry.retries} in {wait_s:.1f} s ..")
+            time.sleep(wait_s)
+
+
+    def get(self, url:str=None, stream:bool=True, headers:dict=None):
+        """
+        GET the url (ex. a bulk query result file) over the pooled session and return the response.
+        The Shopify access token is NOT sent to the (non Shopify) storage host.
+
+        response = client.get(url)
+        """
+        get_headers = {'X-Shopify-Access-Token': None}      # None removes the session header from this request
+        if not headers is None: get_headers.update(headers)
+        return self.session.get(url, stream=stream, headers=get_headers, timeout=self.timeout_s)
+
+
+    def close(self):
+        self.session.close()
+        # Flush the last metrics events to their file and close it
+        self.metrics.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_default_client = None
+
+def shopify_graphql_client(client:ShopifyGraphQLClient=None):
+    """
+    Returns client, or if client is None, a pooled client built from the global variables
+    API_TOKEN and GRAPHQL_ENDPOINT.  The fallback client is re-used until those globals change.
+
+    client = shopify_graphql_client(client)
+    """
+    global _default_client
+
+    if not client is None: return client
 
     if not isinstance(API_TOKEN, str): raise Exception("API_TOKEN is not defined")
     if not isinstance(GRAPHQL_ENDPOINT, str): raise Exception("GRAPHQL_ENDPOINT is not defined")
 
-    # Define the headers for the GraphQL HTTP POST
-    headers = {
-        'Content-Type': 'application/graphql',      # Must be: 'application/graphql'    NOT: 'application/json'
-        'X-Shopify-Access-Token': f'{API_TOKEN}',
-    }
+    if _default_client is None or not _default_client.api_token == API_TOKEN or not _default_client.graphql_endpoint == GRAPHQL_ENDPOINT:
+        if not _default_client is None: _default_client.close()
+        _default_client = ShopifyGraphQLClient(store_name=STORE_NAME, api_token=API_TOKEN, graphql_ver=GRAPHQL_VER, graphql_endpoint=GRAPHQL_ENDPOINT)
 
+    return _default_client
 
-    response = requests.post(GRAPHQL_ENDPOINT, data=query, headers=headers)
-    data = response.json()
+
+# ---------------------------------------------------------------------------
+
+def shopify_graphql_bulk_query(query:str=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Execute the bulk query (bulkOperationRunQuery or bulkOperationRunMutation) specified by query and return the bulk operation id
+    Uses client, or the global variables API_TOKEN and GRAPHQL_ENDPOINT if client is None.
+    Starting a bulk operation isn't idempotent, so it isn't retried blindly:  after an error that may have come
+    after the store created it (ex. a read timeout), the shop's current bulk operation (shopify_graphql_bulk_current())
+    is checked, and if it is this query started since the request was sent, its id is returned.  Otherwise no
+    bulk operation was created and the request is sent again (up to client.retry.retries times).
+
+    bulk_op_id = shopify_graphql_bulk_query(query=query)
+    """
+    # https://shopify.dev/docs/api/admin-graphql/2024-10/objects/BulkOperation
+
+    import json
+    import re
+    import time
+    from datetime import datetime, timedelta, timezone
+
+    client = shopify_graphql_client(client)
+
+    # The query (or the mutation) of a bulk operation, as it is in BulkOperation.query
+    match = re.search(r'bulkOperationRun(Query|Mutation)\((?:query|mutation): """(.*?)"""', query, flags=re.DOTALL)
+
+    with client.metrics.span("bulk_query_submit") as event:
+        if match is None:
+            data = client.post(query)
+        else:
+            op_type = match.group(1).upper()
+            # The store's clock can differ from this one
+            t_sent = datetime.now(timezone.utc) - timedelta(seconds=60)
+            attempt = 0
+            while True:
+                try:
+                    data = client.post(query, idempotent=False)
+                    break
+                except Exception as e:
+                    # Did the request that failed create the bulk operation?
+                    current = shopify_graphql_bulk_current(op_type=op_type, client=client)
+                    if not current is None and not current['query'] is None and " ".join(current['query'].split()) == " ".join(match.group(2).split()) and datetime.fromisoformat(current['createdAt'].replace("Z", "+00:00")) >= t_sent:
+                        print(f"{e}.  The bulk operation {current['bulk_op_id']} ({current['status']}) was created by it")
+                        return current['bulk_op_id']
+                    attempt += 1
+                    if attempt > client.retry.retries: raise
+                    wait_s = client.retry.backoff_s(attempt)
+                    print(f"{e}.  No bulk operation was created.  Retry {attempt} of {client.retry.retries} in {wait_s:.1f} s ..")
+                    time.sleep(wait_s)
+        event['cost'] = data.get('extensions', {}).get('cost', {}).get('actualQueryCost', 0) if isinstance(data, dict) else 0
 
     #print(json.dumps(data, indent=2))
     """
@@ -89,14 +644,16 @@ def shopify_graphql_bulk_query(query:str=None, verbose:bool=False):
     # Check for errors
     if "errors" in data:
         print(f"ERROR: {data['errors']}")
-        print(f"Check your STORE_NAME setting.  {STORE_NAME}")
+        print(f"Check your STORE_NAME setting.  {client.graphql_endpoint}")
         raise Exception(f"ERROR: {data['errors']}")
 
     # Extract the bulk operation id
     bulk_op_id = None
-    if "bulkOperationRunQuery" in data['data']:
-        errors = data['data']['bulkOperationRunQuery']['userErrors']
-        bulk_operation =  data['data']['bulkOperationRunQuery']['bulkOperation']
+    bulk_operation_run = "bulkOperationRunMutation" if "bulkOperationRunMutation" in data['data'] else "bulkOperationRunQuery"
+    if bulk_operation_run in data['data']:
+        # bulkOperationRunQuery or bulkOperationRunMutation
+        errors = data['data'][bulk_operation_run]['userErrors']
+        bulk_operation =  data['data'][bulk_operation_run]['bulkOperation']
         if not bulk_operation is None: 
             bulk_op_id = bulk_operation['id']
             bulk_op_id = str(bulk_op_id).rsplit(sep="/", maxsplit=1)[1]
@@ -120,41 +677,190 @@ def shopify_graphql_bulk_query(query:str=None, verbose:bool=False):
     return bulk_op_id
 
 
-def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=False):
+def shopify_graphql_bulk_current(op_type:str="QUERY", verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Returns the shop's current (latest) bulk operation of op_type ("QUERY" or "MUTATION") as a dict with its
+    bulk_op_id, id, status, errorCode, objectCount, url, query, createdAt and completedAt, or None if there is none.
+    Only one bulk operation of each type can run at a time, so this is the one a new bulk operation collides with.
+
+    bulk_operation = shopify_graphql_bulk_current(op_type="QUERY")
+    if not bulk_operation is None: print(bulk_operation['bulk_op_id'], bulk_operation['status'])
+    """
+    # https://shopify.dev/docs/api/admin-graphql/2024-10/queries/currentBulkOperation
+
+    client = shopify_graphql_client(client)
+
+    query = 'query { currentBulkOperation(type: ' + op_type + ') {id status errorCode objectCount url query createdAt completedAt}}'
+    data = client.post(query)
+
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
+
+    bulk_operation = data['data']['currentBulkOperation']
+    if bulk_operation is None:
+        if verbose: print(f"No current bulk operation of type {op_type}")
+        return None
+
+    bulk_operation['bulk_op_id'] = str(bulk_operation['id']).rsplit(sep="/", maxsplit=1)[1]
+    if verbose: print(f"Current bulk operation {bulk_operation['bulk_op_id']}  status: {bulk_operation['status']}  created: {bulk_operation['createdAt']}  objectCount: {bulk_operation['objectCount']}")
+
+    return bulk_operation
+
+
+def shopify_graphql_bulk_cancel(bulk_op_id:str=None, wait:bool=True, timeout_s:float=60.0, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Cancel the bulk operation bulk_op_id (bulkOperationCancel) and return its status.  If wait, wait (up to timeout_s)
+    until it is no longer CANCELING, so that a new bulk operation of the same type can be started.
+    A bulk operation that already finished can't be canceled, and its status (ex. COMPLETED) is returned.
+
+    status = shopify_graphql_bulk_cancel(bulk_op_id='1234567890123')
+    """
+    # https://shopify.dev/docs/api/admin-graphql/2024-10/mutations/bulkOperationCancel
+
+    client = shopify_graphql_client(client)
+
+    query = 'mutation { bulkOperationCancel(id: "gid://shopify/BulkOperation/' + str(bulk_op_id) + '") {bulkOperation {id status} userErrors {field message}}}'
+    data = client.post(query)
+
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
+
+    bulk_operation = data['data']['bulkOperationCancel']['bulkOperation']
+    for error in data['data']['bulkOperationCancel']['userErrors']:
+        print(f"bulkOperationCancel {bulk_op_id}:  {error['message']}")
+    if bulk_operation is None: raise Exception(f"The bulk operation {bulk_op_id} could not be canceled")
+    status = bulk_operation['status']
+    if verbose: print(f"bulkOperationCancel {bulk_op_id}  status: {status}")
+
+    # Wait until the bulk operation is CANCELED (or it finished before the cancel took effect).
+    if wait: status = shopify_graphql_bulk_wait_canceled(bulk_op_id=bulk_op_id, status=status, timeout_s=timeout_s, verbose=verbose, client=client)
+
+    return status
+
+
+def shopify_graphql_bulk_wait_canceled(bulk_op_id:str=None, status:str="CANCELING", timeout_s:float=60.0, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Wait (up to timeout_s) until the bulk operation bulk_op_id (last seen with status) is no longer CREATED,
+    RUNNING or CANCELING, without canceling it, and return its status (ex. CANCELED).
+
+    status = shopify_graphql_bulk_wait_canceled(bulk_op_id='1234567890123')
+    """
+
+    from time import sleep
+    import time
+
+    client = shopify_graphql_client(client)
+
+    query = 'query { node(id: "gid://shopify/BulkOperation/' + str(bulk_op_id) + '") {... on BulkOperation {status}}}'
+    t_start = time.monotonic()
+    while status in ("CREATED", "RUNNING", "CANCELING"):
+        if time.monotonic() - t_start > timeout_s: raise Exception(f"The bulk operation {bulk_op_id} is still {status} after {timeout_s} s")
+        sleep(0.5)
+        data = client.post(query)
+        if "errors" in data: raise Exception(f"ERROR: {data['errors']}")
+        status = data['data']['node']['status']
+        if verbose: print(f"status: {status}")
+
+    return status
+
+
+def shopify_graphql_bulk_query_reattach(query:str=None, max_age_s:float=3600.0, stale_s:float=None, cancel:bool=False, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Like shopify_graphql_bulk_query() for a bulkOperationRunQuery, but the shop's current bulk query
+    (shopify_graphql_bulk_current()) is checked first, so that a restart never costs a full re-export:
+        A CREATED or RUNNING bulk query of the same query is reattached to (unless it has been running for
+        more than stale_s, then it is canceled and started again).
+        A bulk query of the same query that COMPLETED less than max_age_s ago is reused (its url is still valid,
+        so shopify_graphql_bulk_poll() returns it right away).  Pass max_age_s=0 to never reuse a result.
+        A CREATED or RUNNING bulk query of another query (ex. another app's export) raises an exception.
+        Only if cancel is it canceled (bulkOperationCancel), and then only once it has been running for more
+        than stale_s (if passed).
+    Returns the bulk operation id and its createdAt (ex. '2024-11-21T17:00:00Z'), so an incremental export can
+    take its watermark from when the reused bulk query started.
+
+    bulk_op_id, created_at = shopify_graphql_bulk_query_reattach(query=bulk_query)
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id)
+    """
+
+    import re
+    from datetime import datetime, timezone
+
+    client = shopify_graphql_client(client)
+
+    def normalize(text):
+        return " ".join(str(text).split())
+
+    def age_s(timestamp):
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(timestamp.replace("Z", "+00:00"))).total_seconds()
+
+    match = re.search(r'bulkOperationRunQuery\(query: """(.*?)"""', query, flags=re.DOTALL)
+    if match is None: raise Exception("query is not a bulkOperationRunQuery")
+
+    current = shopify_graphql_bulk_current(op_type="QUERY", verbose=verbose, client=client)
+    if not current is None:
+        same_query = not current['query'] is None and normalize(current['query']) == normalize(match.group(1))
+        if current['status'] in ("CREATED", "RUNNING"):
+            if same_query and (stale_s is None or age_s(current['createdAt']) <= stale_s):
+                print(f"Reattaching to the {current['status']} bulk query {current['bulk_op_id']} created {current['createdAt']}")
+                return current['bulk_op_id'], current['createdAt']
+            if not same_query and (not cancel or (not stale_s is None and age_s(current['createdAt']) <= stale_s)):
+                raise Exception(f"Another bulk query {current['bulk_op_id']} is {current['status']} (created {current['createdAt']}).  Wait for it to finish, or pass cancel=True to cancel it.")
+            print(f"Canceling the {'stale' if same_query else 'other'} bulk query {current['bulk_op_id']} created {current['createdAt']}")
+            shopify_graphql_bulk_cancel(bulk_op_id=current['bulk_op_id'], verbose=verbose, client=client)
+        elif current['status'] == "CANCELING":
+            # Already being canceled:  wait for it instead of canceling it again.
+            shopify_graphql_bulk_wait_canceled(bulk_op_id=current['bulk_op_id'], verbose=verbose, client=client)
+        elif current['status'] == "COMPLETED" and same_query and not current['completedAt'] is None and age_s(current['completedAt']) < max_age_s:
+            print(f"Reusing the bulk query {current['bulk_op_id']} completed {current['completedAt']}")
+            return current['bulk_op_id'], current['createdAt']
+
+    created_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    bulk_op_id = shopify_graphql_bulk_query(query=query, verbose=verbose, client=client)
+
+    return bulk_op_id, created_at
+
+
+def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:float=None, verbose:bool=False, client:ShopifyGraphQLClient=None, wait_min_s:float=0.5, wait_max_s:float=30.0, backoff:float=2.0, timeout_s:float=None):
     """
-    Poll Shopify by the bulk_op_id waiting wait_s between each poll until the bulk results are ready.
-    Returns the actual cost, object count, and the URL.  URL will be None if an error occurs.
+    Poll Shopify by the bulk_op_id until the bulk results are ready.
+    Returns the actual cost, object count, and the URL.  URL will be None if an error occurs
+    (errorCode, FAILED, CANCELED, EXPIRED, or no result after timeout_s) or if the completed
+    bulk operation returned no objects.
+
+    The wait between polls is adaptive:  it starts at wait_min_s (small queries finish in ~1 s) and
+    grows by backoff (with jitter) up to wait_max_s while the objectCount grows.  When the objectCount
+    stops growing the result file is being written, so the wait drops back to wait_min_s.
+    Pass wait_s to poll at a fixed interval instead.
 
     bulk_op_id = '1234567890123'
-    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False)
     if url is None: raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
     """
     # https://shopify.dev/docs/api/usage/bulk-operations/queries#option-b-poll-a-running-bulk-operation
 
     from time import sleep
+    import time
+    import random
     import json
 
-    # pip install requests
-    import requests
-
-    if not isinstance(API_TOKEN, str): raise Exception("API_TOKEN is not defined")
-    if not isinstance(GRAPHQL_ENDPOINT, str): raise Exception("GRAPHQL_ENDPOINT is not defined")
-
-    # Define the headers for the GraphQL HTTP POST
-    headers = {
-        'Content-Type': 'application/graphql',      # Must be: 'application/graphql'    NOT: 'application/json'
-        'X-Shopify-Access-Token': f'{API_TOKEN}',
-    }
+    client = shopify_graphql_client(client)
 
     # Create the query JSON string
     query = 'query { node(id: "gid://shopify/BulkOperation/' + str(bulk_op_id) + '") {... on BulkOperation {status\nerrorCode\nobjectCount\nurl}}}'
 
     if verbose: print("Polling GraphQL for bulk query results by bulk operation id " + str(bulk_op_id) + "..")
+
+    t_start = time.monotonic()
+    wait = wait_min_s if wait_s is None else wait_s
+    obj_count_last = None
     url = None
     # Query (poll) Shopify until the bulk data is available
     while url is None:
-        response = requests.post(GRAPHQL_ENDPOINT, data=query, headers=headers)
-        data = response.json()
+        t_poll_sec = time.perf_counter()
+        data = client.post(query)
+        t_poll_sec = time.perf_counter() - t_poll_sec
         #print(json.dumps(data, indent=2))
 
         """
@@ -181,7 +887,7 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
         }
         }
 
-        productVariantsBulkUpdate
+        Not a BulkOperation id
         {
         "data": {
             "node": null
@@ -201,6 +907,10 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
 
         """
         
+        if "errors" in data:
+            print(f"ERROR: {data['errors']}")
+            raise Exception(f"ERROR: {data['errors']}")
+
         error_code = None
         status = None
         obj_count = None
@@ -208,7 +918,7 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
         if not data['data']['node'] is None and 'status' in data['data']['node']:
             # Extract the bulk query status
             # https://shopify.dev/docs/api/admin-graphql/2024-10/enums/bulkoperationstatus
-            # CANCELED, CANCELING, COMPLETED, CREATED, EXPIIRED, FAILED, RUNNING
+            # CANCELED, CANCELING, COMPLETED, CREATED, EXPIRED, FAILED, RUNNING
             status = data['data']['node']['status']
 
             # The errorCode will be Null if no error
@@ -218,6 +928,7 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
             obj_count = data['data']['node']['objectCount']
 
         cost = data['extensions']['cost']
+        client.metrics.record("bulk_poll", t_poll_sec, cost=cost['actualQueryCost'], status=status, object_count=int(obj_count or 0), bulk_op_id=str(bulk_op_id))
 
         if verbose:
             print(f"status: {status}")
@@ -225,7 +936,7 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
             print(f"obj_count: {obj_count}")
 
         # If an error occurs, print out the details.
-        if not error_code is None:
+        if not error_code is None or status in ("FAILED", "CANCELED", "EXPIRED"):
             print(json.dumps(data, indent=2))
             print(f"status: {status}")
             print(f"error_code: {error_code}")
@@ -237,16 +948,41 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
             url = data['data']['node']['url']
             # url will be None until the bulk query is complete
 
-        if url is None:
-            # Wait to give the server a chance to process the query
-            if not status is None: print(f"status: {status} \t waiting {wait_s} s ..")
-            sleep(wait_s)
-
-        if url is None and status is None: 
-            # productVariantsBulkUpdate
+        if status is None:
+            # Not a bulk operation (node is null), so there is nothing to wait for.
             #print(json.dumps(data, indent=2))
             return cost['actualQueryCost'], obj_count, url
 
+        if status == "COMPLETED":
+            # url is None if the bulk operation completed without returning any objects.
+            if url is None: print(f"status: {status} \t no objects returned (obj_count: {obj_count})")
+            break
+
+        if url is None:
+            # Adapt the wait to the objectCount growth between polls.
+            if wait_s is None and not obj_count is None:
+                if not obj_count_last is None and int(obj_count) > 0 and int(obj_count) == obj_count_last and status == "RUNNING":
+                    # No new objects:  the result file is being written and the bulk operation is about to complete.
+                    wait = wait_min_s
+                elif not obj_count_last is None:
+                    wait = min(wait_max_s, wait * backoff)
+                obj_count_last = int(obj_count)
+            elif wait_s is None:
+                wait = min(wait_max_s, wait * backoff)
+            wait_jitter = wait if not wait_s is None else wait * random.uniform(0.8, 1.2)
+
+            if not timeout_s is None:
+                t_remaining = timeout_s - (time.monotonic() - t_start)
+                if t_remaining <= 0.0:
+                    print(f"status: {status} \t bulk operation {bulk_op_id} not complete after {timeout_s} s")
+                    return cost['actualQueryCost'], obj_count, None
+                wait_jitter = min(wait_jitter, t_remaining)
+
+            # Wait to give the server a chance to process the query
+            print(f"status: {status} \t waiting {wait_jitter:.1f} s ..")
+            sleep(wait_jitter)
+            client.metrics.record("bulk_poll_wait", wait_jitter, bulk_op_id=str(bulk_op_id))
+
     if verbose: 
         print("actualQueryCost:", cost['actualQueryCost'])
         print("url:", url)
@@ -254,27 +990,199 @@ def shopify_graphql_bulk_poll(bulk_op_id:str=None, wait_s:int=10, verbose:bool=F
     return cost['actualQueryCost'], obj_count, url
 
 
-def shopify_graphql_bulk_dl_to_file(url:str=None, path_file:str=None, verbose:bool=False):
+def shopify_graphql_bulk_dl_to_file(url:str=None, path_file:Path=None, verbose:bool=False, client:ShopifyGraphQLClient=None, chunk_size:int=8*1024*1024, retries:int=5, segments:int=1):
     """
     Download the bulk query results from url to the local file path_file.
 
+    The download is written in large (chunk_size) chunks to path_file + '.part'.  If the connection
+    drops, the download resumes from the end of the .part file with an HTTP Range request (up to
+    retries times, also after a restart of the script for the same url), and the size is checked
+    against the Content-Length before the .part file is renamed to path_file.
+    segments > 1 splits the file into that many byte ranges that are downloaded concurrently.  The finished
+    segments are recorded in path_file + '.part.json', so a restart of the script for the same url only
+    downloads the unfinished ones.  If a segmented download fails, its .part file is deleted.
+
     path_file = shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, verbose=False)
     """
 
+    import os
+    import json
+    import time
+    import threading
+    from time import sleep
+    from concurrent.futures import ThreadPoolExecutor
+
+    # pip install requests
+    import requests
+
+    # The errors after which the download is resumed
+    resumable_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+    def content_total(response, offset):
+        """
+        Returns the total size of the file from the Content-Range (206) or Content-Length (200) header.
+        """
+        if response.status_code == 206 and 'Content-Range' in response.headers:
+            # Content-Range: bytes 1048576-3145727/3145728
+            total = response.headers['Content-Range'].rsplit("/", maxsplit=1)[1]
+            return None if total == "*" else int(total)
+        if 'Content-Length' in response.headers:
+            return offset + int(response.headers['Content-Length'])
+        return None
+
+
+    def write_meta(meta):
+        """
+        Write the meta file of the .part file (atomically, it is read after a restart of the script).
+        """
+        path_meta_tmp = path_meta.with_name(path_meta.name + ".tmp")
+        with open(path_meta_tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(path_meta_tmp, path_meta)
+
+
     def download_from_url_to_file(url):
         """
-        Download the file specified by url.
+        Download the file specified by url to the .part file, resuming from the end of the .part file.
         """
-        import requests
-        get_response = requests.get(url,stream=True)
-        with open(path_file, 'wb') as f:
-            for chunk in get_response.iter_content(chunk_size=1024):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
+
+        # Resume only a .part file of the same bulk query result (the url without the signature).
+        meta = None
+        if path_part.is_file() and path_meta.is_file():
+            with open(path_meta, 'r') as f:
+                meta = json.load(f)
+            if not meta['url'] == url.split("?")[0]: meta = None
+            # A segmented .part file has holes:  it can't be resumed from its end.
+            elif 'segments' in meta: meta = None
+        if meta is None and path_part.is_file(): path_part.unlink()
+
+        attempt = 0
+        while True:
+            offset = path_part.stat().st_size if path_part.is_file() else 0
+            headers = {}
+            if offset > 0:
+                headers['Range'] = f"bytes={offset}-"
+                # Only resume if the file on the server hasn't changed.  Otherwise the server returns all of it (200).
+                if not meta is None and not meta.get('etag') is None: headers['If-Range'] = meta['etag']
+                if verbose: print(f"Resuming the download at byte {offset}")
+            try:
+                with client.get(url, stream=True, headers=headers) as get_response:
+                    if not 'ttfb_s' in event: event['ttfb_s'] = time.time() - event['t']
+                    if get_response.status_code == 416 and not meta is None and offset == meta.get('total'):
+                        # Range not satisfiable:  the .part file is already complete.
+                        return offset, meta.get('total')
+                    get_response.raise_for_status()
+                    if offset > 0 and get_response.status_code == 200:
+                        # The server ignored the Range request, so start over.
+                        offset = 0
+                    total = content_total(get_response, offset)
+                    meta = {"url": url.split("?")[0], "etag": get_response.headers.get('ETag'), "total": total}
+                    write_meta(meta)
+
+                    with open(path_part, 'ab' if offset > 0 else 'wb') as f:
+                        for chunk in get_response.iter_content(chunk_size=chunk_size):
+                            if chunk: # filter out keep-alive new chunks
+                                f.write(chunk)
+                                offset += len(chunk)
+
+                if total is None or offset == total: return offset, total
+                raise requests.exceptions.ChunkedEncodingError(f"Incomplete download:  {offset} of {total} bytes")
+
+            except resumable_errors as e:
+                attempt += 1
+                if attempt > retries: raise Exception(f"Download from '{url}' FAILED after {retries} retries:  {e}")
+                print(f"Download interrupted at byte {offset} ({e}).  Retry {attempt} of {retries} ..")
+                sleep(min(30.0, 2.0 ** attempt))
+
+
+    def download_segments_from_url_to_file(url):
+        """
+        Download the file specified by url to the .part file as segments byte ranges concurrently.
+        Returns the bytes downloaded (counted per segment) and the total, or None if the server doesn't support Range requests.
+        """
+
+        # Get the total size with a one byte Range request.
+        with client.get(url, stream=True, headers={'Range': "bytes=0-0"}) as get_response:
+            event['ttfb_s'] = time.time() - event['t']
+            get_response.raise_for_status()
+            if not get_response.status_code == 206: return None
+            total = content_total(get_response, 0)
+            etag = get_response.headers.get('ETag')
+        if total is None: return None
+
+        segment_size = -(-total // segments)
+        ranges = [[start, min(start + segment_size, total) - 1] for start in range(0, total, segment_size)]
+
+        # Keep the finished segments of a .part file of the same bulk query result (after a restart of the script).
+        done = []
+        if path_part.is_file() and path_meta.is_file() and path_part.stat().st_size == total:
+            with open(path_meta, 'r') as f:
+                meta = json.load(f)
+            if meta['url'] == url.split("?")[0] and meta.get('etag') == etag and meta.get('total') == total and meta.get('segments') == ranges:
+                done = meta['done']
+                if verbose: print(f"Resuming the download:  {len(done)} of {len(ranges)} segments already downloaded")
+
+        # The meta file is written before the .part file is allocated, so a stale meta never describes it.
+        meta = {"url": url.split("?")[0], "etag": etag, "total": total, "segments": ranges, "done": done}
+        write_meta(meta)
+        if len(done) == 0:
+            with open(path_part, 'wb') as f:
+                f.truncate(total)
+
+        lock = threading.Lock()
+
+        def download_segment(start, end):
+            # Download the bytes start to end (inclusive), resuming within the segment after an error.
+            # Returns the number of bytes written.
+            segment_start = start
+            written = 0
+            attempt = 0
+            with open(path_part, 'r+b') as f:
+                while start <= end:
+                    try:
+                        with client.get(url, stream=True, headers={'Range': f"bytes={start}-{end}"}) as get_response:
+                            get_response.raise_for_status()
+                            if not get_response.status_code == 206: raise Exception(f"Range request for bytes {start}-{end} returned HTTP status {get_response.status_code}")
+                            f.seek(start)
+                            for chunk in get_response.iter_content(chunk_size=chunk_size):
+                                if chunk:
+                                    chunk = chunk[:end + 1 - start]
+                                    f.write(chunk)
+                                    start += len(chunk)
+                                    written += len(chunk)
+                        if start <= end: raise requests.exceptions.ChunkedEncodingError(f"Incomplete segment:  byte {start} of {end}")
+                    except resumable_errors as e:
+                        attempt += 1
+                        if attempt > retries: raise Exception(f"Download of bytes {start}-{end} from '{url}' FAILED after {retries} retries:  {e}")
+                        sleep(min(30.0, 2.0 ** attempt))
+            with lock:
+                meta['done'].append(segment_start)
+                write_meta(meta)
+            return written
+
+        size = sum(end + 1 - start for start, end in ranges if start in done)
+        try:
+            with ThreadPoolExecutor(max_workers=segments) as executor:
+                futures = [executor.submit(download_segment, start, end) for start, end in ranges if not start in done]
+                for future in futures:
+                    size += future.result()
+        except BaseException:
+            # Don't leave a partly written (zero-filled) .part file behind.
+            if path_part.is_file(): path_part.unlink()
+            if path_meta.is_file(): path_meta.unlink()
+            raise
+
+        return size, total
 
 
     # Download the JSON file specified by a URL to a local file path_file.
 
+    client = shopify_graphql_client(client)
+
+    path_file = Path(path_file)
+    path_part = path_file.with_name(path_file.name + ".part")
+    path_meta = path_file.with_name(path_file.name + ".part.json")
+
     # Delete the file if it already exists
     if path_file.is_file(): 
         print(f"Deleting file that already exists {path_file}")
@@ -282,136 +1190,1742 @@ def shopify_graphql_bulk_dl_to_file(url:str=None, path_file:str=None, verbose:bo
 
     # Download the JSON file specified by url and write it to path_file
     # url:  https://storage.googleapis.com/shopify-tiers-assets-prod-us-east1/bulk-operation-outputs/l32j8ouqfxzi7rkq6hmnxzzzj1lj-final?GoogleAccessId=assets-us-prod%40shopify-tiers.iam.gserviceaccount.com&Expires=1732187275&Signature=TStPV3pLAzM3sFYezQLmH91%2F%2FwJwp55MxfJE9uNUY79xWzD9xIm8WKa1FkWnCG6UwlHHFp26EkmAAoBTjQCuRjSHKq9DI2VC5qUlCDkoTCdfHnf7Y5sq%2BRnz93DDgLxeH0NEiV3%2BYHHsklzt1TKuM%2Bh%2Bnp1eD3EPOriox0Q4UF4%2BmlijQUstRv7kvkVwJbEFMIL7S%2B3MuwdkNVCwd2Mivj%2BJE%2Bsz4gFHlPCJUkdbmI8Q8R5%2Fx9Y7KvJfwQ89uAY%2FwhOjAuOmZiiWE9EstBtPjvmj1UwBkJO1nKRmisAFXY%2BjTdL0PsbfzvdBG64Ovah6KOJlbzlKq5YwI0F%2BQcuOKQ%3D%3D&response-content-disposition=attachment%3B+filename%3D%22bulk-4142422163590.jsonl%22%3B+filename%2A%3DUTF-8%27%27bulk-4142422163590.jsonl&response-content-type=application%2Fjson
-    download_from_url_to_file(url)
-
-    if not path_file.is_file(): raise Exception("Download from '" + url + "' to file '" + str(path_file) + "' FAILED")
+    with client.metrics.span("download", url=url.split("?")[0], segments=segments) as event:
+        result = None
+        if segments > 1: result = download_segments_from_url_to_file(url)
+        if result is None: result = download_from_url_to_file(url)
+        size, total = result
+        event['bytes'] = size
 
-    if verbose: print("Downloaded JSON file location:", path_file)
+    # size is the number of bytes received (a segmented .part file is allocated at the full size up front).
+    if not total is None and (not size == total or not path_part.stat().st_size == total):
+        raise Exception(f"Download from '{url}' to file '{path_part}' is {size} bytes, not the Content-Length {total}")
 
-    return path_file
+    os.replace(path_part, path_file)
+    if path_meta.is_file(): path_meta.unlink()
 
+    if not path_file.is_file(): raise Exception("Download from '" + url + "' to file '" + str(path_file) + "' FAILED")
 
+    if verbose: print("Downloaded JSON file location:", path_file, f"({size} bytes)")
 
+    return path_file
 
-# ---------------------------------------------------------------------------
 
+_shopify_json_decoders = {}
 
-def currency_conversion_api(currency_from:str=None, currency_to:str=None, start_date:str=None, end_date:str=None, verbose=False):
+def shopify_json_decoder(backend:str=None, struct:str=None):
     """
-    Returns the maximum currency conversion rate from start_date to end_date.
-    Note that the end_date should NOT be the current day.
-
-    from datetime import datetime, timedelta
-    end_date = datetime.strftime(datetime.now() - timedelta(days=1), "%Y-%m-%d")        # '2018-07-15'
-    start_date = datetime.strftime(datetime.now() - timedelta(days=8), "%Y-%m-%d")
-    max_eur_to_usd = currency_conversion_api("EUR","USD", start_date, end_date)
-    print(f"max_eur_to_usd: {max_eur_to_usd} from {start_date} to {end_date}")
+    Returns a function that decodes one JSON line (bytes or str) of the bulk query results.
+    backend is 'orjson', 'msgspec' or 'json' (the standard library).  If backend is None, the
+    fastest one installed is used (orjson, then msgspec, then json).
+    If struct is 'Product' or 'ProductVariant', each line is decoded into a typed msgspec.Struct
+    (attributes instead of a dict, requires msgspec) for flat processing of known shapes.
+    Ex. variant.id, variant.sku, variant.parent_id (the __parentId).
+
+    loads = shopify_json_decoder()
+    line = loads(b'{"id":"gid://shopify/Product/1629753868406"}')
     """
 
-    import os
+    key = (backend, struct)
+    if key in _shopify_json_decoders: return _shopify_json_decoders[key]
 
-    if currency_from is None or currency_to is None or start_date is None or end_date is None: raise Exception("Argument missing")
-    if not len(currency_from) == 3: raise Exception("Format error 'currency_from'")
-    if not len(currency_to) == 3: raise Exception("Format error 'currency_to'")
+    if not struct is None:
+        # pip install msgspec
+        import msgspec
+        loads = msgspec.json.Decoder(_shopify_msgspec_struct(struct)).decode
 
-    # Implement your own choice of API to do the conversion.  
-    # I have used CurrencyConverterAPI with long term success.  https://www.currencyconverterapi.com/
-    return 1.06
+    else:
+        if backend is None:
+            # The fastest decoder installed
+            import importlib.util
+            backend = "json"
+            for name in ("orjson", "msgspec"):
+                if not importlib.util.find_spec(name) is None:
+                    backend = name
+                    break
+
+        if backend == "orjson":
+            # pip install orjson
+            import orjson
+            loads = orjson.loads
+        elif backend == "msgspec":
+            # pip install msgspec
+            import msgspec
+            loads = msgspec.json.Decoder().decode
+        elif backend == "json":
+            import json
+            loads = json.loads
+        else:
+            raise Exception(f"Unknown JSON decoder backend '{backend}'.  Use 'orjson', 'msgspec' or 'json'")
 
+    _shopify_json_decoders[key] = loads
+    return loads
 
 
+_shopify_msgspec_structs = {}
 
-def get_selling_price_for_sku(sku:str=None, markup:float=0.6, eur_to_usd:float=None, product_description:str="", price_detail:str=""):
+def _shopify_msgspec_struct(name:str=None):
     """
-    Returns the selling price in USD for the SKU.  
-
-    selling_price_usd = get_selling_price_for_sku(sku="B400ST220CSTCSRF00", eur_to_usd=1.06)
-
+    Returns the msgspec.Struct type for the bulk query result line of the object type name.
     """
 
-    if len(sku) > 30: raise Exception("sku length exceeds 30")
-    if markup > 1.0: raise Exception("Markup is too large")
-    if eur_to_usd is None: raise Exception("Argument 'eur_to_usd' not passed to function")
+    if name in _shopify_msgspec_structs: return _shopify_msgspec_structs[name]
 
-    from random import random
+    # pip install msgspec
+    import msgspec
+    from typing import Optional
 
-    # Implement your own custom function here
-    selling_price_usd = round(random()*100.0,2)
-    return {"selling_price_usd": selling_price_usd, "book_price_eur": round(selling_price_usd/eur_to_usd), "product_description": "", "price_detail": ""}
+    class Product(msgspec.Struct):
+        id: str
+        title: Optional[str] = None
+        updatedAt: Optional[str] = None
 
+    class ProductVariant(msgspec.Struct):
+        id: str
+        title: Optional[str] = None
+        sku: Optional[str] = None
+        price: Optional[str] = None
+        updatedAt: Optional[str] = None
+        parent_id: Optional[str] = msgspec.field(default=None, name="__parentId")
 
+    _shopify_msgspec_structs.update({"Product": Product, "ProductVariant": ProductVariant})
 
+    if not name in _shopify_msgspec_structs: raise Exception(f"No typed struct for '{name}'.  Use 'Product' or 'ProductVariant'")
+    return _shopify_msgspec_structs[name]
 
-def shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=False):
-    """
-    Returns all of the product variants for the Shopify store defined by STORE_NAME.
 
-    product_variants = shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=False)
+def shopify_graphql_bulk_iter(url:str=None, chunk_size:int=1024*1024, decoder=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
     """
+    Stream the bulk query results (JSON lines) from url and yield each line parsed as a dict.
+    Only one chunk of the download is held in memory, so records can be processed in constant
+    memory while the download is still in progress.
+    Each line is decoded by decoder (default:  shopify_json_decoder(), the fastest one installed).
 
-    from pathlib import Path
-
-    #pip install jsonlines
-    import jsonlines
-
-    import requests
-
-    # Get all products and their nested variants:
-    query = "{products {edges {node {id variants {edges {node {id title sku }}}}}}}"
-    
-    bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
-    print(bulk_query)
+    for line in shopify_graphql_bulk_iter(url=url):
+        print(line)     # {'id': 'gid://shopify/Product/1629753868406'}
+    """
 
-    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False)
-    if verbose: print(f"bulk_op_id: {bulk_op_id}")
+    import time
 
-    # Poll the GraphQL endpoint until the bulk query is complete.
-    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
-    #if url is None: raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
-    if verbose: print(f"Bulk query actual cost was {cost} for {obj_count} items.")
-    if not url is None and verbose: print(f"url: {url}")
+    client = shopify_graphql_client(client)
 
-    # Download the bulk query result file to MEMORY
+    loads = shopify_json_decoder() if decoder is None else decoder
 
-    response = requests.get(url,stream=True)
+    t_start_sec = time.perf_counter()
+    response = client.get(url, stream=True)
+    ttfb_s = time.perf_counter() - t_start_sec
     response.raise_for_status()
     if not response.status_code == 200:
         raise Exception(f"ERROR: {response.status_code}")
 
-    product_variants = []
-
-    # Process response content with jsonlines
-    with jsonlines.Reader(response.iter_lines()) as reader:
-        for line in reader.iter():
+    i = 0
+    n_bytes = 0
+    parse_s = 0.0
+    lines = []
+    try:
+        for line in response.iter_lines(chunk_size=chunk_size):
             if line: # filter out keep-alive new chunks
+                lines.append(line)
+                if len(lines) < 1000: continue
+            else:
+                continue
+            # Decode the lines in batches so that only the parse is timed (not the caller's processing).
+            t_parse_sec = time.perf_counter()
+            objects = [loads(line) for line in lines]
+            parse_s += time.perf_counter() - t_parse_sec
+            i += len(objects)
+            n_bytes += sum(map(len, lines)) + len(lines)
+            lines = []
+            yield from objects
+        t_parse_sec = time.perf_counter()
+        objects = [loads(line) for line in lines]
+        parse_s += time.perf_counter() - t_parse_sec
+        i += len(objects)
+        n_bytes += sum(map(len, lines)) + len(lines)
+        yield from objects
+    finally:
+        # Release the connection back to the pool even if the caller stops early.
+        response.close()
+        client.metrics.record("download", time.perf_counter() - t_start_sec, bytes=n_bytes, objects=i, ttfb_s=ttfb_s, url=url.split("?")[0], streamed=True)
+        client.metrics.record("parse", parse_s, bytes=n_bytes, objects=i)
+
+    if verbose: print(f"{i} lines streamed from the bulk query results")
+
+
+def shopify_graphql_bulk_iter_file(path_file:Path=None, decoder=None, verbose:bool=False, metrics:ShopifyMetrics=None):
+    """
+    Yield each line of the bulk query results file path_file (ex. from shopify_graphql_bulk_dl_to_file())
+    parsed by decoder (default:  shopify_json_decoder(), the fastest one installed).
+    If metrics (ex. client.metrics) is passed, the parse time, bytes and lines are recorded.
+
+    for line in shopify_graphql_bulk_iter_file(path_file=Path.cwd().joinpath("bulk_dl.jsonl")):
+        print(line)
+    """
+
+    import time
+
+    loads = shopify_json_decoder() if decoder is None else decoder
+
+    i = 0
+    n_bytes = 0
+    parse_s = 0.0
+    try:
+        with open(path_file, 'rb', buffering=1024*1024) as f:
+            while True:
+                # Decode ~1 MB of lines at a time so that only the parse is timed (not the caller's processing).
+                lines = f.readlines(1024*1024)
+                if len(lines) == 0: break
+                t_parse_sec = time.perf_counter()
+                objects = [loads(line) for line in lines if line.strip()]
+                parse_s += time.perf_counter() - t_parse_sec
+                i += len(objects)
+                n_bytes += sum(map(len, lines))
+                yield from objects
+    finally:
+        if not metrics is None: metrics.record("parse", parse_s, bytes=n_bytes, objects=i, path_file=str(path_file))
+
+    if verbose: print(f"{i} lines read from {path_file}")
+
+
+def shopify_gid_type(gid:str=None):
+    """
+    Returns the object type of the Shopify global id gid.
+
+    shopify_gid_type("gid://shopify/ProductVariant/19047055687798")     # 'ProductVariant'
+    shopify_gid_type("gid://shopify/InventoryLevel/1234?inventory_item_id=5678")     # 'InventoryLevel'
+    """
+    if not isinstance(gid, str) or not gid.startswith("gid://"): raise Exception(f"Not a Shopify gid: {gid}")
+    # gid://shopify/<Type>/<id>
+    return gid.split("/", maxsplit=4)[3]
+
+
+def shopify_graphql_bulk_reassemble(lines=None, child_keys:dict=None):
+    """
+    Rebuild the nesting of bulk query results.  The JSONL output of a bulk query is flat:  every
+    child object (connection node) is its own line that refers to its parent with __parentId and
+    follows the parent.  Each child is appended to a list in its parent under the key
+    child_keys[<Type>] (default:  the <Type> of the child's gid://shopify/<Type>/<id>), at any depth
+    (ex. Product -> ProductVariant -> InventoryLevel).
+    A complete top level object is yielded as soon as the next top level object appears, so only
+    one top level object (and its children) is held in memory.
+    The lines are not modified:  each object is a new plain dict (without the __parentId), also for
+    the typed msgspec structs of shopify_json_decoder(struct=..).
+
+    lines = shopify_graphql_bulk_iter(url=url)
+    for product in shopify_graphql_bulk_reassemble(lines, child_keys={"ProductVariant": "variants"}):
+        print(product['id'], len(product.get('variants', [])))
+    """
+
+    if child_keys is None: child_keys = {}
+
+    group = None
+    # id -> object for the objects of the current group (the possible parents)
+    objects = {}
+    for line in lines:
+        if isinstance(line, dict):
+            line = dict(line)
+        else:
+            # A typed msgspec.Struct:  a dict with the JSON field names (ex. __parentId)
+            # pip install msgspec
+            import msgspec
+            line = msgspec.to_builtins(line)
+        parent_id = line.pop('__parentId', None)
+
+        if parent_id is None:
+            # A new top level object:  the previous one is complete.
+            if not group is None: yield group
+            group = line
+            objects = {}
+        else:
+            if not parent_id in objects:
+                raise Exception(f"Parent {parent_id} not found for {line.get('id')}.  The bulk query results are not in parent / child order.")
+            child_type = shopify_gid_type(line['id']) if 'id' in line else None
+            key = child_keys.get(child_type, child_type)
+            if key is None: raise Exception(f"Child of {parent_id} has no id.  Add the id to the query.")
+            objects[parent_id].setdefault(key, []).append(line)
+
+        if 'id' in line: objects[line['id']] = line
+
+    if not group is None: yield group
+
+
+def shopify_graphql_bulk_file_chunks(path_file:Path=None, chunks:int=None, chunk_size:int=64*1024*1024):
+    """
+    Returns the byte ranges [(start, end), ..] that split the bulk query results file path_file into about
+    chunks parts (default:  one per chunk_size bytes).  Every range starts on a top level object (a line
+    without __parentId), so the children of an object are always in the same range as their parent.
+    The file is memory-mapped and only the lines around each split point are read.
+
+    ranges = shopify_graphql_bulk_file_chunks(path_file=Path.cwd().joinpath("bulk_dl.jsonl"), chunks=8)
+    """
+
+    import os
+    import mmap
+
+    size = os.path.getsize(path_file)
+    if size == 0: return []
+    if chunks is None: chunks = -(-size // chunk_size)
+    chunks = max(1, chunks)
+
+    ranges = []
+    start = 0
+    with open(path_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, chunks):
+            split = size * i // chunks
+            if split <= start: continue
+            # The start of the first line at or after split
+            pos = mm.find(b"\n", split - 1)
+            if pos == -1: break
+            pos += 1
+            # Skip the children (__parentId) of the object before the split.
+            while pos < size:
+                end = mm.find(b"\n", pos)
+                if end == -1: end = size
+                if not b'"__parentId"' in mm[pos:end]: break
+                pos = end + 1
+            if pos >= size: break
+            if pos > start:
+                ranges.append((start, pos))
+                start = pos
+    ranges.append((start, size))
+
+    return ranges
+
+
+def _shopify_bulk_parse_chunk(path_file:str=None, start:int=0, end:int=None, child_keys:dict=None, columns:tuple=None, backend:str=None):
+    """
+    Decode the lines of the byte range start:end of the bulk query results file path_file (memory-mapped) and
+    return the (reassembled) objects, or a pyarrow RecordBatch of columns.  Runs in a process of shopify_graphql_bulk_parse_file().
+    """
+
+    import mmap
+
+    loads = shopify_json_decoder(backend)
+    with open(path_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        lines = [loads(line) for line in mm[start:end].splitlines() if line.strip()]
+
+    if not child_keys is None: lines = list(shopify_graphql_bulk_reassemble(lines, child_keys=child_keys))
+    if columns is None: return lines
+
+    # pip install pyarrow
+    import pyarrow as pa
+    return pa.RecordBatch.from_pydict({column: [line.get(column) for line in lines] for column in columns})
+
+
+def shopify_graphql_bulk_parse_file(path_file:Path=None, processes:int=None, child_keys:dict=None, columns:tuple=None, backend:str=None, chunk_size:int=64*1024*1024, executor=None, verbose:bool=False, metrics:ShopifyMetrics=None):
+    """
+    Parse the bulk query results file path_file (ex. from shopify_graphql_bulk_dl_to_file()) with a pool of
+    processes (default:  the number of CPUs), so the parse scales with the cores.  The file is split at top
+    level objects (shopify_graphql_bulk_file_chunks(), at least one chunk per process) and every chunk is
+    memory-mapped and decoded by backend (see shopify_json_decoder()) in its own process.
+    If child_keys is passed, the children are nested in their parents (see shopify_graphql_bulk_reassemble()).
+    Returns the merged list of the (top level) objects in file order or, if columns (the keys to keep) is passed,
+    the list of the pyarrow RecordBatch of each chunk in file order (much less to send back from the processes).
+    Pass executor (a concurrent.futures.ProcessPoolExecutor) to reuse a pool of processes.
+    If metrics (ex. client.metrics) is passed, the parse time, bytes and objects are recorded.
+
+    products = shopify_graphql_bulk_parse_file(path_file=path_file, child_keys={"ProductVariant": "variants"})
+    batches = shopify_graphql_bulk_parse_file(path_file=path_file, columns=("id", "sku", "price", "__parentId"))
+    """
+
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    if not Path(path_file).is_file(): raise Exception(f"File not found {path_file}")
+    if processes is None: processes = os.cpu_count() or 1
+    size = os.path.getsize(path_file)
+
+    t_start_sec = time.perf_counter()
+    ranges = shopify_graphql_bulk_file_chunks(path_file, chunks=max(processes, -(-size // chunk_size)))
+    if processes == 1 and executor is None:
+        results = [_shopify_bulk_parse_chunk(str(path_file), start, end, child_keys, columns, backend) for start, end in ranges]
+    else:
+        pool = ProcessPoolExecutor(max_workers=processes) if executor is None else executor
+        try:
+            futures = [pool.submit(_shopify_bulk_parse_chunk, str(path_file), start, end, child_keys, columns, backend) for start, end in ranges]
+            results = [future.result() for future in futures]
+        finally:
+            if executor is None: pool.shutdown()
+    parse_s = time.perf_counter() - t_start_sec
+
+    objects = sum(len(result) if columns is None else result.num_rows for result in results)
+    if not metrics is None: metrics.record("parse", parse_s, bytes=size, objects=objects, path_file=str(path_file), chunks=len(ranges), processes=processes)
+    if verbose: print(f"{objects} objects parsed from {path_file} in {len(ranges)} chunks with {processes} processes in {parse_s:.3f} s")
+
+    if columns is None: return [line for result in results for line in result]
+    return results
+
+
+# Update the variants (up to max_variants_per_mutation) of one product.  The variables are
+# {"productId": "gid://shopify/Product/<id>", "variants": [{"id": "gid://shopify/ProductVariant/<id>", "price": "12.34"}, ..]}
+PRODUCT_VARIANTS_BULK_UPDATE = "mutation call($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {productVariantsBulkUpdate(productId: $productId, variants: $variants) {userErrors {field message}}}"
+
+# Shopify's limit on the size of the JSONL variables file of a bulkOperationRunMutation
+BULK_MUTATION_VARIABLES_MAX_BYTES = 100 * 1000 * 1000
+
+
+def shopify_graphql_mutation(query:str=None, verbose:bool=False, client:ShopifyGraphQLClient=None, variables:dict=None, cost:float=None):
+    """
+    Execute a synchronous GraphQL mutation (ex. productVariantsBulkUpdate) with its (optional) variables
+    and return the userErrors and the cost read directly from the mutation response.
+    If cost (the estimated requestedQueryCost) is passed, it is reserved in client.throttle while the mutation is sent.
+    Unlike a bulkOperationRunQuery, the mutation has completed when the response arrives, so
+    there is nothing to poll (don't pass it to shopify_graphql_bulk_poll()).
+
+    user_errors, cost = shopify_graphql_mutation(query=query)
+    user_errors, cost = shopify_graphql_mutation(query=PRODUCT_VARIANTS_BULK_UPDATE, variables={"productId": "gid://shopify/Product/1629753868406", "variants": [{"id": "gid://shopify/ProductVariant/19047055687798", "price": "12.34"}]})
+    print(cost['actualQueryCost'], cost['throttleStatus']['currentlyAvailable'])
+    """
+    # https://shopify.dev/docs/api/admin-graphql/2024-10/mutations/productVariantsBulkUpdate
+
+    import json
+
+    client = shopify_graphql_client(client)
+
+    with client.metrics.span("mutation") as event:
+        data = client.post(query, variables=variables, cost=cost)
+        if isinstance(data, dict): event['cost'] = data.get('extensions', {}).get('cost', {}).get('actualQueryCost', 0)
+        if not variables is None: event['objects'] = len(variables.get('variants', []))
+
+    """
+    {
+    "data": {
+        "productVariantsBulkUpdate": {
+        "userErrors": []
+        }
+    },
+    "extensions": {
+        "cost": {
+        "requestedQueryCost": 11,
+        "actualQueryCost": 11,
+        "throttleStatus": {
+            "maximumAvailable": 2000.0,
+            "currentlyAvailable": 1989,
+            "restoreRate": 100.0
+        }
+        }
+    }
+    }
+    """
+
+    # Check for errors
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
+
+    # The mutation result is the only key under 'data'
+    mutation_name = next(iter(data['data']))
+    user_errors = []
+    if not data['data'][mutation_name] is None and 'userErrors' in data['data'][mutation_name]:
+        user_errors = data['data'][mutation_name]['userErrors']
+
+    cost = data['extensions']['cost']
+
+    if verbose:
+        print(f"{mutation_name} actualQueryCost: {cost['actualQueryCost']}")
+        if len(user_errors) > 0: print(json.dumps(user_errors, indent=2))
+
+    return user_errors, cost
+
+
+def shopify_graphql_mutation_dispatcher(mutations=None, max_workers:int=8, callback=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Execute many synchronous GraphQL mutations concurrently and return a list of (key, user_errors, cost).
+    mutations is an iterable of (key, query), (key, query, variables) or (key, query, variables, cost) and is consumed lazily.
+    Before each mutation is sent, its cost is reserved in client.throttle (the leaky bucket updated from the
+    throttleStatus of every response), so the number of mutations in flight follows currentlyAvailable and
+    restoreRate and stays just under the rate limit.  If the cost is not passed, it is estimated from the
+    number of variables['variants'] (shopify_mutation_cost_estimate()), else the last requestedQueryCost is used.
+    At most max_workers are in flight (keep <= the client pool size).
+    If callback is passed, callback(key, user_errors, cost) is called as each mutation completes.
+
+    results = shopify_graphql_mutation_dispatcher(mutations=[("product 1", query1), ("product 2", query2)], max_workers=8)
+    results = shopify_graphql_mutation_dispatcher(mutations=[("product 1", PRODUCT_VARIANTS_BULK_UPDATE, variables, 210)])
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    client = shopify_graphql_client(client)
+    throttle = client.throttle
+
+    results = []
+
+    def execute(key, query, variables, requested_cost):
+        # client.post() blocks until requested_cost is available in the bucket and reserves it
+        user_errors, cost = shopify_graphql_mutation(query=query, verbose=verbose, client=client, variables=variables, cost=requested_cost)
+        return key, user_errors, cost
+
+    def collect(done):
+        for future in done:
+            key, user_errors, cost = future.result()
+            results.append((key, user_errors, cost))
+            if not callback is None: callback(key, user_errors, cost)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for key, query, *rest in mutations:
+            variables = rest[0] if len(rest) > 0 else None
+            requested_cost = rest[1] if len(rest) > 1 else None
+            if requested_cost is None:
+                if isinstance(variables, dict) and 'variants' in variables:
+                    requested_cost = shopify_mutation_cost_estimate(len(variables['variants']))
+                else:
+                    requested_cost = throttle.requested_cost if not throttle.requested_cost is None else 1.0
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(execute, key, query, variables, requested_cost))
+            if verbose: print(f"{len(pending)} mutations in flight, {throttle.available():.0f} of {throttle.maximum_available:.0f} available")
+        done, pending = wait(pending)
+        collect(done)
+
+    return results
+
+
+def shopify_pipeline_stage(items=None, maxsize:int=16, batch_size:int=64, name:str="pipeline_stage"):
+    """
+    Runs the iterable items (ex. a generator that downloads and parses, or prices) in its own thread and yields
+    its items through a bounded queue of up to maxsize batches of batch_size items.  When the queue is full the
+    thread blocks (backpressure), so memory stays bounded and a slow consumer holds back the producer, while the
+    producer's work (network, parsing, pricing) overlaps the consumer's.  An exception raised by items is
+    re-raised in the consumer.  If the consumer stops early, the thread stops at its next item.
+
+    groups = shopify_pipeline_stage(shopify_group_product_variants(shopify_omca_iter_product_variants()))
+    for product_gid, variants in groups:
+        print(product_gid, len(variants))
+    """
+
+    import queue
+    import threading
+
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(message):
+        # Block while the queue is full, unless the consumer has stopped.
+        while not stop.is_set():
+            try:
+                q.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        batch = []
+        try:
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not put((None, batch)): return
+                    batch = []
+            if len(batch) > 0 and not put((None, batch)): return
+            put((done, None))
+        except BaseException as e:
+            put((e, None))
+        finally:
+            if hasattr(items, 'close'): items.close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            error, batch = q.get()
+            if error is done: break
+            if not error is None: raise error
+            yield from batch
+    finally:
+        stop.set()
+        # Don't wait long for a producer that is blocked in a slow step (ex. a bulk poll).  It stops at its next item.
+        thread.join(timeout=5.0)
+
+
+def shopify_product_variants_count(verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Returns the number of product variants in the store (one cheap productVariantsCount query, no export).
+    It also updates client.throttle with the store's rate limit.
+
+    n_variants = shopify_product_variants_count()
+    """
+    # https://shopify.dev/docs/api/admin-graphql/2024-10/queries/productVariantsCount
+
+    client = shopify_graphql_client(client)
+
+    data = client.post('query { productVariantsCount { count } }')
+
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
+
+    n_variants = int(data['data']['productVariantsCount']['count'])
+    if verbose: print(f"{n_variants} product variants in the store")
+
+    return n_variants
+
+
+def shopify_mutation_cost_estimate(n_variants:int=None, base_cost:float=10.0, variant_cost:float=1.0):
+    """
+    Returns the estimated requestedQueryCost of a productVariantsBulkUpdate of n_variants variants.
+    Calibrate base_cost and variant_cost from the requestedQueryCost of a few mutations.
+
+    cost = shopify_mutation_cost_estimate(n_variants=250)
+    """
+    return base_cost + variant_cost * n_variants
+
+
+def shopify_mutation_cost_plan(batches=None, throttle_status:dict=None, target_s:float=None, max_workers:int=8, batch_sizes=(250, 100, 50, 25, 10), latency_s:float=0.5, reserve:float=0.2, base_cost:float=10.0, variant_cost:float=1.0, verbose:bool=False):
+    """
+    Plan the productVariantsBulkUpdate mutations for the pending batches (the number of variants to update for
+    each product) against the store's rate limit throttle_status (the last extensions.cost.throttleStatus, or
+    client.throttle.status()).  Returns a dict with the predicted total cost, mutations and wall time for the
+    chosen max_variants_per_mutation (from batch_sizes) and max_workers (1 to max_workers):
+        {"total_cost", "mutations", "wall_s", "best_wall_s", "max_variants_per_mutation", "max_workers", "reserve_cost", "rate", "base_cost", "variant_cost"}
+    The fraction reserve of the bucket and of its restoreRate is left for the other apps and integrations
+    sharing the store's rate limit (set client.throttle.reserve = plan['reserve_cost'] to enforce it).
+    Each mutation takes latency_s.  Without target_s, the fastest plan is chosen.  With target_s, the plan
+    with the fewest workers (then the lowest cost) that finishes within target_s is chosen, and an exception
+    is raised if no plan can finish within target_s without using the reserve.
+    Each mutation should reserve its planned cost shopify_mutation_cost_estimate(n, plan['base_cost'], plan['variant_cost']).
+
+    plan = shopify_mutation_cost_plan(batches=[3, 3, 520], throttle_status={"maximumAvailable": 2000.0, "currentlyAvailable": 1800.0, "restoreRate": 100.0}, target_s=60.0)
+    """
+
+    import math
+
+    if batches is None: raise Exception("Argument 'batches' not passed to function")
+    if throttle_status is None: raise Exception("Argument 'throttle_status' not passed to function")
+    if not 0.0 <= reserve < 1.0: raise Exception("reserve must be >= 0 and < 1")
+
+    batches = [n for n in batches if n > 0]
+    n_variants = sum(batches)
+    maximum_available = float(throttle_status['maximumAvailable'])
+    currently_available = float(throttle_status['currentlyAvailable'])
+    restore_rate = float(throttle_status['restoreRate'])
+
+    reserve_cost = reserve * maximum_available
+    # The cost available at once (above the reserve), then the share of the restore rate per second
+    burst = max(0.0, currently_available - reserve_cost)
+    rate = (1.0 - reserve) * restore_rate
+    # A single query can't cost more than 1000 (or the usable bucket)
+    max_query_cost = min(1000.0, maximum_available - reserve_cost)
+
+    plans = []
+    for batch_size in batch_sizes:
+        if shopify_mutation_cost_estimate(min(batch_size, max(batches, default=0)), base_cost, variant_cost) > max_query_cost: continue
+        mutations = sum(math.ceil(n / batch_size) for n in batches)
+        total_cost = mutations * base_cost + n_variants * variant_cost
+        rate_s = max(0.0, total_cost - burst) / rate
+        for workers in range(1, max_workers + 1):
+            wall_s = max(rate_s, math.ceil(mutations / workers) * latency_s)
+            plans.append({"total_cost": total_cost, "mutations": mutations, "wall_s": wall_s, "max_variants_per_mutation": batch_size, "max_workers": workers})
+    if len(plans) == 0: raise Exception(f"No batch size in {batch_sizes} fits the rate limit {maximum_available} less the reserve")
+
+    best_wall_s = min(plan['wall_s'] for plan in plans)
+    if target_s is None:
+        plan = min(plans, key=lambda plan: (plan['wall_s'], plan['max_workers'], plan['total_cost']))
+    else:
+        fits = [plan for plan in plans if plan['wall_s'] <= target_s]
+        if len(fits) == 0:
+            raise Exception(f"Refusing the run:  {n_variants} variants (cost ~{min(plan['total_cost'] for plan in plans):.0f}) need at least {best_wall_s:.1f} s without using the {reserve:.0%} of the rate limit reserved for other integrations (target {target_s} s)")
+        plan = min(fits, key=lambda plan: (plan['max_workers'], plan['total_cost'], plan['wall_s']))
+
+    plan = dict(plan, best_wall_s=best_wall_s, reserve_cost=reserve_cost, rate=rate, base_cost=base_cost, variant_cost=variant_cost)
+    if verbose: print(f"Plan:  {plan['mutations']} mutations of up to {plan['max_variants_per_mutation']} variants with {plan['max_workers']} workers, cost ~{plan['total_cost']:.0f}, ~{plan['wall_s']:.1f} s (best {best_wall_s:.1f} s)")
+    return plan
+
+
+def shopify_graphql_staged_upload(path_file:Path=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Upload the JSONL file path_file of mutation variables (one line per mutation) to Shopify's
+    staged upload storage and return the stagedUploadPath for bulkOperationRunMutation.
+
+    staged_upload_path = shopify_graphql_staged_upload(path_file=Path.cwd().joinpath("bulk_op_vars.jsonl"))
+    """
+    # https://shopify.dev/docs/api/usage/bulk-operations/imports#generate-the-uploaded-url-and-parameters
+
+    import json
+
+    client = shopify_graphql_client(client)
+
+    if not path_file.is_file(): raise Exception(f"File not found {path_file}")
+
+    query = '''mutation {stagedUploadsCreate(input: [{resource: BULK_MUTATION_VARIABLES, filename: "''' + path_file.name + '''", mimeType: "text/jsonl", httpMethod: POST}]) {stagedTargets {url resourceUrl parameters {name value}} userErrors {field message}}}'''
+    data = client.post(query)
+
+    """
+    {
+    "data": {
+        "stagedUploadsCreate": {
+        "stagedTargets": [
+            {
+            "url": "https://shopify-staged-uploads.storage.googleapis.com",
+            "resourceUrl": null,
+            "parameters": [
+                {"name": "key", "value": "tmp/21759409/bulk/89e620e1-0252-43b0-8f3b-3b7075ba4a23/bulk_op_vars.jsonl"},
+                {"name": "Content-Type", "value": "text/jsonl"},
+                {"name": "success_action_status", "value": "201"},
+                {"name": "acl", "value": "private"},
+                {"name": "policy", "value": "..."},
+                {"name": "x-goog-credential", "value": "..."},
+                {"name": "x-goog-algorithm", "value": "GOOG4-RSA-SHA256"},
+                {"name": "x-goog-date", "value": "20241121T120000Z"},
+                {"name": "x-goog-signature", "value": "..."}
+            ]
+            }
+        ],
+        "userErrors": []
+        }
+    }
+    }
+    """
+
+    if "errors" in data:
+        print(f"ERROR: {data['errors']}")
+        raise Exception(f"ERROR: {data['errors']}")
+
+    errors = data['data']['stagedUploadsCreate']['userErrors']
+    if len(errors) > 0:
+        print(json.dumps(errors, indent=2))
+        raise Exception("stagedUploadsCreate failed")
+
+    staged_target = data['data']['stagedUploadsCreate']['stagedTargets'][0]
+    parameters = {parameter['name']: parameter['value'] for parameter in staged_target['parameters']}
+    staged_upload_path = parameters['key']
+
+    # POST the file (multipart form, the file last) to the staged upload url.  Not a Shopify host, so no access token.
+    with open(path_file, 'rb') as f, client.metrics.span("staged_upload", bytes=path_file.stat().st_size):
+        response = client.session.post(staged_target['url'], data=parameters, files={'file': (path_file.name, f, 'text/jsonl')}, headers={'X-Shopify-Access-Token': None}, timeout=client.timeout_s)
+    if not response.status_code in (200, 201, 204):
+        print(response.text)
+        raise Exception(f"ERROR: staged upload of {path_file} failed with HTTP status {response.status_code}")
+
+    if verbose: print(f"staged_upload_path: {staged_upload_path}")
+
+    return staged_upload_path
+
+
+def shopify_graphql_bulk_mutation(mutation:str=None, path_file:Path=None, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Upload the JSONL file of mutation variables path_file, start one bulkOperationRunMutation that
+    executes mutation once for every line, and return the bulk operation id.
+    Track it with shopify_graphql_bulk_poll() and download the results (one JSON line per
+    mutation, with the __lineNumber of the variables) with shopify_graphql_bulk_dl_to_file().
+    The variables file is limited to 100 MB by Shopify (BULK_MUTATION_VARIABLES_MAX_BYTES):  a larger file is refused before it is uploaded.
+
+    mutation = "mutation call($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {productVariantsBulkUpdate(productId: $productId, variants: $variants) {userErrors {field message}}}"
+    bulk_op_id = shopify_graphql_bulk_mutation(mutation=mutation, path_file=Path.cwd().joinpath("bulk_op_vars.jsonl"))
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id)
+    """
+    # https://shopify.dev/docs/api/usage/bulk-operations/imports
+
+    client = shopify_graphql_client(client)
+
+    size = Path(path_file).stat().st_size
+    if size > BULK_MUTATION_VARIABLES_MAX_BYTES: raise Exception(f"The variables file {path_file} is {size} bytes, more than the {BULK_MUTATION_VARIABLES_MAX_BYTES} bytes allowed for a bulk mutation.  Split it into several files.")
+
+    # stagedUploadsCreate is retried like any other request:  a target created by a lost response is never uploaded to and expires.
+    staged_upload_path = shopify_graphql_staged_upload(path_file=path_file, verbose=verbose, client=client)
+
+    bulk_query = '''mutation {bulkOperationRunMutation(mutation: \"\"\"''' + mutation + '''\"\"\", stagedUploadPath: "''' + staged_upload_path + '''") {bulkOperation {id status} userErrors {field message}}}'''
+    bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=verbose, client=client)
+
+    return bulk_op_id
+
+
+
+
+# ---------------------------------------------------------------------------
+
+
+def currency_conversion_daily_rates_api(currency_from:str=None, currency_to:str=None, start_date:str=None, end_date:str=None, verbose=False):
+    """
+    Returns the daily currency conversion rates from start_date to end_date (inclusive) as {'YYYY-MM-DD': rate}.
+    Called by CurrencyRateCache only for the days that aren't cached.
+
+    rates = currency_conversion_daily_rates_api("EUR","USD", "2024-11-14", "2024-11-20")
+    """
+
+    from datetime import date, timedelta
+
+    if currency_from is None or currency_to is None or start_date is None or end_date is None: raise Exception("Argument missing")
+    if not len(currency_from) == 3: raise Exception("Format error 'currency_from'")
+    if not len(currency_to) == 3: raise Exception("Format error 'currency_to'")
+
+    day = date.fromisoformat(start_date)
+    day_end = date.fromisoformat(end_date)
+    if verbose: print(f"currency_conversion_daily_rates_api() {currency_from} to {currency_to} from {start_date} to {end_date}")
+
+    # Implement your own choice of API to do the conversion.  
+    # I have used CurrencyConverterAPI with long term success.  https://www.currencyconverterapi.com/
+    rates = {}
+    while day <= day_end:
+        rates[day.isoformat()] = 1.06
+        day += timedelta(days=1)
+    return rates
+
+
+class CurrencyRateCache:
+    """
+    Cached currency conversion rates.  The maximum rate for each (currency_from, currency_to, start_date, end_date)
+    is kept in an in-process LRU (maxsize entries), and the daily rates it is computed from are kept per currency
+    pair, optionally persisted to the JSON file path_file.  The rates for past days never change, so they never
+    expire and only the days that aren't cached are fetched with rates_api (default currency_conversion_daily_rates_api).
+    A day fetched without a rate (a weekend or a holiday) is recorded as None so it isn't fetched again.
+    The rates for the current day (and later), and a recent day without a rate (not published yet), expire after ttl_s.
+    Thread safe, so one cache can be shared by several stores repricing in one process, and several processes can
+    share path_file (each write is atomic and merges the days written by the others).
+
+    rate_cache = CurrencyRateCache(path_file=Path.cwd().joinpath("currency_rates.json"))
+    max_eur_to_usd = rate_cache.max_rate("EUR","USD", "2024-11-14", "2024-11-20")
+    """
+
+    def __init__(self, path_file:Path=None, ttl_s:float=3600.0, maxsize:int=256, rates_api=None):
+        import json
+        import threading
+        from collections import OrderedDict
+
+        self.path_file = None if path_file is None else Path(path_file)
+        self.ttl_s = ttl_s
+        self.maxsize = maxsize
+        self.rates_api = currency_conversion_daily_rates_api if rates_api is None else rates_api
+        self.lock = threading.RLock()
+        # (currency_from, currency_to, start_date, end_date): (expires at time.monotonic(), max rate)
+        self.lru = OrderedDict()
+        # 'EUR/USD': {'YYYY-MM-DD': [rate (None if the day has no rate), fetched at time.time()]}
+        self.rates = {}
+        self.api_calls = 0
+        if not self.path_file is None and self.path_file.is_file():
+            with open(self.path_file, 'r') as f:
+                self.rates = json.load(f)
+
+
+    def daily_rates(self, currency_from:str=None, currency_to:str=None, start_date:str=None, end_date:str=None, verbose:bool=False):
+        """
+        Returns the daily rates {'YYYY-MM-DD': rate} from start_date to end_date (inclusive), fetching only the days
+        that aren't cached (or that have expired).
+        """
+        with self.lock:
+            return self._daily_rates(currency_from, currency_to, start_date, end_date, verbose)
+
+
+    def _daily_rates(self, currency_from, currency_to, start_date, end_date, verbose):
+        import time
+        from datetime import date, timedelta
+
+        today = date.today().isoformat()
+        yesterday = (date.today() - timedelta(days=1)).isoformat()
+        now = time.time()
+        pair = self.rates.setdefault(f"{currency_from}/{currency_to}", {})
+
+        days = []
+        day = date.fromisoformat(start_date)
+        while day <= date.fromisoformat(end_date):
+            days.append(day.isoformat())
+            day += timedelta(days=1)
+
+        # Past days never expire.  The current day (and later), and yesterday without a rate, expire after ttl_s.
+        def expired(day):
+            return (day >= today or (day >= yesterday and pair[day][0] is None)) and now - pair[day][1] > self.ttl_s
+
+        missing = [day for day in days if not day in pair or expired(day)]
+        if len(missing) > 0:
+            if verbose: print(f"Fetching {len(missing)} of {len(days)} daily rates {currency_from} to {currency_to}")
+            self.api_calls += 1
+            rates = self.rates_api(currency_from, currency_to, missing[0], missing[-1], verbose=verbose)
+            if rates is None: return None
+            for day in missing:
+                # A day without a rate (ex. a weekend) is recorded too, so it isn't fetched again.
+                pair[day] = [rates.get(day), now]
+            for day, rate in rates.items():
+                pair[day] = [rate, now]
+            self.save()
+
+        return {day: pair[day][0] for day in days if day in pair and not pair[day][0] is None}
+
+
+    def max_rate(self, currency_from:str=None, currency_to:str=None, start_date:str=None, end_date:str=None, verbose:bool=False):
+        """
+        Returns the maximum conversion rate from start_date to end_date, or None if there are no rates.
+        """
+        import time
+        from datetime import date
+
+        key = (currency_from, currency_to, start_date, end_date)
+        with self.lock:
+            entry = self.lru.get(key)
+            if not entry is None and entry[0] > time.monotonic():
+                self.lru.move_to_end(key)
+                return entry[1]
+
+            rates = self._daily_rates(currency_from, currency_to, start_date, end_date, verbose)
+            if rates is None or len(rates) == 0: return None
+            max_rate = max(rates.values())
+
+            # A range of past days never changes.
+            expires = float("inf") if end_date < date.today().isoformat() else time.monotonic() + self.ttl_s
+            self.lru[key] = (expires, max_rate)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.maxsize:
+                self.lru.popitem(last=False)
+            return max_rate
+
+
+    def save(self):
+        """
+        Write the daily rates to path_file (if any).  While holding a lock on path_file + '.lock', the days written
+        to path_file by another process since it was read are merged, and the rates are written to a unique
+        temporary file that replaces path_file.
+        """
+        import os
+        import json
+        import tempfile
+        try:
+            import fcntl
+        except ImportError:
+            # Windows:  no lock between processes (the write is still atomic)
+            fcntl = None
+
+        if self.path_file is None: return
+        with self.lock, open(self.path_file.with_name(self.path_file.name + ".lock"), 'a') as f_lock:
+            if not fcntl is None: fcntl.flock(f_lock, fcntl.LOCK_EX)
+            if self.path_file.is_file():
+                try:
+                    with open(self.path_file, 'r') as f:
+                        rates_file = json.load(f)
+                except ValueError:
+                    rates_file = {}
+                for pair, days in rates_file.items():
+                    pair_rates = self.rates.setdefault(pair, {})
+                    for day, entry in days.items():
+                        # Keep the most recently fetched rate of each day
+                        if not day in pair_rates or entry[1] > pair_rates[day][1]: pair_rates[day] = entry
+            with tempfile.NamedTemporaryFile(mode='w', dir=self.path_file.parent, prefix=self.path_file.name + ".", suffix=".tmp", delete=False) as f:
+                json.dump(self.rates, f)
+            try:
+                os.replace(f.name, self.path_file)
+            except OSError:
+                os.remove(f.name)
+                raise
+            # The lock is released when f_lock is closed
+
+
+# The in-process cache used when currency_conversion_api() isn't passed one.
+_default_rate_cache = None
+
+def currency_rate_cache(cache:CurrencyRateCache=None):
+    """
+    Returns cache, or the shared in-process CurrencyRateCache (no file) if cache is None.
+    """
+    global _default_rate_cache
+    if not cache is None: return cache
+    if _default_rate_cache is None: _default_rate_cache = CurrencyRateCache()
+    return _default_rate_cache
+
+
+def currency_conversion_api(currency_from:str=None, currency_to:str=None, start_date:str=None, end_date:str=None, verbose=False, cache:CurrencyRateCache=None):
+    """
+    Returns the maximum currency conversion rate from start_date to end_date.
+    Note that the end_date should NOT be the current day.
+    The daily rates are cached (cache, or the shared in-process cache if None), so
+    repeated calls don't call the rate API again and only new days are fetched.
+
+    from datetime import datetime, timedelta
+    end_date = datetime.strftime(datetime.now() - timedelta(days=1), "%Y-%m-%d")        # '2018-07-15'
+    start_date = datetime.strftime(datetime.now() - timedelta(days=8), "%Y-%m-%d")
+    max_eur_to_usd = currency_conversion_api("EUR","USD", start_date, end_date)
+    print(f"max_eur_to_usd: {max_eur_to_usd} from {start_date} to {end_date}")
+    """
+
+    if currency_from is None or currency_to is None or start_date is None or end_date is None: raise Exception("Argument missing")
+    if not len(currency_from) == 3: raise Exception("Format error 'currency_from'")
+    if not len(currency_to) == 3: raise Exception("Format error 'currency_to'")
+
+    return currency_rate_cache(cache).max_rate(currency_from, currency_to, start_date, end_date, verbose=verbose)
+
+
+
+
+def shopify_price_equal(price_a=None, price_b=None):
+    """
+    Returns True if the two prices (str, float or None) are the same after rounding to the cent with
+    round_price() (the same rounding as the selling prices, so a computed price and the store price agree).
+    A None (unknown) price is never equal.
+
+    shopify_price_equal("10.00", 10.0)      # True
+    """
+    if price_a is None or price_b is None: return False
+    return round_price(float(price_a)) == round_price(float(price_b))
+
+
+
+
+def round_price(price:float=None):
+    """
+    Round the price to the cent:  round half to even of price * 100 (the same as numpy.rint(price * 100) / 100),
+    so that the single SKU and the vectorized prices are identical.
+
+    round_price(12.345)
+    """
+    return round(price * 100.0) / 100.0
+
+
+def get_selling_price_for_sku(sku:str=None, markup:float=0.6, eur_to_usd:float=None, product_description:str="", price_detail:str="", book_price_eur:float=None):
+    """
+    Returns the selling price in USD for the SKU.  
+    If book_price_eur is passed, the selling price is round_price(book_price_eur * eur_to_usd * (1.0 + markup)),
+    the same as get_selling_prices_for_skus() (use it for the whole catalog at once).
+
+    selling_price_usd = get_selling_price_for_sku(sku="B400ST220CSTCSRF00", eur_to_usd=1.06)
+
+    """
+
+    if len(sku) > 30: raise Exception("sku length exceeds 30")
+    if markup > 1.0: raise Exception("Markup is too large")
+    if eur_to_usd is None: raise Exception("Argument 'eur_to_usd' not passed to function")
+
+    if not book_price_eur is None:
+        selling_price_usd = round_price(book_price_eur * eur_to_usd * (1.0 + markup))
+        return {"selling_price_usd": selling_price_usd, "book_price_eur": book_price_eur, "product_description": product_description, "price_detail": price_detail}
+
+    from random import random
+
+    # Implement your own custom function here
+    selling_price_usd = round(random()*100.0,2)
+    return {"selling_price_usd": selling_price_usd, "book_price_eur": round(selling_price_usd/eur_to_usd), "product_description": "", "price_detail": ""}
+
+
+def get_selling_prices_for_skus(skus=None, book_prices_eur=None, markup:float=0.6, eur_to_usd:float=None):
+    """
+    Returns the selling prices in USD (a numpy float64 array) for the arrays (or lists, or pandas Series) of
+    SKUs and their book prices in EUR, computed in one vectorized pass with the same formula and rounding
+    as get_selling_price_for_sku():  round_price(book_price_eur * eur_to_usd * (1.0 + markup)).
+    A NaN book price gives a NaN selling price.  Without numpy, a list is returned.
+
+    selling_prices_usd = get_selling_prices_for_skus(skus=["B400ST220CSTCSRF00"], book_prices_eur=[100.0], eur_to_usd=1.06)
+    """
+
+    if markup > 1.0: raise Exception("Markup is too large")
+    if eur_to_usd is None: raise Exception("Argument 'eur_to_usd' not passed to function")
+
+    try:
+        # pip install numpy
+        import numpy as np
+    except ImportError:
+        np = None
+
+    if np is None:
+        skus = list(skus)
+        book_prices_eur = list(book_prices_eur)
+        if not len(skus) == len(book_prices_eur): raise Exception("skus and book_prices_eur are not the same length")
+        if any(len(sku) > 30 for sku in skus): raise Exception("sku length exceeds 30")
+        return [round_price(book_price_eur * eur_to_usd * (1.0 + markup)) for book_price_eur in book_prices_eur]
+
+    skus = np.asarray(skus, dtype=np.str_)
+    book_prices_eur = np.asarray(book_prices_eur, dtype=np.float64)
+    if not skus.shape == book_prices_eur.shape: raise Exception("skus and book_prices_eur are not the same length")
+    if skus.size > 0 and np.char.str_len(skus).max() > 30: raise Exception("sku length exceeds 30")
 
-                if not 'title' in line:
-                    # Just a product line.  Ex. {"id":"gid:\/\/shopify\/Product\/1629753868406"}
-                    product_gid = line['id']
-                    if not return_full_gid: product_gid = str(product_gid).rsplit(sep="/", maxsplit=1)[1]
+    # The same operations in the same order as get_selling_price_for_sku(), so the float64 results are identical.
+    selling_prices_usd = book_prices_eur * eur_to_usd * (1.0 + markup)
+    return np.rint(selling_prices_usd * 100.0) / 100.0
 
+
+class SupplierPriceBook:
+    """
+    The supplier book price (EUR) for each SKU, loaded once from a CSV or Parquet supplier price file into a
+    compact hashed index:  the SKU strings are interned and map to a position in a typed float64 array of prices.
+    save() writes the index to a cache directory as the SKUs sorted into fixed width records and their prices
+    (float64), and open() memory-maps both on the next run:  nothing is parsed or rebuilt, and a SKU is found
+    by binary search (lookup() searches a whole batch of SKUs at once with numpy).  load_cached() re-uses the
+    cache until the supplier file or the columns change.  Rows without a SKU or a price are skipped.
+
+    price_book = SupplierPriceBook.load_cached(path_file=Path.cwd().joinpath("supplier_prices.csv"))
+    book_price_eur = price_book.get("B400ST220CSTCSRF00")
+    book_prices_eur = price_book.lookup(["B400ST220CSTCSRF00", "A900ST120CSTCFTLT8"])    # numpy array, NaN if not found
+    """
+
+    # The version of the cache directory layout written by save()
+    CACHE_VERSION = 2
+
+    def __init__(self, skus:list=None, prices=None):
+        import sys
+        from array import array
+
+        # The SKUs in the order of prices
+        self.skus = [sys.intern(str(sku)) for sku in skus] if not skus is None else []
+        if any(sku == "" for sku in self.skus): raise Exception("A SKU is empty")
+        self.index = {sku: i for i, sku in enumerate(self.skus)}
+        # array('d'), or the prices of the memory-mapped cache (sorted by SKU) once open()
+        self.prices = prices if not prices is None else array('d')
+        if not len(self.skus) == len(self.prices): raise Exception("skus and prices are not the same length")
+        # The memory-mapped cache (open()):  the sorted SKUs (utf-8, NUL padded to width bytes) and the prices
+        self.mmaps = None
+        self.keys = None
+        self.width = 0
+        self.count = len(self.skus)
+
+
+    @classmethod
+    def load(cls, path_file:Path=None, sku_column:str="sku", price_column:str="book_price_eur"):
+        """
+        Load the supplier price file path_file (.csv or .parquet) with the columns sku_column and price_column.
+        A SKU listed more than once gets the last price.  Rows without a SKU or a price are skipped.
+        """
+        import sys
+
+        path_file = Path(path_file)
+        if not path_file.is_file(): raise Exception(f"File not found {path_file}")
+
+        f = None
+        if path_file.suffix.lower() == ".parquet":
+            # pip install pyarrow
+            import pyarrow.parquet as pq
+            table = pq.read_table(path_file, columns=[sku_column, price_column])
+            rows = zip(table[sku_column].to_pylist(), table[price_column].to_pylist())
+        else:
+            import csv
+            f = open(path_file, 'r', newline='', encoding='utf-8-sig')
+            rows = ((row[sku_column], row[price_column]) for row in csv.DictReader(f))
+
+        price_book = cls()
+        try:
+            for sku, price in rows:
+                if sku is None or price is None or str(sku).strip() == "" or str(price).strip() == "": continue
+                sku = sys.intern(str(sku).strip())
+                i = price_book.index.get(sku)
+                if i is None:
+                    price_book.index[sku] = len(price_book.skus)
+                    price_book.skus.append(sku)
+                    price_book.prices.append(float(price))
                 else:
-                    #'title' in line:
-
-                    # Get the variant gid
-                    variant_gid = line['id']
-                    if not return_full_gid: variant_gid = str(variant_gid).rsplit(sep="/", maxsplit=1)[1]
-                    
-                    variant_title = line['title']
-                    sku = line['sku']
-                    product_gid = line['__parentId']
-                    if not return_full_gid: product_gid = str(product_gid).rsplit(sep="/", maxsplit=1)[1]
-                    product_variants.append({"variant_gid": variant_gid, "variant_title": variant_title, "sku": sku, "product_gid": product_gid})
-                    
-                    #print(f"{i} \t variant_gid: {variant_gid}")
-                    if verbose:
-                        print(f"variant_gid: {variant_gid}")
-                        print(f"variant_title: {variant_title}")
-                        print(f"sku: {sku}")
-                        print(f"product_gid: {product_gid}")
-                        print()
-
-    return product_variants
+                    price_book.prices[i] = float(price)
+        finally:
+            # Also when a row is bad (ex. a missing column or a price that isn't a number)
+            if not f is None: f.close()
+        price_book.count = len(price_book.skus)
+
+        return price_book
+
+
+    def save(self, path_dir:Path=None, source:dict=None):
+        """
+        Save the index to the directory path_dir:  keys.bin (the SKUs sorted by their utf-8 bytes, each NUL padded
+        to the same width), prices.f64 (their prices, raw float64) and meta.json (the width, the count and source,
+        the supplier file and the columns the index was built from, that load_cached() checks).
+        Every file is written to a temporary file first and then renamed, meta.json last, so a crash (or a
+        concurrent load_cached()) never sees a partly written index.
+        """
+        import os
+        import json
+        import tempfile
+        from array import array
+
+        if not self.mmaps is None: raise Exception("The price book is already a saved index")
+
+        path_dir = Path(path_dir)
+        path_dir.mkdir(parents=True, exist_ok=True)
+        keys = [sku.encode('utf-8') for sku in self.skus]
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        width = max((len(key) for key in keys), default=0)
+        meta = {"version": self.CACHE_VERSION, "width": width, "count": len(keys), "source": source}
+
+        paths_tmp = []
+        try:
+            with tempfile.NamedTemporaryFile(mode='wb', dir=path_dir, prefix="keys.bin.", suffix=".tmp", delete=False) as f:
+                paths_tmp.append(f.name)
+                f.write(b"".join(keys[i].ljust(width, b"\0") for i in order))
+            with tempfile.NamedTemporaryFile(mode='wb', dir=path_dir, prefix="prices.f64.", suffix=".tmp", delete=False) as f:
+                paths_tmp.append(f.name)
+                array('d', (self.prices[i] for i in order)).tofile(f)
+            with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', dir=path_dir, prefix="meta.json.", suffix=".tmp", delete=False) as f:
+                paths_tmp.append(f.name)
+                json.dump(meta, f)
+            # A reader that sees the new meta.json also sees the new keys and prices.
+            if path_dir.joinpath("meta.json").exists(): os.remove(path_dir.joinpath("meta.json"))
+            os.replace(paths_tmp[0], path_dir.joinpath("keys.bin"))
+            os.replace(paths_tmp[1], path_dir.joinpath("prices.f64"))
+            os.replace(paths_tmp[2], path_dir.joinpath("meta.json"))
+        finally:
+            for path_tmp in paths_tmp:
+                if os.path.exists(path_tmp): os.remove(path_tmp)
+
+
+    @staticmethod
+    def meta(path_dir:Path=None):
+        """
+        Returns the meta.json (dict) of the index saved by save() in path_dir, or None if there is none (or it is
+        of another version).
+        """
+        import json
+        path_meta = Path(path_dir).joinpath("meta.json")
+        if not path_meta.is_file(): return None
+        with open(path_meta, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return meta if meta.get("version") == SupplierPriceBook.CACHE_VERSION else None
+
+
+    @classmethod
+    def open(cls, path_dir:Path=None):
+        """
+        Open the index saved by save() in path_dir.  The SKUs and the prices are memory-mapped (not read into memory).
+        """
+        import mmap
+
+        path_dir = Path(path_dir)
+        meta = cls.meta(path_dir)
+        if meta is None: raise Exception(f"No price book index in {path_dir}")
+
+        price_book = cls()
+        price_book.count = meta['count']
+        price_book.width = meta['width']
+        price_book.skus = None
+        price_book.index = None
+        price_book.mmaps = []
+        if price_book.count > 0:
+            for name in ("keys.bin", "prices.f64"):
+                with open(path_dir.joinpath(name), 'rb') as f:
+                    price_book.mmaps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            price_book.keys = price_book.mmaps[0]
+            price_book.prices = memoryview(price_book.mmaps[1]).cast('d')
+            if not len(price_book.keys) == price_book.count * price_book.width or not len(price_book.prices) == price_book.count:
+                price_book.close()
+                raise Exception(f"The price book index in {path_dir} is incomplete")
+        return price_book
+
+
+    @classmethod
+    def load_cached(cls, path_file:Path=None, path_dir:Path=None, sku_column:str="sku", price_column:str="book_price_eur"):
+        """
+        Open the memory-mapped index of the supplier price file path_file from path_dir (default:  path_file + '.index'),
+        or load path_file and save the index there if there is none, or it was built from another version of
+        path_file (its size or modification time changed) or from other columns.
+        """
+        path_file = Path(path_file)
+        if path_dir is None: path_dir = path_file.with_name(path_file.name + ".index")
+        path_dir = Path(path_dir)
+
+        stat = path_file.stat()
+        source = {"path_file": str(path_file.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sku_column": sku_column, "price_column": price_column}
+        meta = cls.meta(path_dir)
+        if not meta is None and meta.get("source") == source:
+            return cls.open(path_dir)
+
+        price_book = cls.load(path_file, sku_column=sku_column, price_column=price_column)
+        price_book.save(path_dir, source=source)
+        return price_book
+
+
+    def find(self, sku:str=None):
+        """
+        Returns the position of sku in prices, or None if sku is not in the price book.
+        """
+        if self.mmaps is None: return self.index.get(sku)
+
+        # Binary search of the sorted fixed width SKU records
+        key = str(sku).encode('utf-8')
+        keys, width = self.keys, self.width
+        if len(key) == 0 or len(key) > width: return None
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys[mid * width:(mid + 1) * width].rstrip(b"\0") < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and keys[lo * width:(lo + 1) * width].rstrip(b"\0") == key: return lo
+        return None
+
+
+    def get(self, sku:str=None, default:float=None):
+        """
+        Returns the book price (EUR) for sku, or default if sku is not in the price book.
+        """
+        i = self.find(sku)
+        return default if i is None else self.prices[i]
+
+
+    def lookup(self, skus=None):
+        """
+        Returns the book prices (EUR) for the SKUs as a numpy float64 array (NaN if not found),
+        or a list (None if not found) without numpy.  The SKUs of a memory-mapped index are all
+        binary searched at once (numpy searchsorted).
+        """
+        try:
+            # pip install numpy
+            import numpy as np
+        except ImportError:
+            return [self.get(sku) for sku in skus]
+
+        nan = float("nan")
+        if self.mmaps is None:
+            index = self.index
+            prices = self.prices
+            return np.fromiter((nan if index.get(sku) is None else prices[index[sku]] for sku in skus), dtype=np.float64)
+
+        keys_batch = [str(sku).encode('utf-8') for sku in skus]
+        book_prices_eur = np.full(len(keys_batch), nan, dtype=np.float64)
+        if self.count == 0 or len(keys_batch) == 0: return book_prices_eur
+        # A SKU longer than the longest SKU of the index (or empty) isn't in it (and would be truncated).
+        fits = np.fromiter((0 < len(key) <= self.width for key in keys_batch), dtype=bool, count=len(keys_batch))
+        keys_batch = np.array(keys_batch, dtype=f"S{self.width}")
+        keys = np.frombuffer(self.keys, dtype=f"S{self.width}")
+        i = np.minimum(np.searchsorted(keys, keys_batch), self.count - 1)
+        found = fits & (keys[i] == keys_batch)
+        book_prices_eur[found] = np.frombuffer(self.prices, dtype=np.float64)[i[found]]
+        del keys
+        return book_prices_eur
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, sku:str=None):
+        return not self.find(sku) is None
+
+
+    def close(self):
+        if not self.mmaps is None:
+            if isinstance(self.prices, memoryview): self.prices.release()
+            self.keys = None
+            for m in self.mmaps:
+                m.close()
+            self.mmaps = []
+
+
+
+
+def shopify_omca_iter_product_variants(return_full_gid=False, updated_since:str=None, verbose=False, client:ShopifyGraphQLClient=None, max_age_s:float=0.0, bulk_operation:dict=None):
+    """
+    Yields the product variants (one dict at a time) for the Shopify store defined by client (or STORE_NAME if client is None).
+    The bulk query result is streamed, so the variants can be processed in constant memory while they download.
+    If updated_since (ex. '2024-11-21T17:00:00Z') is passed, only the variants updated at or after that time are returned
+    (a productVariants bulk query filtered by updated_at).  They are not grouped by product.
+    A running bulk query of the same query (ex. started before a restart) is reattached to.  A completed one
+    is only reused if max_age_s is passed and it completed less than max_age_s ago (see
+    shopify_graphql_bulk_query_reattach()):  its prices are as old as the export.
+    If bulk_operation (a dict) is passed, the bulk_op_id and the created_at of the bulk query are set in it.
+
+    for product_variant in shopify_omca_iter_product_variants(return_full_gid=False, verbose=False):
+        print(product_variant)      # {'variant_gid': '19047055687798', 'variant_title': '..', 'sku': 'A900ST120CSTCFTLT8', 'price': '10.00', 'updated_at': '2024-11-21T17:00:00Z', 'product_gid': '1629753868406'}
+    """
+
+    client = shopify_graphql_client(client)
+
+    if updated_since is None:
+        # Get all products and their nested variants:
+        query = "{products {edges {node {id variants {edges {node {id title sku price updatedAt}}}}}}}"
+    else:
+        # Get the variants updated since updated_since (with the id of their product):
+        query = "{productVariants(query: \"updated_at:>='" + updated_since + "'\") {edges {node {id title sku price updatedAt product {id}}}}}"
+    
+    bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
+    print(bulk_query)
+
+    bulk_op_id, created_at = shopify_graphql_bulk_query_reattach(query=bulk_query, max_age_s=max_age_s, verbose=False, client=client)
+    if verbose: print(f"bulk_op_id: {bulk_op_id}")
+    if not bulk_operation is None: bulk_operation.update({"bulk_op_id": bulk_op_id, "created_at": created_at})
+
+    # Poll the GraphQL endpoint until the bulk query is complete.
+    cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
+    if verbose: print(f"Bulk query actual cost was {cost} for {obj_count} items.")
+    if url is None:
+        # A completed bulk query without any objects has no result file.
+        if str(obj_count) == "0": return
+        raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
+    if not url is None and verbose: print(f"url: {url}")
+
+    # Stream the bulk query result file one line at a time and rebuild each product with its variants
+    # (by the gid://shopify/<Type>/<id> of each line).  Ex. {"id":"gid:\/\/shopify\/Product\/1629753868406"}
+    lines = shopify_graphql_bulk_iter(url=url, verbose=verbose, client=client)
+    if updated_since is None:
+        products = shopify_graphql_bulk_reassemble(lines, child_keys={"ProductVariant": "variants"})
+    else:
+        # Each line is a variant.  Ex. {"id":"gid:\/\/shopify\/ProductVariant\/19047055687798", .. "product":{"id":"gid:\/\/shopify\/Product\/1629753868406"}}
+        products = ({"id": line['product']['id'], "variants": [line]} for line in lines)
+
+    yield from shopify_omca_product_variants(products, return_full_gid=return_full_gid, verbose=verbose)
+
+
+def shopify_omca_product_variants(products=None, return_full_gid=False, verbose=False):
+    """
+    Yields the product variants (one dict at a time) for the reassembled products (each with its 'variants')
+    from a products bulk query result.
+
+    lines = shopify_graphql_bulk_iter_file(path_file=Path.cwd().joinpath("products.jsonl"))
+    for product_variant in shopify_omca_product_variants(shopify_graphql_bulk_reassemble(lines, child_keys={"ProductVariant": "variants"})):
+        print(product_variant)
+    """
+
+    for product in products:
+
+        product_gid = product['id']
+        if not return_full_gid: product_gid = str(product_gid).rsplit(sep="/", maxsplit=1)[1]
+
+        for variant in product.get('variants', []):
+
+            # Get the variant gid
+            variant_gid = variant['id']
+            if not return_full_gid: variant_gid = str(variant_gid).rsplit(sep="/", maxsplit=1)[1]
+            
+            variant_title = variant['title']
+            sku = variant['sku']
+            
+            #print(f"{i} \t variant_gid: {variant_gid}")
+            if verbose:
+                print(f"variant_gid: {variant_gid}")
+                print(f"variant_title: {variant_title}")
+                print(f"sku: {sku}")
+                print(f"product_gid: {product_gid}")
+                print()
+
+            yield {"variant_gid": variant_gid, "variant_title": variant_title, "sku": sku, "price": variant.get('price'), "updated_at": variant.get('updatedAt'), "product_gid": product_gid}
+
+
+def shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=False, client:ShopifyGraphQLClient=None):
+    """
+    Returns all of the product variants for the Shopify store defined by client (or STORE_NAME if client is None).
+    Use shopify_omca_iter_product_variants() to process them without holding all of them in memory.
+
+    product_variants = shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=False)
+    """
+
+    return list(shopify_omca_iter_product_variants(return_full_gid=return_full_gid, verbose=verbose, client=client))
+
+
+
+# ---------------------------------------------------------------------------
+
+# A local columnar (Parquet) snapshot of the catalog's product variants.  After the first full export,
+# only the variants updated since the snapshot's watermark are exported and merged into it.
+
+SNAPSHOT_COLUMNS = ("variant_gid", "product_gid", "sku", "variant_title", "price", "updated_at")
+
+
+def shopify_catalog_snapshot_table(product_variants=None):
+    """
+    Returns a pyarrow Table with the SNAPSHOT_COLUMNS for the product variants (dicts) product_variants.
+
+    table = shopify_catalog_snapshot_table(shopify_omca_iter_product_variants())
+    """
+
+    # pip install pyarrow
+    import pyarrow as pa
+
+    columns = {column: [] for column in SNAPSHOT_COLUMNS}
+    for product_variant in product_variants:
+        for column in SNAPSHOT_COLUMNS:
+            columns[column].append(product_variant.get(column))
+
+    return pa.table({column: pa.array(values, type=pa.string()) for column, values in columns.items()})
+
+
+def shopify_catalog_snapshot_load(path_file:Path=None):
+    """
+    Returns the snapshot table and its watermark (the updated_at to export from next time) from the
+    Parquet file path_file, or (None, None) if there is no snapshot.
+
+    table, watermark = shopify_catalog_snapshot_load(path_file=Path.cwd().joinpath("catalog_snapshot.parquet"))
+    """
+
+    # pip install pyarrow
+    import pyarrow.parquet as pq
+
+    if not Path(path_file).is_file(): return None, None
+
+    table = pq.read_table(path_file)
+    metadata = table.schema.metadata or {}
+    watermark = metadata.get(b"watermark")
+    if not watermark is None: watermark = watermark.decode("utf-8")
+
+    return table, watermark
+
+
+def shopify_catalog_snapshot_save(table=None, path_file:Path=None, watermark:str=None):
+    """
+    Save the snapshot table with its watermark to the Parquet file path_file (replaced atomically),
+    and return the table with the watermark in its schema metadata.
+
+    table = shopify_catalog_snapshot_save(table=table, path_file=path_file, watermark="2024-11-21T17:00:00Z")
+    """
+
+    import os
+
+    # pip install pyarrow
+    import pyarrow.parquet as pq
+
+    metadata = dict(table.schema.metadata or {})
+    if not watermark is None: metadata[b"watermark"] = watermark.encode("utf-8")
+    table = table.replace_schema_metadata(metadata)
+
+    path_tmp = Path(path_file).with_name(Path(path_file).name + ".tmp")
+    pq.write_table(table, path_tmp, compression="zstd")
+    os.replace(path_tmp, path_file)
+
+    return table
+
+
+def shopify_catalog_snapshot_refresh(path_file:Path=None, full_refresh:bool=False, verbose:bool=False, client:ShopifyGraphQLClient=None):
+    """
+    Refresh the local catalog snapshot path_file (Parquet) and return it as a pyarrow Table sorted by product_gid.
+    The first time (or if full_refresh), all of the product variants are exported.  After that, only the
+    variants updated since the snapshot's watermark are exported and merged into the snapshot (by variant_gid).
+    Deleted variants are only removed by a full_refresh.
+
+    table = shopify_catalog_snapshot_refresh(path_file=Path.cwd().joinpath("catalog_snapshot.parquet"))
+    for product_variant in shopify_catalog_snapshot_iter(table):
+        print(product_variant)
+    """
+
+    from datetime import datetime, timedelta, timezone
+
+    # pip install pyarrow
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    client = shopify_graphql_client(client)
+
+    # Anything updated after the export starts (less a margin for clock differences) is exported next time.
+    export_start = datetime.strftime(datetime.now(timezone.utc) - timedelta(minutes=5), "%Y-%m-%dT%H:%M:%SZ")
+
+    table, watermark = (None, None) if full_refresh else shopify_catalog_snapshot_load(path_file)
+    if table is None: watermark = None
+    if verbose: print(f"Exporting the product variants updated since {watermark}" if not watermark is None else "Exporting all of the product variants")
+
+    bulk_operation = {}
+    delta = shopify_catalog_snapshot_table(shopify_omca_iter_product_variants(return_full_gid=False, updated_since=watermark, verbose=False, client=client, bulk_operation=bulk_operation))
+    if verbose: print(f"{delta.num_rows} product variants exported")
+    if not bulk_operation.get("created_at") is None:
+        # A reattached (or reused) bulk query started before this export.
+        export_start = min(export_start, datetime.strftime(datetime.strptime(bulk_operation["created_at"], "%Y-%m-%dT%H:%M:%SZ") - timedelta(minutes=5), "%Y-%m-%dT%H:%M:%SZ"))
+
+    if table is None:
+        table = delta
+    else:
+        # Replace the snapshot rows of the updated variants and add the new variants
+        unchanged = pc.invert(pc.is_in(table['variant_gid'], value_set=delta['variant_gid']))
+        table = pa.concat_tables([table.filter(unchanged).select(list(SNAPSHOT_COLUMNS)), delta])
+
+    # Group the variants of each product together (like the bulk query output)
+    table = table.sort_by("product_gid")
+
+    # The watermark is the last updated_at in the snapshot, but never later than the start of this export.
+    max_updated_at = pc.max(table['updated_at']).as_py() if table.num_rows > 0 else None
+    watermark = export_start if max_updated_at is None else min(max_updated_at, export_start)
+
+    table = shopify_catalog_snapshot_save(table=table, path_file=path_file, watermark=watermark)
+    if verbose: print(f"Snapshot {path_file} has {table.num_rows} product variants.  watermark: {watermark}")
+
+    return table
+
+
+def shopify_catalog_snapshot_from_file(path_file:Path=None, path_snapshot:Path=None, watermark:str=None, processes:int=1):
+    """
+    Build the catalog snapshot path_snapshot (Parquet) from the downloaded result file path_file of a full
+    products bulk query, and return the number of product variants.  CPU bound, so it can run in a process pool.
+    If processes > 1 (or None for the number of CPUs), the file is parsed in parallel into columnar batches
+    (shopify_graphql_bulk_parse_file()).
+
+    n_variants = shopify_catalog_snapshot_from_file(path_file=path_file, path_snapshot=path_snapshot, watermark="2024-11-21T17:00:00Z")
+    """
+
+    # pip install pyarrow
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if processes == 1:
+        lines = shopify_graphql_bulk_iter_file(path_file=path_file)
+        products = shopify_graphql_bulk_reassemble(lines, child_keys={"ProductVariant": "variants"})
+        table = shopify_catalog_snapshot_table(shopify_omca_product_variants(products, return_full_gid=False))
+    else:
+        # The variant lines (the ones with a __parentId) of each chunk, with the gids shortened to their ids.
+        tables = []
+        for batch in shopify_graphql_bulk_parse_file(path_file=path_file, processes=processes, columns=("id", "title", "sku", "price", "updatedAt", "__parentId")):
+            batch = batch.filter(pc.is_valid(batch['__parentId']))
+            column = lambda name: pc.cast(batch[name], pa.string())
+            tables.append(pa.table({
+                "variant_gid": pc.replace_substring_regex(column("id"), pattern=r"^.*/", replacement=""),
+                "product_gid": pc.replace_substring_regex(column("__parentId"), pattern=r"^.*/", replacement=""),
+                "sku": column("sku"),
+                "variant_title": column("title"),
+                "price": column("price"),
+                "updated_at": column("updatedAt"),
+            }))
+        table = pa.concat_tables(tables) if len(tables) > 0 else shopify_catalog_snapshot_table([])
+    table = table.sort_by("product_gid")
+    shopify_catalog_snapshot_save(table=table, path_file=path_snapshot, watermark=watermark)
+
+    return table.num_rows
+
+
+def shopify_catalog_snapshot_iter(table=None, batch_size:int=65536):
+    """
+    Yields the rows of the snapshot table as product variant dicts (like shopify_omca_iter_product_variants()),
+    one record batch at a time.
+
+    for product_variant in shopify_catalog_snapshot_iter(table):
+        print(product_variant)
+    """
+
+    for batch in table.to_batches(max_chunksize=batch_size):
+        yield from batch.to_pylist()
+
+
+# ---------------------------------------------------------------------------
+
+# A durable checkpoint journal (SQLite) for shopify_update_product_variant_prices(), so that a run that
+# dies partway through can be restarted without re-sending the products that were already updated.
+
+class ShopifyRepriceJournal:
+    """
+    A checkpoint journal (SQLite file path_file) of the repricing runs.  For each run it records the mode,
+    the catalog snapshot used (and its watermark), the exchange rate, the bulk operation id and its
+    variables file (mode "bulk"), the last completed product, and every product whose
+    productVariantsBulkUpdate was acknowledged without userErrors (written as each one completes).
+    start() resumes the unfinished run of the same mode, store and endpoint, if any, so finished products
+    are skipped and an in-flight bulk operation is picked up by its id instead of launching a new one.
+    An unfinished run older than max_age_s, or started with another exchange rate, is not resumed:  it is
+    marked abandoned and a new run starts (its prices would no longer match).
+    Thread safe.
+
+    journal = ShopifyRepriceJournal(path_file=Path.cwd().joinpath("reprice_journal.sqlite"), max_age_s=6*3600)
+    variants_count = shopify_update_product_variant_prices(path_snapshot=path_snapshot, journal=journal)
+    """
+
+    def __init__(self, path_file:Path=None, max_age_s:float=24*3600):
+        import sqlite3
+        import threading
+
+        if path_file is None: raise Exception("Argument 'path_file' not passed to function")
+        self.path_file = Path(path_file)
+        # An unfinished run older than max_age_s is not resumed
+        self.max_age_s = max_age_s
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path_file, check_same_thread=False)
+        # WAL keeps each per-product commit cheap and the journal consistent if the process dies.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, mode TEXT, started TEXT, finished TEXT, snapshot TEXT, watermark TEXT, eur_to_usd REAL, bulk_op_id TEXT, bulk_op_vars TEXT, last_product_gid TEXT, products_done INTEGER DEFAULT 0, store TEXT, endpoint TEXT, abandoned TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS products (run_id INTEGER, product_gid TEXT, variants INTEGER, completed TEXT, PRIMARY KEY (run_id, product_gid))")
+        # A journal written before the runs were keyed by store and endpoint
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(runs)")]
+        for column in ("store", "endpoint", "abandoned"):
+            if not column in columns: self.db.execute(f"ALTER TABLE runs ADD COLUMN {column} TEXT")
+        self.db.commit()
+
+
+    def start(self, mode:str="sync", snapshot:Path=None, watermark:str=None, eur_to_usd:float=None, store:str=None, endpoint:str=None):
+        """
+        Returns the run dict of the unfinished run of mode, store and endpoint (with "resumed": True), or of a new run.
+        The unfinished run is abandoned instead (and a new run starts) if it is older than max_age_s, or if
+        eur_to_usd is passed and the run started with another rate.  The run dict has the columns of the runs table.
+        """
+        from datetime import datetime, timezone
+
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            row = self.db.execute("SELECT run_id, started, eur_to_usd FROM runs WHERE mode = ? AND store IS ? AND endpoint IS ? AND finished IS NULL ORDER BY run_id DESC LIMIT 1", (mode, store, endpoint)).fetchone()
+            resumed = not row is None
+            if resumed:
+                run_id, started, run_eur_to_usd = row
+                age_s = (now - datetime.strptime(started, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)).total_seconds()
+                abandoned = None
+                if not self.max_age_s is None and age_s > self.max_age_s:
+                    abandoned = f"older than {self.max_age_s} s"
+                elif not eur_to_usd is None and not run_eur_to_usd is None and not float(eur_to_usd) == float(run_eur_to_usd):
+                    abandoned = f"eur_to_usd {run_eur_to_usd} is now {eur_to_usd}"
+                if not abandoned is None:
+                    print(f"Not resuming run {run_id} started {started}:  {abandoned}.  Starting a new run.")
+                    self.db.execute("UPDATE runs SET finished = ?, abandoned = ? WHERE run_id = ?", (now.strftime("%Y-%m-%dT%H:%M:%SZ"), abandoned, run_id))
+                    resumed = False
+            if not resumed:
+                run_id = self.db.execute("INSERT INTO runs (mode, started, snapshot, watermark, eur_to_usd, store, endpoint) VALUES (?, ?, ?, ?, ?, ?, ?)", (mode, now.strftime("%Y-%m-%dT%H:%M:%SZ"), None if snapshot is None else str(snapshot), watermark, eur_to_usd, store, endpoint)).lastrowid
+            self.db.commit()
+        run = self.run(run_id)
+        run['resumed'] = resumed
+        return run
+
+
+    def run(self, run_id:int=None):
+        """
+        Returns the run dict of run_id, or None.
+        """
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM runs WHERE run_id = ?", (run_id,))
+            row = cursor.fetchone()
+            if row is None: return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+
+    def update(self, run_id:int=None, **values):
+        """
+        Set the runs table columns values (ex. snapshot=, watermark=, eur_to_usd=) of run_id.
+        """
+        if len(values) == 0: return
+        with self.lock:
+            self.db.execute("UPDATE runs SET " + ", ".join(f"{column} = ?" for column in values) + " WHERE run_id = ?", (*values.values(), run_id))
+            self.db.commit()
+
+
+    def set_bulk_operation(self, run_id:int=None, bulk_op_id:str=None, path_file:Path=None):
+        """
+        Record the bulk operation id of run_id and its variables file path_file, as soon as it has been started.
+        """
+        self.update(run_id, bulk_op_id=bulk_op_id, bulk_op_vars=None if path_file is None else str(path_file))
+
+
+    def products_done(self, run_id:int=None, products=None):
+        """
+        Record the products [(product_gid, variants updated)] of run_id as completed in one transaction.
+        """
+        from datetime import datetime, timezone
+
+        products = list(products)
+        if len(products) == 0: return
+        completed = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO products (run_id, product_gid, variants, completed) VALUES (?, ?, ?, ?)", [(run_id, product_gid, variants, completed) for product_gid, variants in products])
+            self.db.execute("UPDATE runs SET last_product_gid = ?, products_done = (SELECT COUNT(*) FROM products WHERE run_id = ?) WHERE run_id = ?", (products[-1][0], run_id, run_id))
+            self.db.commit()
+
+
+    def product_done(self, run_id:int=None, product_gid:str=None, variants:int=None):
+        """
+        Record the product product_gid of run_id as completed (after its productVariantsBulkUpdate is acknowledged).
+        """
+        self.products_done(run_id, [(product_gid, variants)])
+
+
+    def completed(self, run_id:int=None):
+        """
+        Returns the set of the product_gid completed by run_id.
+        """
+        with self.lock:
+            return set(row[0] for row in self.db.execute("SELECT product_gid FROM products WHERE run_id = ?", (run_id,)))
+
+
+    def finish(self, run_id:int=None):
+        """
+        Mark run_id as finished (the next start() begins a new run).
+        """
+        from datetime import datetime, timezone
+
+        self.update(run_id, finished=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 
@@ -422,81 +2936,401 @@ def shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=Fals
 # Update all of the selling prices in the Shopify store by
 # adjusting them for the max EUR to USD exchange rate over 
 # the past 7 days.  All in memory (no local file)
-def shopify_update_product_variant_prices(verbose=True):
+def shopify_group_product_variants(product_variants=None, max_variants:int=None):
+    """
+    Groups the product variants (dicts) by their product_gid in a single pass and yields
+    (product_gid, variants) for every group, including the last one.  The variants of a product
+    must be together (like the bulk query output and the catalog snapshot).  If max_variants is
+    passed, the variants of a product with more than max_variants are yielded as sub-batches of
+    up to max_variants.
+
+    for product_gid, variants in shopify_group_product_variants(shopify_omca_iter_product_variants(), max_variants=250):
+        print(product_gid, len(variants))
+    """
+
+    from itertools import groupby
+
+    if not max_variants is None and max_variants < 1: raise Exception("max_variants must be >= 1")
+
+    for product_gid, group in groupby(product_variants, key=lambda product_variant: product_variant['product_gid']):
+        variants = list(group)
+        if max_variants is None:
+            yield product_gid, variants
+            continue
+        for i in range(0, len(variants), max_variants):
+            yield product_gid, variants[i:i + max_variants]
+
+
+def shopify_update_product_variant_prices(verbose=True, mode:str="sync", max_workers:int=8, path_snapshot:Path=None, only_changed:bool=True, price_book:SupplierPriceBook=None, rate_cache:CurrencyRateCache=None, path_dir:Path=None, max_variants_per_mutation:int=250, target_s:float=None, reserve:float=0.2, journal:ShopifyRepriceJournal=None, pipeline:bool=True, queue_size:int=16, refresh_snapshot:bool=True, client:ShopifyGraphQLClient=None):
     """
     Execute a Shopify GraphQL bulk query to update the store prices.
     The store price in USD for a product and its variants are obtained by
     getting the max EUR to USD conversion rate for the past 7 days and 
     then looking up the book price in EUR by the product SKU and adjusting
     it by the currency conversion and the markup. 
+    All of the GraphQL requests share the pooled client (or the global
+    API_TOKEN and GRAPHQL_ENDPOINT if client is None).  Up to max_workers
+    productVariantsBulkUpdate mutations are in flight at once, limited by
+    the store's rate limit (client.throttle).
+    mode="bulk" writes all of the price changes to a JSONL variables file
+    and updates the store with a single server side bulkOperationRunMutation
+    (use it for full catalog repricing; it doesn't draw down the rate limit).
+    Past the 100 MB limit of a variables file the changes are split into
+    several files, executed one after the other.
+    The bulk variables and results files are written to path_dir (default
+    the current working directory).
+    Each productVariantsBulkUpdate updates the variants of one product, up to
+    max_variants_per_mutation (a product with more is split into several
+    mutations).  Lower it for smaller payloads, raise it for fewer requests.
+    In mode "sync" the fraction reserve of the rate limit is always left to
+    other integrations (client.throttle.reserve).
+    If target_s is passed (mode "sync"), all of the prices are computed first
+    and shopify_mutation_cost_plan() chooses the batch size and the workers
+    (up to max_variants_per_mutation and max_workers) to finish within
+    target_s without using the reserve, or refuses the run (raises an
+    exception) if it can't.  If every variant is sent (only_changed=False),
+    the run is refused before the export and the pricing when even the
+    store's variant count (shopify_product_variants_count()) can't be
+    updated within target_s.
+    If path_snapshot is passed, the product variants come from the local
+    catalog snapshot (Parquet), refreshed with only the variants updated
+    since the last run, instead of a full export.  Pass refresh_snapshot=False
+    if the snapshot was just built (ex. from a full export) to use it as is.
+    If only_changed, only the variants whose price changes (compared to the
+    exported store price, to the cent) are sent.
+    If price_book (SupplierPriceBook) is passed, the book prices come from
+    the supplier price file and the variants are priced in vectorized batches
+    of about 1024 variants.  Variants whose SKU isn't in the price book are skipped.
+    The exchange rate comes from rate_cache (CurrencyRateCache), or the
+    shared in-process cache if None.
+    If journal (ShopifyRepriceJournal) is passed, every product is recorded
+    as soon as its productVariantsBulkUpdate is acknowledged.  If the previous
+    run of the same mode and store didn't finish (and isn't older than the
+    journal's max_age_s, nor started at another exchange rate), it is resumed:
+    the completed products are skipped, the same catalog snapshot is used (the
+    snapshot isn't refreshed), and an in-flight bulk operation (mode "bulk")
+    is polled by its id instead of launching a new one.  Without path_snapshot
+    the catalog is exported again, but only the unfinished products are sent.
+    If pipeline, the export (download, parse and group by product), the pricing
+    and the mutations run as concurrent stages (shopify_pipeline_stage())
+    connected by bounded queues of queue_size batches of products, so the
+    first mutations are sent while the export is still downloading and a
+    rate limited mutation stage holds back the export (backpressure).
+    The time to the first acknowledged update is recorded in client.metrics
+    as the phase "first_update".
 
     """
 
-    import os
+    import json
     from datetime import datetime, timedelta
 
     import time
     t_start_sec = time.perf_counter()
-    
 
+    if not mode in ("sync", "bulk"): raise Exception(f"Unknown mode '{mode}'.  Use 'sync' or 'bulk'")
+    if not 0.0 <= reserve < 1.0: raise Exception("reserve must be >= 0 and < 1")
+
+    client = shopify_graphql_client(client)
+
+    batch_sizes = sorted(set([batch_size for batch_size in (250, 100, 50, 25, 10) if batch_size < max_variants_per_mutation] + [max_variants_per_mutation]), reverse=True)
+    if mode == "sync" and not target_s is None and not only_changed:
+        # Refuse an infeasible run before spending the export and the pricing on it.  Every variant is sent, and the
+        # variants as one batch are the fewest mutations possible, so a run this plan refuses can't finish in time.
+        n_variants = shopify_product_variants_count(verbose=verbose, client=client)
+        shopify_mutation_cost_plan(batches=[n_variants], throttle_status=client.throttle.status(), target_s=target_s, max_workers=max_workers, batch_sizes=batch_sizes, reserve=reserve, verbose=verbose)
+    
     # Get the EUR to USD exchange rate (max over past 7 days)
     end_date = datetime.strftime(datetime.now() - timedelta(days=1), "%Y-%m-%d")        # '2018-07-15'
     start_date = datetime.strftime(datetime.now() - timedelta(days=8), "%Y-%m-%d")
-    max_eur_to_usd = currency_conversion_api("EUR","USD", start_date, end_date)
+    max_eur_to_usd = currency_conversion_api("EUR","USD", start_date, end_date, cache=rate_cache)
     if max_eur_to_usd is None: raise Exception("ERROR: currency_conversion_api()")
     if verbose: print(f"max_eur_to_usd: {max_eur_to_usd} from {start_date} to {end_date}")
 
-    # Get all of the product variants from the Shopify store.
-    product_variants = shopify_omca_get_product_variants_to_ram(return_full_gid=False, verbose=False)
-
-    # Iterate over the product variants grouped by the product_gid  (bulk query processes all variants for one parent product_gid)
-    product_gid_last = None
-    variants_count = 0
-    bulk_query_cost = 1
-    for product_variant in product_variants:
-        #print(product_variant['variant_gid'], product_variant['sku'], product_variant['product_gid'])
-        if product_gid_last is None:
-            pass
-            variants = []
-            variants.append({"sku": product_variant['sku'], "variant_gid": product_variant['variant_gid'], "product_gid": product_variant['product_gid']})
+    # Start a new run in the checkpoint journal, or resume the unfinished one of this store (at the same exchange rate).
+    run = None
+    completed = set()
+    if not journal is None:
+        run = journal.start(mode=mode, eur_to_usd=max_eur_to_usd, store=client.store_name, endpoint=client.graphql_endpoint)
+        if run['resumed']:
+            completed = journal.completed(run['run_id'])
+            print(f"Resuming run {run['run_id']} started {run['started']}:  {len(completed)} products already completed (last {run['last_product_gid']})")
+
+    if path_snapshot is None:
+        # Stream all of the product variants from the Shopify store (constant memory, pricing starts during the download).
+        # Never reuse a completed export:  only_changed compares against the store prices, so they must be current.
+        product_variants = shopify_omca_iter_product_variants(return_full_gid=False, verbose=False, client=client, max_age_s=0)
+    else:
+        if not run is None and run['resumed'] and run['snapshot'] == str(path_snapshot) and Path(path_snapshot).is_file():
+            # A resumed run uses the same snapshot (not refreshed), so the completed products match.
+            table, watermark = shopify_catalog_snapshot_load(path_snapshot)
+            if verbose: print(f"Snapshot {path_snapshot} from run {run['run_id']}.  watermark: {watermark}")
+        elif not refresh_snapshot and Path(path_snapshot).is_file():
+            # The snapshot is fresh (just built by the caller).
+            table, watermark = shopify_catalog_snapshot_load(path_snapshot)
+            if verbose: print(f"Snapshot {path_snapshot} used as is.  watermark: {watermark}")
+            if not run is None: journal.update(run['run_id'], snapshot=str(path_snapshot), watermark=watermark)
         else:
-            #product_gid_last is not None
-            if not product_variant['product_gid'] == product_gid_last:
-                pass
-                # Process variants
-                if verbose: print(f"\nProcessing {len(variants)} variants for product_gid {product_gid_last}")
-                query = "["
-                for variant in variants:
-                    #print(variant['sku'], variant['variant_gid'], variant['product_gid'])
-
+            # Export only the variants updated since the last run and merge them into the local snapshot.
+            table = shopify_catalog_snapshot_refresh(path_file=path_snapshot, verbose=verbose, client=client)
+            if not run is None: journal.update(run['run_id'], snapshot=str(path_snapshot), watermark=table.schema.metadata[b"watermark"].decode("utf-8"))
+        product_variants = shopify_catalog_snapshot_iter(table)
+    product_variants_count = 0
+    variants_skipped = 0
+    variants_not_found = 0
+    variants_resumed = 0
+
+    # With a price book, the products are priced in batches of about price_batch_variants variants:  one vectorized
+    # get_selling_prices_for_skus() call for all of the SKUs of the batch (a call per product is slower than the scalar math).
+    price_batch_variants = 1024
+
+    # Get the selling price for each variant of a batch of product groups [(product_gid, variants), ..].
+    # Yields (product_gid, variant_prices) for each product with price changes.
+    def price_products(batch):
+        nonlocal variants_skipped, variants_not_found
+        if not price_book is None:
+            skus = [variant['sku'] for product_gid, variants in batch for variant in variants]
+            # One batched lookup:  NaN (numpy) or None if the SKU isn't in the price book
+            book_prices_eur = price_book.lookup(skus)
+            if hasattr(book_prices_eur, 'tolist'): book_prices_eur = [None if book_price_eur != book_price_eur else book_price_eur for book_price_eur in book_prices_eur.tolist()]
+            selling_prices_usd = get_selling_prices_for_skus(skus=skus, book_prices_eur=[0.0 if book_price_eur is None else book_price_eur for book_price_eur in book_prices_eur], eur_to_usd=max_eur_to_usd)
+            # Python floats (indexing a numpy array one element at a time is slow)
+            if hasattr(selling_prices_usd, 'tolist'): selling_prices_usd = selling_prices_usd.tolist()
+        offset = 0
+        for product_gid, variants in batch:
+            if verbose: print(f"\nProcessing {len(variants)} variants for product_gid {product_gid}")
+            variant_prices = []
+            for i, variant in enumerate(variants, start=offset):
+                #print(variant['sku'], variant['variant_gid'], variant['product_gid'])
+
+                if not price_book is None:
+                    if book_prices_eur[i] is None:
+                        if verbose: print(f"SKU {variant['sku']} not found in the price book")
+                        variants_not_found += 1
+                        continue
+                    selling_price_usd = str(selling_prices_usd[i])
+                else:
                     # Get the selling price in USD and other data for a product SKU.
                     result = get_selling_price_for_sku(sku=variant['sku'], eur_to_usd=max_eur_to_usd)
                     selling_price_usd = str(result['selling_price_usd'])
 
-                    query += '''{id:"gid://shopify/ProductVariant/''' + variant['variant_gid'] + '''\",price:"''' + selling_price_usd + '''"},'''
-                query += "]"
-                bulk_query = '''mutation {productVariantsBulkUpdate(variants: ''' + query + ''', productId: "gid://shopify/Product/1629753868406") {userErrors {code field message}}}'''
-                print(bulk_query)
-
-                # Execute the productVariantsBulkUpdate
-                bulk_op_id = shopify_graphql_bulk_query(query=bulk_query, verbose=False)
-                # A productVariantsBulkUpdate doesn't generate a bulk_op_id.
-
-                # Poll the GraphQL endpoint until the bulk query is complete.
-                cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, wait_s=10, verbose=False)
-                if verbose: print(f"productVariantsBulkUpdate actual cost was {cost} for {len(variants)} items updated.\n")
-                variants_count += len(variants)
-                bulk_query_cost += cost
-                
-                variants = []
-            variants.append({"sku": product_variant['sku'], "variant_gid": product_variant['variant_gid'], "product_gid": product_variant['product_gid']})
-        product_gid_last = product_variant['product_gid']
+                # Only update the variants whose price changes (compared to the exported store price)
+                if only_changed and shopify_price_equal(variant['price'], selling_price_usd):
+                    variants_skipped += 1
+                    continue
+                variant_prices.append({"variant_gid": variant['variant_gid'], "price": selling_price_usd})
+            offset += len(variants)
+
+            if len(variant_prices) > 0: yield product_gid, variant_prices
+
+    # Get the selling price for each variant of each product group (product_gid, variants).
+    # Yields (product_gid, variant_prices) for each product with price changes.
+    def product_variant_prices(groups):
+        nonlocal product_variants_count, variants_resumed
+        batch = []
+        batch_variants = 0
+        for product_gid, variants in groups:
+            product_variants_count += len(variants)
+            if product_gid in completed:
+                # Already updated by the resumed run
+                variants_resumed += len(variants)
+                continue
+            batch.append((product_gid, variants))
+            batch_variants += len(variants)
+            # Without a price book each product is priced as it arrives.
+            if price_book is None or batch_variants >= price_batch_variants:
+                yield from price_products(batch)
+                batch = []
+                batch_variants = 0
+        yield from price_products(batch)
+
+    # Group the product variants by the product_gid (the bulk query output has all variants of a product together).
+    groups = shopify_group_product_variants(product_variants)
+    if pipeline:
+        # Download, parse and group in one thread, price in another, and send the mutations from this one.
+        groups = shopify_pipeline_stage(groups, maxsize=queue_size, name="export")
+        priced_groups = shopify_pipeline_stage(product_variant_prices(groups), maxsize=queue_size, name="pricing")
+    else:
+        priced_groups = product_variant_prices(groups)
+
+    first_update_s = None
+
+    def first_update():
+        nonlocal first_update_s
+        if first_update_s is None:
+            first_update_s = time.perf_counter() - t_start_sec
+            client.metrics.record("first_update", first_update_s)
+
+    # A product with more than max_variants_per_mutation changed variants is split into several mutations.
+    def product_batches(groups):
+        for product_gid, variant_prices in groups:
+            for i in range(0, len(variant_prices), max_variants_per_mutation):
+                yield product_gid, variant_prices[i:i + max_variants_per_mutation]
+
+    def mutation_variables(product_gid, variant_prices):
+        return {"productId": "gid://shopify/Product/" + product_gid, "variants": [{"id": "gid://shopify/ProductVariant/" + variant['variant_gid'], "price": variant['price']} for variant in variant_prices]}
+
+    variants_count = 0
+    bulk_query_cost = 1
+
+    if mode == "bulk":
+        # Write the variables for every productVariantsBulkUpdate (one line per product) to JSONL files of up to
+        # BULK_MUTATION_VARIABLES_MAX_BYTES, then execute each file server side with a bulkOperationRunMutation
+        # (one at a time:  a store runs one bulk mutation at a time).
+        mutation = PRODUCT_VARIANTS_BULK_UPDATE
+        if path_dir is None: path_dir = Path.cwd()
+
+        # Poll the bulk mutation bulk_op_id until it is complete, then download and count the result of each mutation.
+        # line_products and line_variants are the product_gid and the number of variants of each line of its variables file.
+        def bulk_mutation_results(bulk_op_id, line_products, line_variants):
+            nonlocal variants_count, bulk_query_cost
+            cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
+            # A completed bulk mutation without any results has no result file.
+            if url is None and not str(obj_count) == "0":
+                # Launch a new bulk operation for the unfinished products next time.
+                if not run is None: journal.set_bulk_operation(run['run_id'], bulk_op_id=None, path_file=None)
+                raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
+            bulk_query_cost += cost
+
+            products_done = {}
+            products_failed = set()
+            if not url is None:
+                # Download the result of each mutation.  Ex.  {"data":{"productVariantsBulkUpdate":{"userErrors":[]}},"__lineNumber":0}
+                path_file_results = shopify_graphql_bulk_dl_to_file(url=url, path_file=Path(path_dir).joinpath("bulk_op_results.jsonl"), verbose=verbose, client=client)
+                for result in shopify_graphql_bulk_iter_file(path_file=path_file_results, metrics=client.metrics):
+                    user_errors = []
+                    if 'data' in result and not result['data']['productVariantsBulkUpdate'] is None:
+                        user_errors = result['data']['productVariantsBulkUpdate']['userErrors']
+                    if 'errors' in result: user_errors = result['errors']
+                    if len(user_errors) > 0:
+                        print(f"ERROR: productVariantsBulkUpdate for variables line {result['__lineNumber']}")
+                        for error in user_errors:
+                            print(str(error['message']))
+                        products_failed.add(line_products[result['__lineNumber']])
+                    else:
+                        # The first price written and acknowledged (not the submit of the bulk mutation)
+                        first_update()
+                        variants_count += line_variants[result['__lineNumber']]
+                        product_gid = line_products[result['__lineNumber']]
+                        products_done[product_gid] = products_done.get(product_gid, 0) + line_variants[result['__lineNumber']]
+            if not run is None:
+                journal.products_done(run['run_id'], [(product_gid, n) for product_gid, n in products_done.items() if not product_gid in products_failed])
+                journal.set_bulk_operation(run['run_id'], bulk_op_id=None, path_file=None)
+
+        if not run is None and not run['bulk_op_id'] is None:
+            # Finish the in-flight bulk operation of the resumed run first, then skip its products like the other completed ones.
+            bulk_op_id = run['bulk_op_id']
+            path_file = Path(run['bulk_op_vars'])
+            if not path_file.is_file(): raise Exception(f"The variables file {path_file} of bulk_op_id {bulk_op_id} was not found")
+            line_products = []
+            line_variants = []
+            with open(path_file, 'r') as f:
+                for line in f:
+                    variables = json.loads(line)
+                    line_products.append(variables['productId'].split("/")[-1])
+                    line_variants.append(len(variables['variants']))
+            if verbose: print(f"Resuming bulk_op_id: {bulk_op_id} with the {len(line_variants)} productVariantsBulkUpdate variables in {path_file}")
+            bulk_mutation_results(bulk_op_id, line_products, line_variants)
+            completed.update(journal.completed(run['run_id']))
+
+        # The variables files [(path_file, line_products, line_variants)], each under the size limit.
+        parts = []
+        f = None
+        part_bytes = 0
+        try:
+            for product_gid, variant_prices in product_batches(priced_groups):
+                line = json.dumps(mutation_variables(product_gid, variant_prices)) + "\n"
+                line_bytes = len(line.encode('utf-8'))
+                if line_bytes > BULK_MUTATION_VARIABLES_MAX_BYTES: raise Exception(f"The variables of product_gid {product_gid} are {line_bytes} bytes, more than the {BULK_MUTATION_VARIABLES_MAX_BYTES} bytes allowed for a bulk mutation")
+                if f is None or part_bytes + line_bytes > BULK_MUTATION_VARIABLES_MAX_BYTES:
+                    if not f is None: f.close()
+                    path_file = Path(path_dir).joinpath("bulk_op_vars.jsonl" if len(parts) == 0 else f"bulk_op_vars.{len(parts) + 1}.jsonl")
+                    f = open(path_file, 'w')
+                    part_bytes = 0
+                    parts.append((path_file, [], []))
+                f.write(line)
+                part_bytes += line_bytes
+                parts[-1][1].append(product_gid)
+                parts[-1][2].append(len(variant_prices))
+        finally:
+            if not f is None: f.close()
+        if verbose: print(f"{sum(len(line_variants) for path_file, line_products, line_variants in parts)} productVariantsBulkUpdate variables written to {len(parts)} files")
+
+        if len(parts) == 0:
+            # No changed variants:  nothing to upload and no bulk mutation to run.
+            if verbose: print("No changed variants, no bulk mutation was run")
+        for path_file, line_products, line_variants in parts:
+            bulk_op_id = shopify_graphql_bulk_mutation(mutation=mutation, path_file=path_file, verbose=verbose, client=client)
+            if verbose: print(f"bulk_op_id: {bulk_op_id}  ({len(line_variants)} productVariantsBulkUpdate variables in {path_file})")
+            if not run is None: journal.set_bulk_operation(run['run_id'], bulk_op_id=bulk_op_id, path_file=path_file)
+            bulk_mutation_results(bulk_op_id, line_products, line_variants)
+
+    else:
+        # One productVariantsBulkUpdate mutation (the same query with its own variables) for each batch of a product's variants.
+        groups = priced_groups
+        # The cost model of the mutations (the plan's when there is one):  each mutation reserves its planned cost
+        base_cost, variant_cost = 10.0, 1.0
+        if not target_s is None:
+            # Price the whole catalog first so that the plan has every pending batch.
+            groups = list(groups)
+            plan = shopify_mutation_cost_plan(batches=[len(variant_prices) for product_gid, variant_prices in groups], throttle_status=client.throttle.status(), target_s=target_s, max_workers=max_workers, batch_sizes=batch_sizes, reserve=reserve, verbose=verbose)
+            max_variants_per_mutation = plan['max_variants_per_mutation']
+            max_workers = plan['max_workers']
+            base_cost, variant_cost = plan['base_cost'], plan['variant_cost']
+
+        # The mutations in flight and the variants updated of each product, to journal a product once all of its mutations succeed.
+        product_pending = {}
+        product_updated = {}
+        products_failed = set()
+
+        def product_mutations():
+            for product_gid, variant_prices in product_batches(groups):
+                variables = mutation_variables(product_gid, variant_prices)
+                if verbose: print(f"productVariantsBulkUpdate for product_gid {product_gid}:  {len(variant_prices)} variants")
+                product_pending[product_gid] = product_pending.get(product_gid, 0) + 1
+                yield (product_gid, len(variant_prices)), PRODUCT_VARIANTS_BULK_UPDATE, variables, shopify_mutation_cost_estimate(len(variant_prices), base_cost, variant_cost)
+
+        def mutation_done(key, user_errors, cost):
+            nonlocal variants_count, bulk_query_cost
+            product_gid, n_variants = key
+            if len(user_errors) > 0:
+                print(f"ERROR: productVariantsBulkUpdate for product_gid {product_gid}")
+                for error in user_errors:
+                    print(str(error['message']))
+                products_failed.add(product_gid)
+            else:
+                first_update()
+                variants_count += n_variants
+                product_updated[product_gid] = product_updated.get(product_gid, 0) + n_variants
+            product_pending[product_gid] -= 1
+            if product_pending[product_gid] == 0:
+                del product_pending[product_gid]
+                if not run is None and not product_gid in products_failed: journal.product_done(run['run_id'], product_gid, product_updated[product_gid])
+                product_updated.pop(product_gid, None)
+            if verbose: print(f"productVariantsBulkUpdate actual cost was {cost['actualQueryCost']} for {n_variants} items updated.\n")
+            bulk_query_cost += cost['actualQueryCost']
+
+        # Execute the productVariantsBulkUpdate mutations concurrently, as fast as the store's rate limit allows.
+        # They are synchronous (no bulk_op_id), so the userErrors and the cost are in each response and there is nothing to poll.
+        # Leave the fraction reserve of the bucket to the other integrations (with or without a plan).
+        reserve_last = client.throttle.reserve
+        client.throttle.reserve = reserve * client.throttle.maximum_available
+        try:
+            shopify_graphql_mutation_dispatcher(mutations=product_mutations(), max_workers=max_workers, callback=mutation_done, verbose=False, client=client)
+        finally:
+            client.throttle.reserve = reserve_last
+
+    if not run is None: journal.finish(run['run_id'])
 
     # Report the script execution time
     t_stop_sec = time.perf_counter()
     print('\nElapsed time {:6f} sec'.format(t_stop_sec-t_start_sec))
+    if not first_update_s is None: print('Time to first update {:6f} sec'.format(first_update_s))
 
-    print(f"The Store price for {variants_count} variants out of {len(product_variants)} were updated at a bulk query cost of {bulk_query_cost}.")
+    print(f"The Store price for {variants_count} variants out of {product_variants_count} were updated at a bulk query cost of {bulk_query_cost}.")
+    if only_changed: print(f"{variants_skipped} variants were skipped because their price didn't change.")
+    if not price_book is None: print(f"{variants_not_found} variants were skipped because their SKU isn't in the price book.")
+    if variants_resumed > 0: print(f"{variants_resumed} variants were skipped because their product was completed by the resumed run.")
+    if verbose: print("\n" + client.metrics.report())
     return variants_count
 
 
@@ -510,5 +3344,21 @@ if __name__ == '__main__':
     # All in memory (no local file). 
     shopify_update_product_variant_prices(verbose=True)
 
+    # Full catalog repricing with one server side bulkOperationRunMutation
+    # (a staged JSONL upload of the variables) instead of one mutation per product.
+    #shopify_update_product_variant_prices(verbose=True, mode="bulk")
+
+    # The book prices from the supplier price file (columns sku,book_price_eur), memory-mapped between runs.
+    #price_book = SupplierPriceBook.load_cached(path_file=Path.cwd().joinpath("supplier_prices.csv"))
+    #shopify_update_product_variant_prices(verbose=True, price_book=price_book)
+
+    # Keep the daily EUR to USD rates on disk so the next run only fetches the new days.
+    #rate_cache = CurrencyRateCache(path_file=Path.cwd().joinpath("currency_rates.json"))
+    #shopify_update_product_variant_prices(verbose=True, rate_cache=rate_cache)
+
+    # Checkpoint every completed product so that a run that dies partway through resumes where it stopped.
+    #with ShopifyRepriceJournal(path_file=Path.cwd().joinpath("reprice_journal.sqlite")) as journal:
+    #    shopify_update_product_variant_prices(verbose=True, path_snapshot=Path.cwd().joinpath("catalog_snapshot.parquet"), journal=journal)
+
 
     # ---------------------------------------------------------------------------
\ No newline at end of file
@@ -0,0 +1,748 @@
+#
+#   Written by:  Mark W Kiehl
+#   http://mechatronicsolutionsllc.com/
+#   http://www.savvysolutions.info/savvycodesolutions/
+#
+
+# Define the script version in terms of Semantic Versioning (SemVer)
+# when Git or other versioning systems are not employed.
+__version__ = "0.0.0"
+from pathlib import Path
+print("'" + Path(__file__).stem + ".py'  v" + __version__)
+
+
+# A local stand-in for the Shopify Admin GraphQL endpoint so that the bulk query and
+# update functions can be exercised (and benchmarked) without a live store.
+# Only the Python standard library is used by the server itself.
+
+
+# ---------------------------------------------------------------------------
+
+class ShopifyMockServer:
+    """
+    A local HTTP server that answers the GraphQL requests made by
+    shopify_graphql_bulk_query_update_product_variants.py:
+        bulkOperationRunQuery, the node(id:) BulkOperation poll, the JSONL result url,
+        productVariantsBulkUpdate, and stagedUploadsCreate (+ the upload) with bulkOperationRunMutation,
+        currentBulkOperation(type:) and bulkOperationCancel.
+    Like Shopify, only one bulk operation of each type (QUERY, MUTATION) runs at a time:  starting another
+    one while it is CREATED or RUNNING returns a userError.
+    webhookSubscriptionCreate is supported for the BULK_OPERATIONS_FINISH topic:  the bulk_operations/finish
+    webhook is posted to every subscribed callback url (signed with api_secret) when a bulk operation finishes.
+
+    The rate limit is a leaky bucket of maximum_available points that refills at restore_rate points/s
+    (the defaults are the standard plan, Shopify Plus is 20000 and 1000).  Every response has a realistic
+    extensions.cost (requestedQueryCost 10 for a bulk operation or a mutation plus 1 per variant, 1 for a
+    poll) and a request that doesn't fit in the bucket gets a THROTTLED error.  throttle=False disables it.
+    If bulk_objects_per_s is passed, a bulk operation is RUNNING (objectCount growing at that rate) before
+    it is COMPLETED, otherwise it completes right away.
+    The result files are written to path_dir (a temporary directory by default) and served with
+    Range / If-Range (ETag) support, so downloads can be resumed and segmented.
+    error_rate is the fraction of GraphQL requests that fail with an HTTP 502 (to exercise the retries).
+
+    with ShopifyMockServer(products=100, variants_per_product=3) as server:
+        client = ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint)
+    """
+
+    def __init__(self, products:int=100, variants_per_product:int=3, host:str="127.0.0.1", port:int=0, api_secret:str="shpss_mock", maximum_available:float=2000.0, restore_rate:float=100.0, throttle:bool=True, bulk_objects_per_s:float=None, path_dir:Path=None, error_rate:float=0.0):
+
+        from http.server import ThreadingHTTPServer
+        import threading
+        import tempfile
+        import time
+
+        self.products = products
+        self.variants_per_product = variants_per_product
+        self.request_count = {}
+        self.lock = threading.RLock()
+        # bulk operation id -> {"type": "QUERY" or "MUTATION", "query", "staged_upload_path": .., "t_created", "created_at", "object_count", "t_canceled"}
+        self.bulk_operations = {}
+        # staged upload path (key) -> uploaded file (bytes)
+        self.staged_uploads = {}
+        # webhook subscription id -> callback url (BULK_OPERATIONS_FINISH)
+        self.webhook_subscriptions = {}
+        self.api_secret = api_secret
+        # The number of variants updated by productVariantsBulkUpdate (sync and bulk)
+        self.variants_updated = 0
+
+        # The rate limit (leaky bucket)
+        self.maximum_available = float(maximum_available)
+        self.restore_rate = float(restore_rate)
+        self.throttle = throttle
+        self.currently_available = float(maximum_available)
+        # The lowest currentlyAvailable left by a request (to check that a client leaves a reserve)
+        self.min_available = float(maximum_available)
+        self.t_bucket = time.monotonic()
+        self.bulk_objects_per_s = bulk_objects_per_s
+        self.error_rate = error_rate
+
+        # The bulk operation result files
+        self.path_dir_tmp = None
+        if path_dir is None:
+            path_dir = self.path_dir_tmp = Path(tempfile.mkdtemp(prefix="shopify_mock_"))
+        self.path_dir = Path(path_dir)
+
+        self.httpd = ThreadingHTTPServer((host, port), _shopify_mock_handler(self))
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address[0], self.httpd.server_address[1]
+        self.graphql_endpoint = f"http://{self.host}:{self.port}/admin/api/2024-10/graphql.json"
+        self.thread = None
+
+
+    def start(self):
+        import threading
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        import shutil
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if not self.path_dir_tmp is None: shutil.rmtree(self.path_dir_tmp, ignore_errors=True)
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def count(self, name:str=None):
+        with self.lock:
+            self.request_count[name] = self.request_count.get(name, 0) + 1
+
+
+    def jsonl_lines(self, updated_since:str=None):
+        """
+        Yields the bulk query result (JSON lines) for the generated catalog.
+        """
+        yield from shopify_mock_catalog_lines(products=self.products, variants_per_product=self.variants_per_product, updated_since=updated_since)
+
+
+    def product_variant_errors(self, product_gid:str=None, variant_gids:list=None):
+        """
+        Returns the userErrors of a productVariantsBulkUpdate for the variants variant_gids of the product product_gid,
+        and counts the updated variants if there are none.
+        """
+        variant_id_first = 10000000000001
+        product_id = int(str(product_gid).rsplit("/", maxsplit=1)[-1]) - 1000000000000
+        user_errors = []
+        for variant_gid in variant_gids:
+            variant_id = int(str(variant_gid).rsplit("/", maxsplit=1)[-1])
+            if not 0 <= product_id < self.products or not (variant_id - variant_id_first) // self.variants_per_product == product_id:
+                user_errors.append({"field": ["variants"], "message": f"Product variant {variant_gid} does not exist on product {product_gid}"})
+        if len(variant_gids) == 0: user_errors.append({"field": ["variants"], "message": "No variants"})
+        if len(user_errors) == 0:
+            with self.lock:
+                self.variants_updated += len(variant_gids)
+        return user_errors
+
+
+    def requested_cost(self, query:str=None, variables:dict=None):
+        """
+        Returns the requestedQueryCost of the GraphQL query.
+        """
+        import re
+        if "bulkOperationRunQuery" in query or "bulkOperationRunMutation" in query or "bulkOperationCancel" in query: return 10
+        if "productVariantsBulkUpdate" in query:
+            if not variables is None: return 10 + len(variables.get("variants", []))
+            return 10 + len(re.findall(r'"gid://shopify/ProductVariant/\d+"', query))
+        if "node(id:" in query or "currentBulkOperation" in query or "productVariantsCount" in query: return 1
+        return 10
+
+
+    def throttle_status(self):
+        """
+        Returns the throttleStatus of the leaky bucket (refilled at restore_rate since the last request).
+        """
+        import time
+        with self.lock:
+            t = time.monotonic()
+            self.currently_available = min(self.maximum_available, self.currently_available + self.restore_rate * (t - self.t_bucket))
+            self.t_bucket = t
+            return {"maximumAvailable": self.maximum_available, "currentlyAvailable": int(self.currently_available), "restoreRate": self.restore_rate}
+
+
+    def graphql(self, query:str=None, variables:dict=None):
+        """
+        Returns the response (dict) for the GraphQL query and its (optional) variables,
+        or a THROTTLED (or MAX_COST_EXCEEDED) error if it doesn't fit in the rate limit.
+        """
+        requested = self.requested_cost(query, variables)
+        with self.lock:
+            throttle_status = self.throttle_status()
+            if self.throttle and requested > 1000:
+                self.count("MAX_COST_EXCEEDED")
+                return {"errors": [{"message": f"Query cost is {requested}, which exceeds the single query max cost limit (1000).", "extensions": {"code": "MAX_COST_EXCEEDED", "cost": requested, "maxCost": 1000}}], "extensions": {"cost": {"requestedQueryCost": requested, "actualQueryCost": None, "throttleStatus": throttle_status}}}
+            if self.throttle and self.currently_available < requested:
+                self.count("THROTTLED")
+                return {"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED", "documentation": "https://shopify.dev/api/usage/rate-limits"}}], "extensions": {"cost": {"requestedQueryCost": requested, "actualQueryCost": None, "throttleStatus": throttle_status}}}
+            if self.throttle:
+                self.currently_available -= requested
+                self.min_available = min(self.min_available, self.currently_available)
+            throttle_status['currentlyAvailable'] = int(self.currently_available)
+        cost = {"requestedQueryCost": requested, "actualQueryCost": requested, "throttleStatus": throttle_status}
+        return self.graphql_response(query, variables, cost)
+
+
+    def graphql_response(self, query:str=None, variables:dict=None, cost:dict=None):
+        """
+        Returns the response (dict) for the GraphQL query with the extensions.cost cost.
+        """
+        import re
+        import threading
+        import time
+        from datetime import datetime, timezone
+
+        if "bulkOperationRunQuery" in query or "bulkOperationRunMutation" in query:
+            bulk_operation_run = "bulkOperationRunMutation" if "bulkOperationRunMutation" in query else "bulkOperationRunQuery"
+            self.count(bulk_operation_run)
+            with self.lock:
+                current = self.bulk_operation_current("MUTATION" if bulk_operation_run == "bulkOperationRunMutation" else "QUERY")
+                if not current is None and current["status"] in ("CREATED", "RUNNING", "CANCELING"):
+                    self.count("bulk_operation_in_progress")
+                    return {"data": {bulk_operation_run: {"bulkOperation": None, "userErrors": [{"field": None, "message": f"A bulk {current['type'].lower()} operation for this app and shop is already in progress: {current['id']}."}]}}, "extensions": {"cost": cost}}
+                bulk_op_id = str(len(self.bulk_operations) + 1)
+                bulk_operation = {"type": "QUERY", "updated_since": None}
+                match = re.search(r"updated_at:>='([^']+)'", query)
+                if not match is None: bulk_operation["updated_since"] = match.group(1)
+                bulk_operation["object_count"] = shopify_mock_catalog_count(products=self.products, variants_per_product=self.variants_per_product, updated_since=bulk_operation["updated_since"])
+                if bulk_operation_run == "bulkOperationRunMutation":
+                    match = re.search(r'stagedUploadPath: "([^"]+)"', query)
+                    if match is None or not match.group(1) in self.staged_uploads:
+                        return {"data": {bulk_operation_run: {"bulkOperation": None, "userErrors": [{"field": ["stagedUploadPath"], "message": "The JSONL file could not be found."}]}}, "extensions": {"cost": cost}}
+                    bulk_operation = {"type": "MUTATION", "staged_upload_path": match.group(1), "object_count": self.staged_uploads[match.group(1)].count(b"\n")}
+                # The query (or the mutation) of the bulk operation, like BulkOperation.query
+                match = re.search(r'\(mutation: """(.*?)""",|\(query: """(.*?)"""\)', query, flags=re.DOTALL)
+                bulk_operation["query"] = None if match is None else (match.group(1) or match.group(2))
+                bulk_operation["t_created"] = time.monotonic()
+                bulk_operation["created_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+                bulk_operation["t_canceled"] = None
+                bulk_operation["file_lock"] = threading.Lock()
+                self.bulk_operations[bulk_op_id] = bulk_operation
+                callback_urls = list(self.webhook_subscriptions.values())
+            # Post the bulk_operations/finish webhook when the bulk operation finishes (after the response).
+            for callback_url in callback_urls:
+                threading.Timer(0.05 + self.bulk_operation_duration(bulk_op_id), shopify_mock_webhook_post, kwargs={"callback_url": callback_url, "bulk_op_id": bulk_op_id, "op_type": bulk_operation["type"].lower(), "api_secret": self.api_secret}).start()
+            return {"data": {bulk_operation_run: {"bulkOperation": {"id": "gid://shopify/BulkOperation/" + bulk_op_id, "status": "CREATED"}, "userErrors": []}}, "extensions": {"cost": cost}}
+
+        if "currentBulkOperation" in query:
+            self.count("currentBulkOperation")
+            match = re.search(r'currentBulkOperation\(type: (\w+)\)', query)
+            with self.lock:
+                return {"data": {"currentBulkOperation": self.bulk_operation_current("QUERY" if match is None else match.group(1))}, "extensions": {"cost": cost}}
+
+        if "bulkOperationCancel" in query:
+            self.count("bulkOperationCancel")
+            bulk_op_id = re.search(r'id: "gid://shopify/BulkOperation/(\d+)"', query).group(1)
+            with self.lock:
+                if not bulk_op_id in self.bulk_operations:
+                    return {"data": {"bulkOperationCancel": {"bulkOperation": None, "userErrors": [{"field": ["id"], "message": "Bulk operation does not exist"}]}}, "extensions": {"cost": cost}}
+                node = self.bulk_operation_node(bulk_op_id)
+                if not node["status"] in ("CREATED", "RUNNING"):
+                    return {"data": {"bulkOperationCancel": {"bulkOperation": {"id": node["id"], "status": node["status"]}, "userErrors": [{"field": None, "message": f"A bulk operation cannot be canceled when it is {node['status'].lower()}"}]}}, "extensions": {"cost": cost}}
+                self.bulk_operations[bulk_op_id]["t_canceled"] = time.monotonic()
+            return {"data": {"bulkOperationCancel": {"bulkOperation": {"id": node["id"], "status": "CANCELING"}, "userErrors": []}}, "extensions": {"cost": cost}}
+
+        if "webhookSubscriptionCreate" in query:
+            self.count("webhookSubscriptionCreate")
+            match = re.search(r'callbackUrl: "([^"]+)"', query)
+            with self.lock:
+                subscription_id = "gid://shopify/WebhookSubscription/" + str(len(self.webhook_subscriptions) + 1)
+                self.webhook_subscriptions[subscription_id] = match.group(1)
+            return {"data": {"webhookSubscriptionCreate": {"webhookSubscription": {"id": subscription_id, "topic": "BULK_OPERATIONS_FINISH"}, "userErrors": []}}, "extensions": {"cost": cost}}
+
+        if "webhookSubscriptionDelete" in query:
+            self.count("webhookSubscriptionDelete")
+            match = re.search(r'id: "([^"]+)"', query)
+            with self.lock:
+                self.webhook_subscriptions.pop(match.group(1), None)
+            return {"data": {"webhookSubscriptionDelete": {"deletedWebhookSubscriptionId": match.group(1), "userErrors": []}}, "extensions": {"cost": cost}}
+
+        if "stagedUploadsCreate" in query:
+            self.count("stagedUploadsCreate")
+            match = re.search(r'filename: "([^"]+)"', query)
+            key = "tmp/mock/bulk/" + str(len(self.staged_uploads) + 1) + "/" + match.group(1)
+            parameters = [{"name": "key", "value": key}, {"name": "Content-Type", "value": "text/jsonl"}, {"name": "success_action_status", "value": "201"}]
+            return {"data": {"stagedUploadsCreate": {"stagedTargets": [{"url": f"http://{self.host}:{self.port}/staged-uploads", "resourceUrl": None, "parameters": parameters}], "userErrors": []}}, "extensions": {"cost": cost}}
+
+        if "productVariantsBulkUpdate" in query:
+            self.count("productVariantsBulkUpdate")
+            if variables is None:
+                product_gid = re.search(r'productId: "([^"]+)"', query).group(1)
+                variant_gids = re.findall(r'"(gid://shopify/ProductVariant/\d+)"', query)
+            else:
+                product_gid = variables["productId"]
+                variant_gids = [variant["id"] for variant in variables["variants"]]
+            return {"data": {"productVariantsBulkUpdate": {"userErrors": self.product_variant_errors(product_gid, variant_gids)}}, "extensions": {"cost": cost}}
+
+        if "productVariantsCount" in query:
+            self.count("productVariantsCount")
+            return {"data": {"productVariantsCount": {"count": self.products * self.variants_per_product, "precision": "EXACT"}}, "extensions": {"cost": cost}}
+
+        match = re.search(r'node\(id: "gid://shopify/BulkOperation/(\d+)"\)', query)
+        if not match is None:
+            self.count("node")
+            bulk_op_id = match.group(1)
+            with self.lock:
+                if not bulk_op_id in self.bulk_operations: return {"data": {"node": None}, "extensions": {"cost": cost}}
+                return {"data": {"node": self.bulk_operation_node(bulk_op_id)}, "extensions": {"cost": cost}}
+
+        return {"errors": [{"message": "Mock server does not support the query"}]}
+
+
+    def bulk_operation_node(self, bulk_op_id:str=None):
+        """
+        Returns the BulkOperation (dict) bulk_op_id as it is now:  RUNNING (the objectCount growing at bulk_objects_per_s)
+        until it is COMPLETED, or CANCELING then CANCELED after a bulkOperationCancel.
+        """
+        import time
+        from datetime import datetime, timedelta
+
+        bulk_operation = self.bulk_operations[bulk_op_id]
+        t = time.monotonic()
+        t_running = t - bulk_operation["t_created"]
+        duration = self.bulk_operation_duration(bulk_op_id)
+        created_at = bulk_operation["created_at"]
+        node = {"id": "gid://shopify/BulkOperation/" + bulk_op_id, "type": bulk_operation["type"], "status": "COMPLETED", "errorCode": None, "objectCount": str(bulk_operation["object_count"]), "url": None, "query": bulk_operation["query"], "createdAt": created_at, "completedAt": None}
+        t_canceled = bulk_operation["t_canceled"]
+        if not t_canceled is None and t_canceled - bulk_operation["t_created"] < duration:
+            # Canceled while running (CANCELING for 0.1 s)
+            node["status"] = "CANCELING" if t - t_canceled < 0.1 else "CANCELED"
+            node["objectCount"] = str(int((t_canceled - bulk_operation["t_created"]) * self.bulk_objects_per_s))
+        elif t_running < duration:
+            # Still running:  the objectCount grows at bulk_objects_per_s
+            node["status"] = "RUNNING"
+            node["objectCount"] = str(int(t_running * self.bulk_objects_per_s))
+        else:
+            node["completedAt"] = datetime.strftime(datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ") + timedelta(seconds=duration), "%Y-%m-%dT%H:%M:%SZ")
+            if bulk_operation["object_count"] > 0: node["url"] = f"http://{self.host}:{self.port}/bulk-operation-outputs/{bulk_op_id}.jsonl"
+        return node
+
+
+    def bulk_operation_current(self, op_type:str="QUERY"):
+        """
+        Returns the BulkOperation (dict) of the latest bulk operation of op_type ("QUERY" or "MUTATION"), like currentBulkOperation, or None.
+        """
+        for bulk_op_id in sorted(self.bulk_operations, key=int, reverse=True):
+            if self.bulk_operations[bulk_op_id]["type"] == op_type: return self.bulk_operation_node(bulk_op_id)
+        return None
+
+
+    def bulk_operation_duration(self, bulk_op_id:str=None):
+        """
+        Returns the time (s) the bulk operation bulk_op_id is RUNNING.
+        """
+        if self.bulk_objects_per_s is None: return 0.0
+        return self.bulk_operations[bulk_op_id]["object_count"] / self.bulk_objects_per_s
+
+
+    def bulk_operation_lines(self, bulk_op_id:str=None):
+        """
+        Yields the JSON lines of the result file for the bulk operation bulk_op_id.
+        A bulk mutation is executed (one productVariantsBulkUpdate per line of the uploaded variables).
+        """
+        import json
+        bulk_operation = self.bulk_operations[bulk_op_id]
+        if bulk_operation["type"] == "QUERY":
+            yield from self.jsonl_lines(updated_since=bulk_operation["updated_since"])
+            return
+        variables_lines = self.staged_uploads[bulk_operation["staged_upload_path"]].decode("utf-8").splitlines()
+        for line_number, line in enumerate(variables_lines):
+            variables = json.loads(line)
+            user_errors = self.product_variant_errors(variables["productId"], [variant["id"] for variant in variables["variants"]])
+            yield json.dumps({"data": {"productVariantsBulkUpdate": {"userErrors": user_errors}}, "__lineNumber": line_number})
+
+
+    def bulk_operation_file(self, bulk_op_id:str=None):
+        """
+        Returns the result file of the bulk operation bulk_op_id, written on the first request.
+        """
+        import os
+        bulk_operation = self.bulk_operations[bulk_op_id]
+        path_file = self.path_dir.joinpath(f"bulk-{bulk_op_id}.jsonl")
+        with bulk_operation["file_lock"]:
+            if not path_file.is_file():
+                path_tmp = path_file.with_name(path_file.name + ".tmp")
+                with open(path_tmp, 'w', buffering=1024*1024) as f:
+                    for line in self.bulk_operation_lines(bulk_op_id):
+                        f.write(line + "\n")
+                os.replace(path_tmp, path_file)
+        return path_file
+
+
+def shopify_mock_price(variant_id:int=None):
+    """
+    Returns the store price (str, ex. "37.45") of the mock variant variant_id (the number of its gid).
+
+    price = shopify_mock_price(10000000000001)
+    """
+    return f"{1.0 + (int(variant_id) * 7919 % 9973) / 100.0:.2f}"
+
+
+def shopify_mock_catalog_lines(products:int=100, variants_per_product:int=3, updated_since:str=None):
+    """
+    Yields the bulk query result lines (JSON strings) of a generated catalog of products and
+    their nested variants, like the products / variants bulk query returns them.
+    Each variant was updated one second after the previous one (starting 2024-11-21T00:00:00Z).
+    The prices vary from 1.00 to 100.72 (shopify_mock_price()).
+    If updated_since is passed, only the variants updated at or after it are yielded, flat
+    (with their product id) like the productVariants(query: "updated_at:>=..") bulk query.
+    Fast enough for catalogs of millions of variants (ex. 1M products x 5 variants).
+
+    for line in shopify_mock_catalog_lines(products=2, variants_per_product=3):
+        print(line)
+    """
+    import time
+    from datetime import datetime, timezone
+    t_updated = datetime(2024, 11, 21, tzinfo=timezone.utc).timestamp()
+    variant_id = 10000000000000
+    for p in range(products):
+        product_gid = "gid://shopify/Product/" + str(1000000000000 + p)
+        if updated_since is None: yield '{"id":"' + product_gid + '"}'
+        for v in range(variants_per_product):
+            variant_id += 1
+            updated_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t_updated + variant_id - 10000000000000))
+            variant = f'{{"id":"gid://shopify/ProductVariant/{variant_id}","title":"variant {v}","sku":"SKU{p:07d}V{v:02d}","price":"{shopify_mock_price(variant_id)}","updatedAt":"{updated_at}"'
+            if updated_since is None:
+                yield variant + ',"__parentId":"' + product_gid + '"}'
+            elif updated_at >= updated_since:
+                yield variant + ',"product":{"id":"' + product_gid + '"}}'
+
+
+def shopify_mock_catalog_count(products:int=100, variants_per_product:int=3, updated_since:str=None):
+    """
+    Returns the number of lines (objects) shopify_mock_catalog_lines() yields.
+
+    obj_count = shopify_mock_catalog_count(products=1000, variants_per_product=5)
+    """
+    from datetime import datetime, timezone
+    variants = products * variants_per_product
+    if updated_since is None: return products + variants
+    t_updated = datetime(2024, 11, 21, tzinfo=timezone.utc)
+    # Variant n (1 ..) was updated n seconds after t_updated.
+    n_first = max(1, int((datetime.strptime(updated_since, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc) - t_updated).total_seconds()))
+    return max(0, variants - n_first + 1)
+
+
+def shopify_mock_catalog_file(path_file:Path=None, variants:int=1000, variants_per_product:int=5):
+    """
+    Write a generated bulk query results file (products with their nested variants) of about
+    variants variants (ex. 1000 to 5000000) to path_file and return path_file.
+
+    path_file = shopify_mock_catalog_file(path_file=Path.cwd().joinpath("catalog_1M.jsonl"), variants=1000000)
+    """
+    with open(path_file, 'w', buffering=1024*1024) as f:
+        for line in shopify_mock_catalog_lines(products=max(1, variants // variants_per_product), variants_per_product=variants_per_product):
+            f.write(line + "\n")
+    return path_file
+
+
+def _shopify_mock_handler(server:ShopifyMockServer=None):
+    """
+    Returns the BaseHTTPRequestHandler class bound to server.
+    """
+
+    from http.server import BaseHTTPRequestHandler
+    import json
+    import random
+
+    class ShopifyMockHandler(BaseHTTPRequestHandler):
+
+        # HTTP/1.1 so that the client's keep-alive connection is re-used
+        protocol_version = "HTTP/1.1"
+        # The headers and the body are separate writes.  Without TCP_NODELAY the delayed ACK adds ~40 ms per request.
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if self.path.startswith("/staged-uploads"):
+                self.staged_upload(body)
+                return
+            body = body.decode("utf-8")
+            variables = None
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                body = json.loads(body)
+                body, variables = body['query'], body.get('variables')
+            if self.headers.get('X-Shopify-Access-Token') is None:
+                self.send_json({"errors": "[API] Invalid API key or access token (unrecognized login or wrong password)"}, status=401)
+                return
+            if server.error_rate > 0.0 and random.random() < server.error_rate:
+                server.count("502")
+                data = b"<html><body><h1>502 Bad Gateway</h1></body></html>"
+                self.send_response(502)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+            self.send_json(server.graphql(body, variables=variables))
+
+        def do_GET(self):
+            import re
+            server.count("GET")
+            bulk_op_id = self.path.rsplit("/", maxsplit=1)[-1].split(".")[0]
+            if not bulk_op_id in server.bulk_operations:
+                self.send_json({"error": "Not Found"}, status=404)
+                return
+            path_file = server.bulk_operation_file(bulk_op_id)
+            size = path_file.stat().st_size
+            etag = f'"{bulk_op_id}-{size}"'
+
+            # Range:  bytes=start-end, bytes=start- or bytes=-suffix (only if If-Range matches the ETag)
+            start, end, status = 0, size - 1, 200
+            match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get('Range', ''))
+            if not match is None and self.headers.get('If-Range', etag) == etag and not match.group(1) + match.group(2) == "":
+                if match.group(1) == "":
+                    start = max(0, size - int(match.group(2)))
+                else:
+                    start = int(match.group(1))
+                    if not match.group(2) == "": end = min(end, int(match.group(2)))
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{size}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/jsonl')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(end + 1 - start))
+            if status == 206: self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            try:
+                with open(path_file, 'rb') as f:
+                    f.seek(start)
+                    remaining = end + 1 - start
+                    while remaining > 0:
+                        chunk = f.read(min(remaining, 1024*1024))
+                        if not chunk: break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped the download (ex. after a Range probe).
+                pass
+
+        def staged_upload(self, body:bytes=None):
+            # Parse the multipart form (the fields, then the file) like the staged upload storage host.
+            from email.parser import BytesParser
+            from email import policy
+            server.count("staged_upload")
+            message = BytesParser(policy=policy.default).parsebytes(b"Content-Type: " + self.headers['Content-Type'].encode("utf-8") + b"\r\n\r\n" + body)
+            fields = {}
+            for part in message.iter_parts():
+                fields[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True)
+            with server.lock:
+                server.staged_uploads[fields['key'].decode("utf-8")] = fields['file']
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def send_json(self, data:dict=None, status:int=200):
+            data = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return ShopifyMockHandler
+
+
+def shopify_mock_webhook_post(callback_url:str=None, bulk_op_id:str=None, status:str="completed", error_code:str=None, op_type:str="query", api_secret:str=None):
+    """
+    Post a bulk_operations/finish webhook payload for bulk_op_id to callback_url like Shopify does
+    (a stand-in for testing ShopifyBulkWebhookReceiver).  Returns the HTTP status of the response.
+
+    http_status = shopify_mock_webhook_post(callback_url="http://127.0.0.1:8080/webhooks/bulk_operations_finish", bulk_op_id="1", api_secret="shpss_mock")
+    """
+
+    import json
+    import hmac
+    import hashlib
+    import base64
+    import urllib.request
+    import urllib.error
+    from datetime import datetime
+
+    payload = {
+        "admin_graphql_api_id": "gid://shopify/BulkOperation/" + str(bulk_op_id),
+        "completed_at": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "created_at": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "error_code": error_code,
+        "status": status,
+        "type": op_type,
+    }
+    body = json.dumps(payload).encode("utf-8")
+
+    headers = {'Content-Type': 'application/json', 'X-Shopify-Topic': 'bulk_operations/finish'}
+    if not api_secret is None:
+        headers['X-Shopify-Hmac-Sha256'] = base64.b64encode(hmac.new(api_secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("utf-8")
+
+    request = urllib.request.Request(callback_url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+# ---------------------------------------------------------------------------
+
+
+def benchmark_update_product_variant_prices(products:int=200, variants_per_product:int=3, max_s_per_product:float=0.25, maximum_available:float=2000.0, restore_rate:float=100.0, verbose:bool=False):
+    """
+    Run shopify_update_product_variant_prices() against the local mock endpoint and
+    report the wall time per product.  Raises an exception if the time per product
+    exceeds max_s_per_product (ex. a sleep or a poll after every productVariantsBulkUpdate).
+    The mock store is throttled at maximum_available / restore_rate (the standard plan by default).
+
+    s_per_product = benchmark_update_product_variant_prices(products=200)
+    """
+
+    import time
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    with ShopifyMockServer(products=products, variants_per_product=variants_per_product, maximum_available=maximum_available, restore_rate=restore_rate) as server:
+        with update.ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint) as client:
+            t_start_sec = time.perf_counter()
+            variants_count = update.shopify_update_product_variant_prices(verbose=verbose, client=client)
+            t_elapsed_sec = time.perf_counter() - t_start_sec
+
+        mutations = server.request_count.get("productVariantsBulkUpdate", 0)
+        if not variants_count == server.variants_updated:
+            raise Exception(f"{variants_count} variants reported updated, but the store updated {server.variants_updated}")
+
+    s_per_product = t_elapsed_sec / max(mutations, 1)
+    first_update_s = client.metrics.phases.get("first_update", {}).get("latency_s")
+    print(f"{mutations} productVariantsBulkUpdate in {t_elapsed_sec:.3f} s  ({s_per_product*1000.0:.2f} ms per product, {server.request_count.get('THROTTLED', 0)} throttled, first update after {first_update_s or 0.0:.3f} s)")
+    if s_per_product > max_s_per_product:
+        raise Exception(f"Wall time per product {s_per_product:.3f} s exceeds {max_s_per_product} s")
+
+    return s_per_product
+
+
+
+def benchmark_suite(sizes=(1000, 10000, 100000, 1000000), variants_per_product:int=5, sync_max_variants:int=10000, maximum_available:float=20000.0, restore_rate:float=1000.0, bulk_objects_per_s:float=None, trace_memory:bool=True, verbose:bool=False):
+    """
+    End to end benchmark against the mock store for generated catalogs of each size in sizes (variants,
+    up to 5000000):  the streamed bulk export, the repricing with one bulk mutation ("bulk"), and the
+    repricing with productVariantsBulkUpdate mutations ("sync", only up to sync_max_variants variants).
+    The mock store is throttled at maximum_available / restore_rate (Shopify Plus by default).
+    Reports the wall time, the throughput (variants/s), the memory high-water mark (the tracemalloc peak
+    of the process, which includes the mock server's buffers) and the GraphQL cost and time of each phase
+    (client.metrics).  Returns a list of result dicts.
+
+    results = benchmark_suite(sizes=(1000, 10000, 100000))
+    """
+
+    import time
+    import tempfile
+    import tracemalloc
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    runs = {
+        "export": lambda client, path_dir: sum(1 for product_variant in update.shopify_omca_iter_product_variants(client=client)),
+        "bulk": lambda client, path_dir: update.shopify_update_product_variant_prices(verbose=False, mode="bulk", path_dir=path_dir, client=client),
+        "sync": lambda client, path_dir: update.shopify_update_product_variant_prices(verbose=False, mode="sync", max_workers=16, client=client),
+    }
+
+    results = []
+    for variants in sizes:
+        products = max(1, variants // variants_per_product)
+        with ShopifyMockServer(products=products, variants_per_product=variants_per_product, maximum_available=maximum_available, restore_rate=restore_rate, bulk_objects_per_s=bulk_objects_per_s) as server, tempfile.TemporaryDirectory() as path_dir:
+            for name, run in runs.items():
+                if name == "sync" and products * variants_per_product > sync_max_variants: continue
+                throttled = server.request_count.get("THROTTLED", 0)
+                with update.ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint, pool_maxsize=16) as client:
+                    if trace_memory: tracemalloc.start()
+                    t_start_sec = time.perf_counter()
+                    n = run(client, Path(path_dir))
+                    t_elapsed_sec = time.perf_counter() - t_start_sec
+                    peak_mb = None
+                    if trace_memory:
+                        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+                        tracemalloc.stop()
+
+                phases = {phase: {"count": values['count'], "latency_s": values['latency_s'], "bytes": values['bytes'], "objects": values['objects'], "cost": values['cost']} for phase, values in client.metrics.phases.items()}
+                result = {"variants": products * variants_per_product, "run": name, "count": n, "wall_s": t_elapsed_sec, "variants_per_s": products * variants_per_product / t_elapsed_sec, "peak_mb": peak_mb, "cost": sum(phase['cost'] for phase in phases.values()), "throttled": server.request_count.get("THROTTLED", 0) - throttled, "phases": phases}
+                results.append(result)
+                if verbose: print(f"\n{name} {result['variants']} variants\n" + client.metrics.report())
+
+    print(f"\n{'variants':>10} {'run':<8} {'wall s':>9} {'variants/s':>11} {'peak MB':>9} {'cost':>10} {'throttled':>10}")
+    for result in results:
+        peak_mb = "" if result['peak_mb'] is None else f"{result['peak_mb']:.1f}"
+        print(f"{result['variants']:>10} {result['run']:<8} {result['wall_s']:>9.3f} {result['variants_per_s']:>11,.0f} {peak_mb:>9} {result['cost']:>10.0f} {result['throttled']:>10}")
+
+    return results
+
+
+def benchmark_json_decoders(lines:int=1000000, variants_per_product:int=3, path_file:Path=None):
+    """
+    Parse a generated bulk query results file of lines JSON lines with each JSON decoder backend
+    installed (json, orjson, msgspec, and msgspec into the typed ProductVariant struct) and
+    report the lines per second.  Returns {decoder: lines per second}.
+    The fixture file is generated once (in the temporary directory by default) and re-used.
+
+    results = benchmark_json_decoders(lines=1000000)
+    """
+
+    import time
+    import tempfile
+    import importlib.util
+
+    import shopify_graphql_bulk_query_update_product_variants as bulk
+
+    if path_file is None: path_file = Path(tempfile.gettempdir()).joinpath(f"shopify_bulk_fixture_{lines}.jsonl")
+    if not path_file.is_file():
+        print(f"Generating {lines} lines in {path_file} ..")
+        with open(path_file, 'w', buffering=1024*1024) as f:
+            for line in shopify_mock_catalog_lines(products=lines // (1 + variants_per_product), variants_per_product=variants_per_product):
+                f.write(line + "\n")
+
+    decoders = {"json": bulk.shopify_json_decoder(backend="json")}
+    if not importlib.util.find_spec("orjson") is None: decoders["orjson"] = bulk.shopify_json_decoder(backend="orjson")
+    if not importlib.util.find_spec("msgspec") is None:
+        decoders["msgspec"] = bulk.shopify_json_decoder(backend="msgspec")
+        decoders["msgspec ProductVariant"] = bulk.shopify_json_decoder(struct="ProductVariant")
+
+    results = {}
+    for name, decoder in decoders.items():
+        t_start_sec = time.perf_counter()
+        n = 0
+        for line in bulk.shopify_graphql_bulk_iter_file(path_file=path_file, decoder=decoder):
+            n += 1
+        t_elapsed_sec = time.perf_counter() - t_start_sec
+        results[name] = n / t_elapsed_sec
+        print(f"{name:24s} {n} lines in {t_elapsed_sec:7.3f} s  ({results[name]:12,.0f} lines/s)")
+
+    return results
+
+
+
+if __name__ == '__main__':
+    pass
+
+    # Measure the per product wall time of the price update against the local mock endpoint.
+    benchmark_update_product_variant_prices(products=200, variants_per_product=3)
+
+    # Compare the JSON decoder backends on a generated 1M line bulk query results file.
+    #benchmark_json_decoders(lines=1000000)
+
+    # Export and reprice generated catalogs from 1k to 1M variants (add 5000000 for the largest stores).
+    #benchmark_suite(sizes=(1000, 10000, 100000, 1000000))
+
+    # ---------------------------------------------------------------------------
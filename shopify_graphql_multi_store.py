@@ -0,0 +1,201 @@
+#
+#   Written by:  Mark W Kiehl
+#   http://mechatronicsolutionsllc.com/
+#   http://www.savvysolutions.info/savvycodesolutions/
+#
+
+# Define the script version in terms of Semantic Versioning (SemVer)
+# when Git or other versioning systems are not employed.
+__version__ = "0.0.0"
+from pathlib import Path
+print("'" + Path(__file__).stem + ".py'  v" + __version__)
+
+
+# Run the bulk export, poll, download and repricing of
+# shopify_graphql_bulk_query_update_product_variants.py for many Shopify stores at once.
+# Each store gets its own ShopifyGraphQLClient (connection pool and rate limit throttle),
+# the stores run concurrently in threads (they mostly wait on the network), and the
+# CPU bound parsing of the downloaded bulk query results runs in a process pool.
+# The total wall time is set by the slowest store instead of the sum of all of them.
+
+
+# ---------------------------------------------------------------------------
+
+def shopify_store_configs_load(path_file:Path=None):
+    """
+    Returns the list of store configs from the JSON file path_file.  Each store config is a dict with:
+        store_name      The store name (required)
+        api_token       The Admin API access token, or
+        api_token_env   the name of the environment variable with the access token
+        graphql_ver     (optional) Ex. "2024-10"
+        graphql_endpoint (optional) Ex. "https://my-store-name.myshopify.com/admin/api/2024-10/graphql.json"
+
+    stores = shopify_store_configs_load(path_file=Path.cwd().joinpath("stores.json"))
+    """
+
+    import os
+    import json
+
+    if not Path(path_file).is_file(): raise Exception(f"File not found {path_file}")
+    with open(path_file, 'r') as f:
+        stores = json.load(f)
+
+    for store in stores:
+        if not 'store_name' in store: raise Exception(f"store_name missing from store config {store}")
+        if not 'api_token' in store:
+            if not 'api_token_env' in store: raise Exception(f"api_token or api_token_env missing for store {store['store_name']}")
+            store['api_token'] = os.environ.get(store['api_token_env'])
+            if store['api_token'] is None: raise Exception(f"Environment variable {store['api_token_env']} not set for store {store['store_name']}")
+
+    return stores
+
+
+def shopify_store_client(store:dict=None, pool_maxsize:int=10):
+    """
+    Returns a new ShopifyGraphQLClient (its own connection pool and throttle) for the store config store.
+
+    client = shopify_store_client({"store_name": "my-store-name", "api_token": "shpat_xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx"})
+    """
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    return update.ShopifyGraphQLClient(store_name=store['store_name'], api_token=store.get('api_token'), graphql_ver=store.get('graphql_ver'), graphql_endpoint=store.get('graphql_endpoint'), pool_maxsize=pool_maxsize)
+
+
+def shopify_store_export_to_file(path_file:Path=None, verbose:bool=False, client=None):
+    """
+    Run the full products bulk query for the store of client, download the result to path_file, and return
+    (path_file, watermark), where the watermark is the start of the export (less 5 minutes), or (None, watermark)
+    if the store has no products.  A running (or just completed) export of the store is reattached to
+    (shopify_graphql_bulk_query_reattach()), so a restart doesn't start the export again.
+
+    path_file, watermark = shopify_store_export_to_file(path_file=Path.cwd().joinpath("my-store-name.jsonl"), client=client)
+    """
+
+    from datetime import datetime, timedelta, timezone
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    query = "{products {edges {node {id variants {edges {node {id title sku price updatedAt}}}}}}}"
+    bulk_query = '''mutation {bulkOperationRunQuery(query: \"\"\"''' + query + '''\"\"\") {bulkOperation {id status} userErrors {field message}}}'''
+
+    bulk_op_id, created_at = update.shopify_graphql_bulk_query_reattach(query=bulk_query, verbose=False, client=client)
+    if verbose: print(f"{client.store_name} bulk_op_id: {bulk_op_id}")
+
+    # Anything updated after the export starts (less a margin for clock differences) is exported next time.
+    watermark = datetime.strftime(datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc) - timedelta(minutes=5), "%Y-%m-%dT%H:%M:%SZ")
+
+    cost, obj_count, url = update.shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, verbose=False, client=client)
+    if verbose: print(f"{client.store_name} bulk query actual cost was {cost} for {obj_count} items.")
+    if url is None:
+        # A completed bulk query without any objects has no result file.
+        if str(obj_count) == "0": return None, watermark
+        raise Exception(f"shopify_graphql_bulk_poll() error for bulk_op_id {bulk_op_id}")
+
+    path_file = update.shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, verbose=False, client=client)
+    return path_file, watermark
+
+
+def shopify_multi_store_update_store(store:dict=None, path_dir:Path=None, parse_pool=None, full_refresh:bool=False, mode:str="sync", max_workers:int=8, price_book=None, rate_cache=None, verbose:bool=False):
+    """
+    Update the prices of one store (see shopify_multi_store_update_prices()) and return its result dict.
+    The first time (or if full_refresh) the store's catalog is exported to a file and parsed into the
+    store's catalog snapshot in parse_pool (a concurrent.futures.ProcessPoolExecutor, or in this thread if None),
+    which is then used as is.  After that, only the variants updated since the snapshot's watermark are exported.
+    Each product update is checkpointed in the store's journal path_dir/<store_name>/reprice_journal.sqlite,
+    so an interrupted store resumes where it stopped.
+    """
+
+    import time
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    t_start_sec = time.perf_counter()
+    store_name = store['store_name']
+    result = {"store_name": store_name, "variants_count": None, "elapsed_s": None, "error": None}
+
+    path_dir_store = Path(path_dir).joinpath(store_name)
+    path_dir_store.mkdir(parents=True, exist_ok=True)
+    path_snapshot = path_dir_store.joinpath("catalog_snapshot.parquet")
+
+    try:
+        with shopify_store_client(store, pool_maxsize=max(10, max_workers)) as client, update.ShopifyRepriceJournal(path_file=path_dir_store.joinpath("reprice_journal.sqlite")) as journal:
+
+            # False once the snapshot was just built from a full export (no incremental export needed)
+            refresh_snapshot = True
+            if full_refresh or not path_snapshot.is_file():
+                path_file, watermark = shopify_store_export_to_file(path_file=path_dir_store.joinpath("products.jsonl"), verbose=verbose, client=client)
+                if not path_file is None:
+                    if parse_pool is None:
+                        n_variants = update.shopify_catalog_snapshot_from_file(path_file=path_file, path_snapshot=path_snapshot, watermark=watermark)
+                    else:
+                        n_variants = parse_pool.submit(update.shopify_catalog_snapshot_from_file, path_file, path_snapshot, watermark).result()
+                    if verbose: print(f"{store_name} snapshot has {n_variants} product variants")
+                    refresh_snapshot = False
+
+            result['variants_count'] = update.shopify_update_product_variant_prices(verbose=verbose, mode=mode, max_workers=max_workers, path_snapshot=path_snapshot, price_book=price_book, rate_cache=rate_cache, path_dir=path_dir_store, journal=journal, refresh_snapshot=refresh_snapshot, client=client)
+
+    except Exception as e:
+        # One failing store doesn't stop the others.
+        result['error'] = str(e)
+        print(f"ERROR: store {store_name}  {e}")
+
+    result['elapsed_s'] = time.perf_counter() - t_start_sec
+    return result
+
+
+def shopify_multi_store_update_prices(stores:list=None, path_dir:Path=None, max_stores:int=None, parse_processes:int=None, full_refresh:bool=False, mode:str="sync", max_workers:int=8, price_book=None, rate_cache=None, verbose:bool=False):
+    """
+    Update the store prices (shopify_update_product_variant_prices()) of every store config in stores concurrently
+    (up to max_stores at once, default all of them) and return the list of results
+    [{"store_name", "variants_count", "elapsed_s", "error"}] in the order of stores.
+    Each store keeps its catalog snapshot and bulk files in path_dir/<store_name>/ (default the current working directory).
+    The bulk query results are parsed in a pool of parse_processes processes (default the number of CPUs).
+    The price_book (SupplierPriceBook) and rate_cache (CurrencyRateCache) are shared by all of the stores,
+    so the exchange rate is only fetched once.
+
+    stores = shopify_store_configs_load(path_file=Path.cwd().joinpath("stores.json"))
+    results = shopify_multi_store_update_prices(stores=stores, path_dir=Path.cwd().joinpath("stores"))
+    """
+
+    import time
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+    import shopify_graphql_bulk_query_update_product_variants as update
+
+    if stores is None or len(stores) == 0: raise Exception("Argument 'stores' not passed to function")
+    if len(set(store['store_name'] for store in stores)) < len(stores): raise Exception("The store names are not unique")
+    if path_dir is None: path_dir = Path.cwd()
+    if rate_cache is None: rate_cache = update.currency_rate_cache()
+
+    t_start_sec = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=parse_processes) as parse_pool:
+        with ThreadPoolExecutor(max_workers=max_stores or len(stores)) as executor:
+            futures = [executor.submit(shopify_multi_store_update_store, store, path_dir, parse_pool, full_refresh, mode, max_workers, price_book, rate_cache, verbose) for store in stores]
+            results = [future.result() for future in futures]
+
+    t_elapsed_sec = time.perf_counter() - t_start_sec
+
+    print(f"\n{len(stores)} stores updated in {t_elapsed_sec:.3f} s  (sum of the store times {sum(result['elapsed_s'] for result in results):.3f} s)")
+    for result in results:
+        if result['error'] is None:
+            print(f"{result['store_name']}:  {result['variants_count']} variants updated in {result['elapsed_s']:.3f} s")
+        else:
+            print(f"{result['store_name']}:  ERROR {result['error']}")
+
+    return results
+
+
+
+if __name__ == '__main__':
+    pass
+
+
+    # Update the selling prices of all of the stores in stores.json (concurrently).
+    # Ex. stores.json:  [{"store_name": "my-store-name", "api_token_env": "MY_STORE_NAME_API_TOKEN"}, ...]
+    #stores = shopify_store_configs_load(path_file=Path.cwd().joinpath("stores.json"))
+    #results = shopify_multi_store_update_prices(stores=stores, path_dir=Path.cwd().joinpath("stores"))
+
+
+    # ---------------------------------------------------------------------------
@@ -0,0 +1,615 @@
+"""
+Regression tests against the local mock store (shopify_graphql_mock_server.ShopifyMockServer).
+
+python -m pytest -q tests
+"""
+
+import json
+import time
+
+import pytest
+import requests
+
+from shopify_graphql_mock_server import ShopifyMockServer, shopify_mock_price, shopify_mock_catalog_lines
+from shopify_graphql_bulk_query_update_product_variants import (ShopifyGraphQLClient, ShopifyMetrics, ShopifyRetryPolicy, ShopifyRepriceJournal, SupplierPriceBook, shopify_update_product_variant_prices,
+    shopify_group_product_variants, shopify_graphql_bulk_reassemble, shopify_graphql_bulk_query, shopify_graphql_bulk_poll, shopify_graphql_bulk_dl_to_file,
+    shopify_graphql_bulk_cancel, shopify_graphql_bulk_query_reattach, shopify_json_decoder, shopify_graphql_bulk_file_chunks, shopify_graphql_bulk_parse_file,
+    shopify_catalog_snapshot_refresh, shopify_catalog_snapshot_save, CurrencyRateCache)
+
+
+PRODUCTS_BULK_QUERY = 'mutation {bulkOperationRunQuery(query: """{products {edges {node {id variants {edges {node {id title sku price updatedAt}}}}}}}""") {bulkOperation {id status} userErrors {field message}}}'
+
+# The markup and the (stub) EUR to USD rate of the selling prices
+SELLING_FACTOR = 1.06 * (1.0 + 0.6)
+
+
+def mock_price_book(server:ShopifyMockServer=None, changed=None):
+    """
+    Returns a SupplierPriceBook for every SKU of the mock catalog.  The selling price of a variant is its store
+    price, unless changed(i) is True for its index i in the catalog (then it is about 1.70 higher).
+    """
+    skus = []
+    prices = []
+    for p in range(server.products):
+        for v in range(server.variants_per_product):
+            i = p * server.variants_per_product + v
+            book_price_eur = float(shopify_mock_price(10000000000001 + i)) / SELLING_FACTOR
+            if not changed is None and changed(i): book_price_eur += 1.0
+            skus.append(f"SKU{p:07d}V{v:02d}")
+            prices.append(book_price_eur)
+    return SupplierPriceBook(skus=skus, prices=prices)
+
+
+def mock_client(server:ShopifyMockServer=None):
+    return ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint)
+
+
+# ---------------------------------------------------------------------------
+
+@pytest.fixture
+def small_bucket_store():
+    # Every productVariantsBulkUpdate of 200 variants costs 210, so only 2 fit in the bucket at once
+    with ShopifyMockServer(products=12, variants_per_product=200, maximum_available=500, restore_rate=500) as server:
+        yield server
+
+
+def test_dispatcher_reserves_the_mutation_cost(small_bucket_store):
+    """
+    The dispatcher reserves each mutation's cost (not the last response's cost), so it is never THROTTLED.
+    """
+    server = small_bucket_store
+    with mock_client(server) as client:
+        variants_count = shopify_update_product_variant_prices(client=client)
+    assert variants_count == server.variants_updated
+    assert variants_count > 0
+    assert server.request_count.get("THROTTLED", 0) == 0
+
+
+@pytest.mark.parametrize("mode", ["sync", "bulk"])
+def test_only_changed_variants_are_updated(mode, tmp_path):
+    """
+    Only the variants whose selling price differs from the (varied) store price are updated, and the count
+    reported matches the variants the store updated.
+    """
+    with ShopifyMockServer(products=40, variants_per_product=3) as server:
+        price_book = mock_price_book(server, changed=lambda i: i % 3 == 0)
+        with mock_client(server) as client:
+            variants_count = shopify_update_product_variant_prices(verbose=False, mode=mode, price_book=price_book, path_dir=tmp_path, client=client)
+    assert variants_count == 40
+    assert server.variants_updated == variants_count
+
+
+def test_bulk_mutation_without_changed_variants(tmp_path):
+    """
+    A bulk run without any changed variants neither uploads variables nor runs a bulk mutation.
+    """
+    # No SKU of the mock catalog is in the price book, so no variant is repriced
+    price_book = SupplierPriceBook(skus=["NOT-IN-THE-CATALOG"], prices=[1.0])
+    with ShopifyMockServer(products=5, variants_per_product=3) as server:
+        with mock_client(server) as client:
+            variants_count = shopify_update_product_variant_prices(mode="bulk", price_book=price_book, path_dir=tmp_path, client=client)
+    assert variants_count == 0
+    assert server.request_count.get("stagedUploadsCreate", 0) == 0
+    assert server.request_count.get("bulkOperationRunMutation", 0) == 0
+
+
+def test_group_product_variants_flushes_the_last_group():
+    """
+    The last product's variants are yielded too (also when they are split by max_variants).
+    """
+    product_variants = [{"product_gid": product_gid, "variant_gid": str(i)} for i, product_gid in enumerate(["1", "1", "2", "3", "3", "3"])]
+    groups = list(shopify_group_product_variants(iter(product_variants)))
+    assert [(product_gid, len(variants)) for product_gid, variants in groups] == [("1", 2), ("2", 1), ("3", 3)]
+    groups = list(shopify_group_product_variants(iter(product_variants), max_variants=2))
+    assert [(product_gid, len(variants)) for product_gid, variants in groups] == [("1", 2), ("2", 1), ("3", 2), ("3", 1)]
+    assert list(shopify_group_product_variants(iter([]))) == []
+
+
+def test_bulk_reassemble_nested():
+    """
+    The flat bulk query lines are nested again at every depth, and the last top level object is yielded.
+    """
+    lines = [
+        {"id": "gid://shopify/Product/1"},
+        {"id": "gid://shopify/ProductVariant/11", "__parentId": "gid://shopify/Product/1"},
+        {"id": "gid://shopify/InventoryLevel/111", "__parentId": "gid://shopify/ProductVariant/11"},
+        {"id": "gid://shopify/InventoryLevel/112", "__parentId": "gid://shopify/ProductVariant/11"},
+        {"id": "gid://shopify/ProductVariant/12", "__parentId": "gid://shopify/Product/1"},
+        {"id": "gid://shopify/Product/2"},
+        {"id": "gid://shopify/ProductVariant/21", "__parentId": "gid://shopify/Product/2"},
+        {"id": "gid://shopify/InventoryLevel/211", "__parentId": "gid://shopify/ProductVariant/21"},
+    ]
+    products = list(shopify_graphql_bulk_reassemble(iter(lines), child_keys={"ProductVariant": "variants", "InventoryLevel": "levels"}))
+    assert [product['id'] for product in products] == ["gid://shopify/Product/1", "gid://shopify/Product/2"]
+    assert [variant['id'] for variant in products[0]['variants']] == ["gid://shopify/ProductVariant/11", "gid://shopify/ProductVariant/12"]
+    assert [level['id'] for level in products[0]['variants'][0]['levels']] == ["gid://shopify/InventoryLevel/111", "gid://shopify/InventoryLevel/112"]
+    assert not 'levels' in products[0]['variants'][1]
+    assert [level['id'] for level in products[1]['variants'][0]['levels']] == ["gid://shopify/InventoryLevel/211"]
+    assert all(not '__parentId' in variant for product in products for variant in product['variants'])
+    # The lines themselves are not modified
+    assert lines[1]['__parentId'] == "gid://shopify/Product/1"
+    assert not 'variants' in lines[0]
+
+
+def test_bulk_reassemble_typed_structs():
+    """
+    The lines of the typed (msgspec.Struct) decoder are reassembled like the dicts of the json decoder.
+    """
+    pytest.importorskip("msgspec")
+    lines = list(shopify_mock_catalog_lines(products=20, variants_per_product=3))
+    loads_struct = shopify_json_decoder(struct="ProductVariant")
+    products = list(shopify_graphql_bulk_reassemble((loads_struct(line) for line in lines), child_keys={"ProductVariant": "variants"}))
+    expected = list(shopify_graphql_bulk_reassemble((json.loads(line) for line in lines), child_keys={"ProductVariant": "variants"}))
+    assert len(products) == 20
+    for product, product_expected in zip(products, expected):
+        assert product['id'] == product_expected['id']
+        assert [(variant['id'], variant['sku'], variant['price']) for variant in product['variants']] == [(variant['id'], variant['sku'], variant['price']) for variant in product_expected['variants']]
+        assert all(not '__parentId' in variant for variant in product['variants'])
+
+
+def test_journal_resume(tmp_path):
+    """
+    A run that dies partway through resumes from the journal:  the completed products are skipped and
+    every product is updated.
+    """
+
+    class CrashingJournal(ShopifyRepriceJournal):
+        products = 0
+        def products_done(self, run_id=None, products=None):
+            super().products_done(run_id, products)
+            CrashingJournal.products += 1
+            if CrashingJournal.products == 10: raise KeyboardInterrupt("crash")
+
+    path_journal = tmp_path.joinpath("reprice_journal.sqlite")
+    path_snapshot = tmp_path.joinpath("catalog_snapshot.parquet")
+    with ShopifyMockServer(products=40, variants_per_product=3) as server:
+        price_book = mock_price_book(server, changed=lambda i: True)
+        with mock_client(server) as client:
+            with CrashingJournal(path_file=path_journal) as journal:
+                with pytest.raises(KeyboardInterrupt):
+                    shopify_update_product_variant_prices(verbose=False, max_workers=1, path_snapshot=path_snapshot, price_book=price_book, journal=journal, client=client)
+                run = journal.run(1)
+                completed = journal.completed(run['run_id'])
+            assert run['finished'] is None
+            assert len(completed) == 10
+
+            with ShopifyRepriceJournal(path_file=path_journal) as journal:
+                variants_count = shopify_update_product_variant_prices(verbose=False, path_snapshot=path_snapshot, price_book=price_book, journal=journal, client=client)
+                run = journal.run(1)
+    assert variants_count == (40 - 10) * 3
+    assert run['finished'] is not None
+    assert run['products_done'] == 40
+    assert server.variants_updated == 40 * 3
+
+
+class InterruptedResponse:
+    """
+    Wraps a streamed requests response whose connection drops after chunks chunks.
+    """
+    def __init__(self, response, chunks:int=2):
+        self.response = response
+        self.chunks = chunks
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __enter__(self):
+        self.response.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.response.__exit__(*args)
+
+    def iter_content(self, chunk_size:int=None):
+        for i, chunk in enumerate(self.response.iter_content(chunk_size=chunk_size)):
+            if i == self.chunks: raise requests.exceptions.ConnectionError("connection dropped")
+            yield chunk
+
+
+@pytest.fixture
+def bulk_result():
+    """
+    Yields the mock server, a client, the url of a products bulk query result and its content.
+    """
+    with ShopifyMockServer(products=2000, variants_per_product=3) as server:
+        with mock_client(server) as client:
+            bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+            cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, client=client)
+            with client.get(url) as response:
+                content = response.content
+            yield server, client, url, content
+
+
+def test_download_range_resume(bulk_result, tmp_path):
+    """
+    An interrupted download resumes from the end of its .part file with a Range request (also after a restart).
+    """
+    server, client, url, content = bulk_result
+    path_file = tmp_path.joinpath("products.jsonl")
+    get = client.get
+    requests_headers = []
+
+    def get_interrupted(url, **kwargs):
+        return InterruptedResponse(get(url, **kwargs))
+
+    client.get = get_interrupted
+    with pytest.raises(Exception, match="FAILED"):
+        shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, client=client, chunk_size=64*1024, retries=0)
+    offset = tmp_path.joinpath("products.jsonl.part").stat().st_size
+    assert 0 < offset < len(content)
+    assert json.loads(tmp_path.joinpath("products.jsonl.part.json").read_text())['total'] == len(content)
+
+    def get_recorded(url, **kwargs):
+        requests_headers.append(kwargs.get('headers', {}))
+        return get(url, **kwargs)
+
+    client.get = get_recorded
+    shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, client=client, chunk_size=64*1024)
+    assert [headers.get('Range') for headers in requests_headers] == [f"bytes={offset}-"]
+    assert path_file.read_bytes() == content
+    assert not tmp_path.joinpath("products.jsonl.part").exists()
+
+
+def test_segmented_download_failure_deletes_the_part_file(bulk_result, tmp_path):
+    """
+    A failed segmented download doesn't leave a zero-filled .part file (or its meta) behind.
+    """
+    server, client, url, content = bulk_result
+    path_file = tmp_path.joinpath("products.jsonl")
+    get = client.get
+
+    def get_failing(url, **kwargs):
+        if kwargs.get('headers', {}).get('Range', '').startswith("bytes=0-0"): return get(url, **kwargs)
+        raise requests.exceptions.ConnectionError("connection refused")
+
+    client.get = get_failing
+    with pytest.raises(Exception, match="FAILED"):
+        shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, client=client, segments=4, retries=0)
+    assert not tmp_path.joinpath("products.jsonl.part").exists()
+    assert not tmp_path.joinpath("products.jsonl.part.json").exists()
+
+    client.get = get
+    shopify_graphql_bulk_dl_to_file(url=url, path_file=path_file, client=client, segments=4)
+    assert path_file.read_bytes() == content
+
+
+def test_sync_run_leaves_the_reserve():
+    """
+    Without target_s, the mutations still leave the fraction reserve of the bucket to the other integrations.
+    """
+    # Every productVariantsBulkUpdate of 100 variants costs 110:  4 fit in the half of the bucket above the reserve
+    with ShopifyMockServer(products=20, variants_per_product=100, maximum_available=1000, restore_rate=1000) as server:
+        with mock_client(server) as client:
+            variants_count = shopify_update_product_variant_prices(verbose=False, reserve=0.5, client=client)
+            assert client.throttle.reserve == 0.0
+    assert variants_count == server.variants_updated
+    assert variants_count > 0
+    # The client's bucket estimate can lag the store's by the cost of a small request or two.
+    assert server.min_available >= 500 - 20
+    assert server.request_count.get("THROTTLED", 0) == 0
+
+
+def test_infeasible_run_is_refused_before_the_export():
+    """
+    A run that can't send every variant within target_s is refused from the store's variant count,
+    before the export and the pricing.
+    """
+    with ShopifyMockServer(products=200, variants_per_product=100, maximum_available=1000, restore_rate=50) as server:
+        with mock_client(server) as client:
+            with pytest.raises(Exception, match="Refusing the run"):
+                shopify_update_product_variant_prices(verbose=False, only_changed=False, target_s=1.0, client=client)
+    assert server.request_count.get("productVariantsCount", 0) == 1
+    assert server.request_count.get("bulkOperationRunQuery", 0) == 0
+    assert server.request_count.get("productVariantsBulkUpdate", 0) == 0
+
+
+def test_reprice_does_not_reuse_a_completed_export(tmp_path):
+    """
+    The reprice exports the current store prices:  a completed export of the same query is not reused.
+    """
+    with ShopifyMockServer(products=20, variants_per_product=3) as server:
+        price_book = mock_price_book(server, changed=lambda i: i % 2 == 0)
+        with mock_client(server) as client:
+            shopify_update_product_variant_prices(verbose=False, price_book=price_book, client=client)
+            shopify_update_product_variant_prices(verbose=False, price_book=price_book, client=client)
+    assert server.request_count.get("bulkOperationRunQuery", 0) == 2
+
+
+def test_reattach_waits_for_a_canceling_bulk_query():
+    """
+    A bulk query that is already CANCELING is waited for, not canceled again, before the new one starts.
+    """
+    with ShopifyMockServer(products=1000, variants_per_product=3, bulk_objects_per_s=100.0) as server:
+        with mock_client(server) as client:
+            bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+            assert shopify_graphql_bulk_cancel(bulk_op_id=bulk_op_id, wait=False, client=client) == "CANCELING"
+            bulk_op_id_new, created_at = shopify_graphql_bulk_query_reattach(query=PRODUCTS_BULK_QUERY, client=client)
+    assert not bulk_op_id_new == bulk_op_id
+    assert server.request_count.get("bulkOperationCancel", 0) == 1
+    assert server.request_count.get("bulk_operation_in_progress", 0) == 0
+
+
+def test_retry_transient_errors():
+    """
+    HTTP 502 errors (the mock store's error injection) are retried with a backoff until the request succeeds.
+    """
+    retry = ShopifyRetryPolicy(retries=20, backoff_min_s=0.001, backoff_max_s=0.01, failure_threshold=1000)
+    with ShopifyMockServer(products=5, variants_per_product=3, error_rate=0.5) as server:
+        with ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint, retry=retry) as client:
+            for i in range(20):
+                data = client.post('query { currentBulkOperation(type: QUERY) {id status} }')
+                assert data['data']['currentBulkOperation'] is None
+            retries = client.metrics.phases.get("retry", {}).get("count", 0)
+    assert server.request_count.get("502", 0) > 0
+    assert retries == server.request_count["502"]
+    assert retry.consecutive_failures == 0
+
+
+def test_circuit_breaker_opens_and_closes():
+    """
+    After failure_threshold errors in a row the circuit breaker opens (fail_fast raises right away),
+    and the first success after reset_s closes it.
+    """
+    retry = ShopifyRetryPolicy(retries=1, backoff_min_s=0.001, backoff_max_s=0.01, failure_threshold=2, reset_s=0.5, fail_fast=True)
+    with ShopifyMockServer(products=5, variants_per_product=3, error_rate=1.0) as server:
+        with ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint, retry=retry) as client:
+            query = 'query { currentBulkOperation(type: QUERY) {id status} }'
+            with pytest.raises(Exception, match="FAILED after 1 retries"):
+                client.post(query)
+            assert retry.trips == 1
+            errors = server.request_count["502"]
+            with pytest.raises(Exception, match="Circuit breaker open"):
+                client.post(query)
+            # Not sent while the circuit breaker is open
+            assert server.request_count["502"] == errors
+
+            server.error_rate = 0.0
+            time.sleep(0.5)
+            assert client.post(query)['data']['currentBulkOperation'] is None
+            assert retry.consecutive_failures == 0
+
+
+@pytest.mark.parametrize("sent", [True, False])
+def test_bulk_query_start_is_not_sent_twice(sent):
+    """
+    A bulkOperationRunQuery whose response is lost (a read timeout after the store created it) isn't sent again:
+    the shop's current bulk operation is checked and its id is returned.  One that never reached the store
+    (the connection dropped before it was sent) is sent again.
+    """
+    with ShopifyMockServer(products=5, variants_per_product=3) as server:
+        with mock_client(server) as client:
+            session_post = client.session.post
+            failures = []
+
+            def post_timeout(url, **kwargs):
+                if "bulkOperationRunQuery" in str(kwargs.get('data')) and len(failures) == 0:
+                    failures.append(url)
+                    if not sent: raise requests.exceptions.ConnectionError("connection reset")
+                    session_post(url, **kwargs)
+                    raise requests.exceptions.ReadTimeout("read timeout")
+                return session_post(url, **kwargs)
+
+            client.session.post = post_timeout
+            bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+            client.session.post = session_post
+            cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, client=client)
+    assert not url is None
+    assert server.request_count.get("bulkOperationRunQuery", 0) == 1
+    assert server.request_count.get("bulk_operation_in_progress", 0) == 0
+
+
+def test_price_book_cache(tmp_path):
+    """
+    The cached index is memory-mapped (binary searched, not rebuilt), is rebuilt when the columns change,
+    and rows without a SKU are skipped.
+    """
+    path_file = tmp_path.joinpath("supplier_prices.csv")
+    path_file.write_text("sku,book_price_eur,list_price_eur\nB1,1.50,9.00\n,2.00,9.00\nA22,3.25,8.00\nB1,1.75,7.00\nC3,,6.00\n")
+
+    price_book = SupplierPriceBook.load_cached(path_file=path_file)
+    assert price_book.mmaps is None
+    assert len(price_book) == 2
+    price_book = SupplierPriceBook.load_cached(path_file=path_file)
+    assert not price_book.mmaps is None
+    assert [price_book.get(sku) for sku in ("B1", "A22", "C3", "", "A222")] == [1.75, 3.25, None, None, None]
+    assert [None if price != price else price for price in price_book.lookup(["A22", "B1", "C3", "A2", ""])] == [3.25, 1.75, None, None, None]
+    price_book.close()
+
+    price_book = SupplierPriceBook.load_cached(path_file=path_file, price_column="list_price_eur")
+    assert price_book.mmaps is None
+    assert [price_book.get(sku) for sku in ("B1", "A22", "C3")] == [7.0, 8.0, 6.0]
+
+
+def test_reprice_with_a_memory_mapped_price_book(tmp_path):
+    """
+    A memory-mapped price book prices the catalog like the in-memory one it was saved from.
+    """
+    with ShopifyMockServer(products=40, variants_per_product=3) as server:
+        mock_price_book(server, changed=lambda i: i % 4 == 0).save(tmp_path.joinpath("index"))
+        price_book = SupplierPriceBook.open(tmp_path.joinpath("index"))
+        with mock_client(server) as client:
+            variants_count = shopify_update_product_variant_prices(verbose=False, price_book=price_book, client=client)
+        price_book.close()
+    assert variants_count == 30
+    assert server.variants_updated == variants_count
+
+
+def test_bulk_first_update_is_the_first_acknowledged_result(tmp_path):
+    """
+    In mode "bulk" the time to the first update is recorded when the bulk mutation's first result is
+    acknowledged (after its completed poll), not when it is submitted.
+    """
+    with ShopifyMockServer(products=40, variants_per_product=3) as server:
+        price_book = mock_price_book(server, changed=lambda i: True)
+        with mock_client(server) as client:
+            shopify_update_product_variant_prices(verbose=False, mode="bulk", price_book=price_book, path_dir=tmp_path, client=client)
+            phases = [event['phase'] for event in client.metrics.events]
+    assert phases.count("first_update") == 1
+    # The last poll is the bulk mutation's COMPLETED poll
+    assert phases.index("first_update") > len(phases) - 1 - phases[::-1].index("bulk_poll")
+
+
+@pytest.fixture
+def bulk_results_file(tmp_path):
+    """
+    Returns a bulk query results file of products with 0 to 12 variants (nested 3 deep), and its lines.
+    """
+    lines = []
+    for p in range(300):
+        product_gid = f"gid://shopify/Product/{p + 1}"
+        lines.append(json.dumps({"id": product_gid, "title": f"product {p}"}))
+        for v in range(p * 7 % 13):
+            variant_gid = f"gid://shopify/ProductVariant/{(p + 1) * 100 + v}"
+            lines.append(json.dumps({"id": variant_gid, "sku": f"SKU{p:07d}V{v:02d}", "price": shopify_mock_price((p + 1) * 100 + v), "__parentId": product_gid}))
+            if v % 3 == 0: lines.append(json.dumps({"id": f"gid://shopify/InventoryLevel/{(p + 1) * 100 + v}", "available": v, "__parentId": variant_gid}))
+    path_file = tmp_path.joinpath("bulk_dl.jsonl")
+    path_file.write_text("\n".join(lines) + "\n")
+    return path_file, lines
+
+
+def test_bulk_file_chunks_split_at_top_level_objects(bulk_results_file):
+    """
+    Every chunk starts at the start of a top level line, and the chunks cover the file without gaps.
+    """
+    path_file, lines = bulk_results_file
+    content = path_file.read_bytes()
+    ranges = shopify_graphql_bulk_file_chunks(path_file, chunk_size=1000)
+    assert len(ranges) > 50
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(content)
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    for start, end in ranges:
+        assert start == 0 or content[start - 1:start] == b"\n"
+        assert not b'"__parentId"' in content[start:content.index(b"\n", start)]
+
+
+def test_bulk_parse_file_parallel_matches_sequential(bulk_results_file):
+    """
+    The file parsed in small chunks by a pool of processes gives the same objects, in the same order,
+    as the sequential reassembly of every line.
+    """
+    path_file, lines = bulk_results_file
+    child_keys = {"ProductVariant": "variants", "InventoryLevel": "levels"}
+    expected = list(shopify_graphql_bulk_reassemble((json.loads(line) for line in lines), child_keys=child_keys))
+    assert shopify_graphql_bulk_parse_file(path_file=path_file, processes=1, child_keys=child_keys, backend="json") == expected
+    assert shopify_graphql_bulk_parse_file(path_file=path_file, processes=4, child_keys=child_keys, chunk_size=1000, backend="json") == expected
+
+
+def test_client_close_closes_the_metrics_file(tmp_path):
+    """
+    Closing the client flushes and closes its metrics file.  A shared ShopifyMetrics opens it again for the next event.
+    """
+    path_file = tmp_path.joinpath("metrics.jsonl")
+    metrics = ShopifyMetrics(path_file=path_file)
+    with ShopifyMockServer(products=5, variants_per_product=3) as server:
+        for i in range(2):
+            with ShopifyGraphQLClient(api_token="shpat_mock", graphql_endpoint=server.graphql_endpoint, metrics=metrics) as client:
+                bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+                shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, client=client)
+            assert metrics.file is None
+            events = [json.loads(line) for line in path_file.read_text().splitlines()]
+            assert [event['phase'] for event in events].count("bulk_query_submit") == i + 1
+
+
+def test_bulk_poll_adaptive_backoff():
+    """
+    The wait between polls starts at wait_min_s and grows by backoff up to wait_max_s while the bulk query runs,
+    and a poll with timeout_s gives up (url None) when the bulk query isn't complete in time.
+    """
+    # 400 objects at 400 objects/s:  the bulk query runs for about 1 s
+    with ShopifyMockServer(products=100, variants_per_product=3, bulk_objects_per_s=400.0) as server:
+        with mock_client(server) as client:
+            bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+            cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, client=client, wait_min_s=0.05, wait_max_s=0.4, backoff=2.0)
+            waits = [event['latency_s'] for event in client.metrics.events if event['phase'] == "bulk_poll_wait"]
+            assert not url is None
+            assert int(obj_count) == 400
+            # Jitter is +-20 %
+            assert waits[0] <= 0.05 * 1.2
+            assert max(waits) >= 0.2 * 0.8
+            assert max(waits) <= 0.4 * 1.2
+            # Fewer polls than at a fixed wait_min_s
+            assert len(waits) < 1.0 / 0.05
+
+    with ShopifyMockServer(products=1000, variants_per_product=3, bulk_objects_per_s=100.0) as server:
+        with mock_client(server) as client:
+            bulk_op_id = shopify_graphql_bulk_query(query=PRODUCTS_BULK_QUERY, client=client)
+            t_start = time.monotonic()
+            cost, obj_count, url = shopify_graphql_bulk_poll(bulk_op_id=bulk_op_id, client=client, wait_min_s=0.05, timeout_s=0.3)
+            assert url is None
+            assert time.monotonic() - t_start < 1.0
+
+
+def test_catalog_snapshot_incremental_refresh(tmp_path):
+    """
+    The first refresh exports the whole catalog.  The next one exports only the variants updated since the
+    watermark and merges them into the snapshot by variant_gid.
+    """
+    path_snapshot = tmp_path.joinpath("catalog_snapshot.parquet")
+    with ShopifyMockServer(products=20, variants_per_product=3) as server:
+        with mock_client(server) as client:
+            table = shopify_catalog_snapshot_refresh(path_file=path_snapshot, client=client)
+            assert table.num_rows == 60
+            assert [bulk_operation["updated_since"] for bulk_operation in server.bulk_operations.values()] == [None]
+
+            # A stale snapshot:  every price is 0.00 and the watermark is the updated_at of the 41st variant
+            rows = table.to_pylist()
+            updated_at = sorted(row['updated_at'] for row in rows)
+            stale = table.from_pylist([dict(row, price="0.00") for row in rows], schema=table.schema)
+            shopify_catalog_snapshot_save(table=stale, path_file=path_snapshot, watermark=updated_at[40])
+
+            table = shopify_catalog_snapshot_refresh(path_file=path_snapshot, client=client)
+    assert list(server.bulk_operations.values())[-1]["updated_since"] == updated_at[40]
+    assert table.num_rows == 60
+    assert sorted(table['variant_gid'].to_pylist()) == sorted(row['variant_gid'] for row in rows)
+    refreshed = [row for row in table.to_pylist() if not row['price'] == "0.00"]
+    assert len(refreshed) == 20
+    assert all(row['updated_at'] >= updated_at[40] for row in refreshed)
+    assert table.schema.metadata[b"watermark"].decode("utf-8") == updated_at[-1]
+
+
+class RatesApi:
+    """
+    A stub daily rates API that records the ranges it is called with.  Weekends have no rate.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, currency_from, currency_to, start_date, end_date, verbose=False):
+        from datetime import date, timedelta
+        self.calls.append((start_date, end_date))
+        rates = {}
+        day = date.fromisoformat(start_date)
+        while day <= date.fromisoformat(end_date):
+            if day.weekday() < 5: rates[day.isoformat()] = 1.0 + day.day / 100.0
+            day += timedelta(days=1)
+        return rates
+
+
+def test_currency_rate_cache(tmp_path):
+    """
+    Past days are fetched once (also the weekend days without a rate), only the new days of a later range are
+    fetched, and the rates persisted to path_file are merged across caches and re-used by a new cache.
+    """
+    path_file = tmp_path.joinpath("currency_rates.json")
+    rates_api = RatesApi()
+    cache = CurrencyRateCache(path_file=path_file, rates_api=rates_api)
+    # 2024-11-14 is a Thursday:  the 16th and the 17th are a weekend
+    assert cache.max_rate("EUR", "USD", "2024-11-14", "2024-11-20") == 1.2
+    assert cache.max_rate("EUR", "USD", "2024-11-14", "2024-11-20") == 1.2
+    assert cache.max_rate("EUR", "USD", "2024-11-15", "2024-11-18") == 1.18
+    assert rates_api.calls == [("2024-11-14", "2024-11-20")]
+    assert cache.max_rate("EUR", "USD", "2024-11-16", "2024-11-22") == 1.22
+    assert rates_api.calls[1:] == [("2024-11-21", "2024-11-22")]
+    # Only weekend days:  no rate, and not fetched again
+    assert cache.max_rate("EUR", "USD", "2024-11-16", "2024-11-17") is None
+    assert len(rates_api.calls) == 2
+
+    # Another cache of the same file writes another pair.  Both are in the file.
+    rates_api_other = RatesApi()
+    CurrencyRateCache(path_file=path_file, rates_api=rates_api_other).max_rate("EUR", "GBP", "2024-11-14", "2024-11-15")
+    cache.max_rate("EUR", "USD", "2024-11-25", "2024-11-25")
+    rates_api_new = RatesApi()
+    cache_new = CurrencyRateCache(path_file=path_file, rates_api=rates_api_new)
+    assert cache_new.max_rate("EUR", "USD", "2024-11-14", "2024-11-25") == 1.25
+    assert cache_new.max_rate("EUR", "GBP", "2024-11-14", "2024-11-15") == 1.15
+    assert rates_api_new.calls == [("2024-11-23", "2024-11-24")]